@@ -17,7 +17,7 @@ import mailpile.ui
 from mailpile.eventlog import Event
 from mailpile.mailboxes import IsMailbox
 from mailpile.mailutils import ExtractEmails, ExtractEmailAndName, Email
-from mailpile.postinglist import GlobalPostingList
+from mailpile.postinglist import GlobalPostingList, JournalFlusher
 from mailpile.search import MailIndex
 from mailpile.util import *
 from mailpile.vcard import AddressInfo
@@ -565,18 +565,13 @@ class SearchResults(dict):
         return dict_merge(self.session.config.get_tag_info(tid), attributes)
 
     def _thread(self, thread_mid):
-        msg_info = self.idx.get_msg_at_idx_pos(int(thread_mid, 36))
-        thread = [i for i in msg_info[MailIndex.MSG_REPLIES].split(',') if i]
-
-        # FIXME: This is a hack, the indexer should just keep things
-        #        in the right order on rescan. Fixing threading is a bigger
-        #        problem though, so we do this for now.
-        def thread_sort_key(idx):
-            info = self.idx.get_msg_at_idx_pos(int(thread_mid, 36))
-            return int(info[self.idx.MSG_DATE], 36)
-        thread.sort(key=thread_sort_key)
-
-        return thread
+        # Replies are ordered by date using the cached sort order, so we
+        # never load the metadata of replies which are not displayed.
+        thread = list(self.idx.get_thread(int(thread_mid, 36)))
+        date_rank = self.idx.INDEX_SORT.get('date')
+        if date_rank:
+            thread.sort(key=date_rank.__getitem__)
+        return [b36(i) for i in thread]
 
     WANT_MSG_TREE = ('attachments', 'html_parts', 'text_parts', 'header_list',
                      'editing_strings', 'crypto')
@@ -586,13 +581,39 @@ class SearchResults(dict):
         for k in tree.keys():
             if k not in self.WANT_MSG_TREE or k in self.PRUNE_MSG_TREE:
                 del tree[k]
+        # The MIME parts hold the raw attachments, we don't want to keep
+        # those around (or cached). Email.extract_attachment() gets them
+        # by count, when someone actually wants them.
+        for att in tree.get('attachments', []):
+            att.pop('part', None)
         return tree
 
+    # Trees are not cached if they may change without the index noticing:
+    # drafts can be edited, and importing or revoking keys changes how
+    # messages decrypt and verify. So we only cache final crypto states.
+    CACHEABLE_CRYPTO = ('none', 'decrypted', 'verified')
+
+    def _cacheable(self, email, tree):
+        if email.ephemeral_mid or email.is_editable():
+            return False
+        for info in tree.get('crypto', {}).values():
+            if info.get('status', 'none') not in self.CACHEABLE_CRYPTO:
+                return False
+        return True
+
     def _message(self, email):
-        tree = email.get_message_tree(want=(email.WANT_MSG_TREE_PGP +
-                                            self.WANT_MSG_TREE))
-        email.evaluate_pgp(tree, decrypt=True)
-        return self._prune_msg_tree(tree)
+        trees = self.idx.MSG_TREES
+        trees.max_trees = self.session.config.sys.message_cache
+        key = self.idx.msg_tree_key(email.get_msg_info())
+        tree = trees.get(email.msg_idx_pos, key)
+        if tree is None:
+            tree = email.get_message_tree(want=(email.WANT_MSG_TREE_PGP +
+                                                self.WANT_MSG_TREE))
+            email.evaluate_pgp(tree, decrypt=True)
+            tree = self._prune_msg_tree(tree)
+            if self._cacheable(email, tree):
+                trees.put(email.msg_idx_pos, key, tree)
+        return tree
 
     def __init__(self, session, idx,
                  results=None, start=0, end=None, num=None,
@@ -838,7 +859,8 @@ class Load(Command):
 
 class Rescan(Command):
     """Add new messages to index"""
-    SYNOPSIS = (None, 'rescan', None, '[all|vcards|mailboxes|<msgs>]')
+    SYNOPSIS = (None, 'rescan', None,
+                '[all|vcards|mailboxes [<mailbox ids>]|<msgs>]')
     ORDER = ('Internals', 2)
     SERIALIZE = 'Rescan'
     LOG_PROGRESS = True
@@ -860,7 +882,8 @@ class Rescan(Command):
         if args and args[0].lower() == 'vcards':
             return self._rescan_vcards(session, config)
         elif args and args[0].lower() == 'mailboxes':
-            return self._rescan_mailboxes(session, config)
+            return self._rescan_mailboxes(session, config,
+                                          which=args[1:] or None)
         elif args and args[0].lower() == 'all':
             args.pop(0)
 
@@ -909,7 +932,7 @@ class Rescan(Command):
                     imported += imp.import_vcards(session, config.vcards)
         return {'vcards': imported}
 
-    def _rescan_mailboxes(self, session, config):
+    def _rescan_mailboxes(self, session, config, which=None):
         idx = self._idx()
         msg_count = 0
         mbox_count = 0
@@ -920,14 +943,18 @@ class Rescan(Command):
                 session.ui.mark(_('Running: %s') % pre_command)
                 subprocess.check_call(pre_command, shell=True)
             msg_count = 1
+            flusher = JournalFlusher(session, idx)
             for fid, fpath in config.get_mailboxes():
                 if fpath == '/dev/null':
                     continue
+                if which and fid not in which:
+                    continue
                 if mailpile.util.QUITTING:
                     break
                 try:
                     count = idx.scan_mailbox(session, fid, fpath,
-                                             config.open_mailbox)
+                                             config.open_mailbox,
+                                             flusher=flusher)
                 except ValueError:
                     session.ui.warning(_('Failed to rescan: %s') % fpath)
                     count = 0
@@ -935,9 +962,13 @@ class Rescan(Command):
                 if count:
                     msg_count += count
                     mbox_count += 1
-                config.clear_mbox_cache()
                 session.ui.mark('\n')
             msg_count -= 1
+            if 'rescan' in config.sys.debug:
+                session.ui.debug(_('Mailbox cache: %(open)d/%(max_open)s open, '
+                                   '%(hits)d hits, %(misses)d misses, '
+                                   '%(evictions)d evictions'
+                                   ) % config.mbox_cache_stats())
             if msg_count:
                 if not mailpile.util.QUITTING:
                     idx.cache_sort_orders(session)
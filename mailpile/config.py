@@ -30,7 +30,10 @@ from mailpile.commands import Rescan
 from mailpile.eventlog import EventLog
 from mailpile.httpd import HttpWorker
 from mailpile.mailboxes import MBX_ID_LEN, OpenMailbox, NoSuchMailboxError
+from mailpile.mailboxes import MailboxCache
 from mailpile.mailboxes import wervd
+import mailpile.mailboxes.imap
+import mailpile.mailboxes.mbox
 from mailpile.search import MailIndex
 from mailpile.util import *
 from mailpile.ui import Session, BackgroundInteraction
@@ -902,7 +905,7 @@ class ConfigManager(ConfigDict):
         self.event_log = None
         self.index = None
         self.vcards = {}
-        self._mbox_cache = {}
+        self._mbox_cache = MailboxCache()
         self._running = {}
 
         self._magic = True  # Enable the getattr/getitem magic
@@ -1078,7 +1081,10 @@ class ConfigManager(ConfigDict):
         self.prepare_workers()
 
     def clear_mbox_cache(self):
-        self._mbox_cache = {}
+        self._mbox_cache.clear()
+
+    def mbox_cache_stats(self):
+        return self._mbox_cache.stats()
 
     def get_mailboxes(self):
         def fmt_mbxid(k):
@@ -1134,21 +1140,64 @@ class ConfigManager(ConfigDict):
         finally:
             fd.close()
 
+    def load_toc_cache(self, tfn):
+        with open(os.path.join(self.workdir, tfn), 'rb') as fd:
+            if self.prefs.obfuscate_index:
+                from mailpile.crypto.streamer import DecryptingStreamer
+                with DecryptingStreamer(self.prefs.obfuscate_index,
+                                        fd) as streamer:
+                    data = streamer.read()
+            else:
+                data = fd.read()
+        return mailpile.mailboxes.mbox.MailpileMailbox.FromTocCache(data)
+
+    def save_toc_cache(self, obj, tfn):
+        # Encrypted caches can't be appended to, so they are rewritten.
+        full, chunk = obj.get_toc_chunk(full=self.prefs.obfuscate_index)
+        if self.prefs.obfuscate_index:
+            from mailpile.crypto.streamer import EncryptingStreamer
+            fd = EncryptingStreamer(self.prefs.obfuscate_index,
+                                    dir=self.workdir)
+            try:
+                fd.write(chunk)
+                fd.save(os.path.join(self.workdir, tfn))
+            finally:
+                fd.close()
+        else:
+            with open(os.path.join(self.workdir, tfn),
+                      'wb' if full else 'ab') as fd:
+                fd.write(chunk)
+
     def open_mailbox(self, session, mailbox_id):
         try:
             mbx_id = mailbox_id.lower()
             mfn = self.sys.mailbox[mbx_id]
             pfn = 'pickled-mailbox.%s' % mbx_id
+            tfn = 'toc-mailbox.%s' % mbx_id
         except KeyError:
             raise NoSuchMailboxError(_('No such mailbox: %s') % mbx_id)
 
+        def saver(mbx):
+            # mbox-style mailboxes get the compact, incremental TOC cache
+            if hasattr(mbx, 'get_toc_chunk'):
+                return (lambda o, f: self.save_toc_cache(o, f)), tfn
+            return (lambda o, f: self.save_pickle(o, f)), pfn
+
+        # Mailboxes hold open files, so we only keep so many around.
+        self._mbox_cache.max_open = self.sys.fd_cache_size
+        mbox = self._mbox_cache.get(mbx_id)
         try:
-            if mbx_id in self._mbox_cache:
-                self._mbox_cache[mbx_id].update_toc()
+            if mbox is not None:
+                mbox.update_toc()
             else:
                 if session:
                     session.ui.mark(_('%s: Updating: %s') % (mbx_id, mfn))
-                self._mbox_cache[mbx_id] = self.load_pickle(pfn)
+                if os.path.exists(os.path.join(self.workdir, tfn)):
+                    mbox = self.load_toc_cache(tfn)
+                else:
+                    mbox = self.load_pickle(pfn)
+                # Don't save right away, but save after the next scan.
+                mbox._save_to = saver(mbox)
         except:
             if self.sys.debug:
                 import traceback
@@ -1159,16 +1208,14 @@ class ConfigManager(ConfigDict):
             editable = self.is_editable_mailbox(mbx_id)
             mbox = OpenMailbox(mfn, self, create=editable)
             mbox.editable = editable
-            mbox.save(session,
-                      to=pfn,
-                      pickler=lambda o, f: self.save_pickle(o, f))
-            self._mbox_cache[mbx_id] = mbox
+            pickler, fn = saver(mbox)
+            mbox.save(session, to=fn, pickler=pickler)
+        self._mbox_cache.put(mbx_id, mbox)
 
         # Always set this, it can't be pickled
-        self._mbox_cache[mbx_id]._encryption_key_func = \
-            lambda: self.prefs.obfuscate_index
+        mbox._encryption_key_func = lambda: self.prefs.obfuscate_index
 
-        return self._mbox_cache[mbx_id]
+        return mbox
 
     def open_local_mailbox(self, session):
         local_id = self.sys.get('local_mailbox_id', None)
@@ -1311,6 +1358,8 @@ class ConfigManager(ConfigDict):
     def prepare_workers(config, session=None, daemons=False):
         # Set globals from config first...
         import mailpile.util
+        mailpile.mailboxes.imap.POOL.max_connections = \
+            config.sys.imap_connections
 
         # Make sure we have a silent background session
         if not config.background:
@@ -1353,6 +1402,11 @@ class ConfigManager(ConfigDict):
                         config.slow_worker.add_task(session, 'Rescan', rsc.run)
                 config.cron_worker.add_task('rescan', rescan_interval, rescan)
 
+            # Keep idle IMAP connections from timing out.
+            imap_pool = mailpile.mailboxes.imap.POOL
+            config.cron_worker.add_task('imap_keepalive', imap_pool.KEEPALIVE,
+                                        imap_pool.keepalive)
+
             # Schedule plugin jobs
             from mailpile.plugins import PluginManager
 
@@ -1383,6 +1437,7 @@ class ConfigManager(ConfigDict):
                       config.cron_worker] + config.other_workers:
                 if w:
                     w.quit(join=wait)
+        mailpile.mailboxes.imap.POOL.close()
         config.other_workers = []
         config.http_worker = config.cron_worker = None
         config.slow_worker = config.dumb_worker
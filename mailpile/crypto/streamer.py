@@ -1,3 +1,4 @@
+import binascii
 import os
 import hashlib
 import random
@@ -9,6 +10,38 @@ from tempfile import NamedTemporaryFile
 
 from mailpile.util import sha512b64 as genkey
 
+try:
+    import ctypes
+    import ctypes.util
+    _libcrypto = ctypes.CDLL(ctypes.util.find_library('crypto') or
+                             'libcrypto.so')
+    for _func, _restype, _argtypes in (
+            ('EVP_get_cipherbyname', ctypes.c_void_p, [ctypes.c_char_p]),
+            ('EVP_get_digestbyname', ctypes.c_void_p, [ctypes.c_char_p]),
+            ('EVP_md5', ctypes.c_void_p, []),
+            ('EVP_sha256', ctypes.c_void_p, []),
+            ('EVP_BytesToKey', ctypes.c_int, [
+                ctypes.c_void_p, ctypes.c_void_p, ctypes.c_char_p,
+                ctypes.c_char_p, ctypes.c_int, ctypes.c_int,
+                ctypes.c_char_p, ctypes.c_char_p]),
+            ('EVP_CIPHER_CTX_new', ctypes.c_void_p, []),
+            ('EVP_CIPHER_CTX_free', None, [ctypes.c_void_p]),
+            ('EVP_CipherInit_ex', ctypes.c_int, [
+                ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p,
+                ctypes.c_char_p, ctypes.c_char_p, ctypes.c_int]),
+            ('EVP_CipherUpdate', ctypes.c_int, [
+                ctypes.c_void_p, ctypes.c_char_p, ctypes.c_void_p,
+                ctypes.c_char_p, ctypes.c_int]),
+            ('EVP_CipherFinal_ex', ctypes.c_int, [
+                ctypes.c_void_p, ctypes.c_char_p, ctypes.c_void_p])):
+        getattr(_libcrypto, _func).restype = _restype
+        getattr(_libcrypto, _func).argtypes = _argtypes
+    if hasattr(_libcrypto, 'OPENSSL_add_all_algorithms_noconf'):
+        # OpenSSL < 1.1 needs to be told to load its ciphers
+        _libcrypto.OPENSSL_add_all_algorithms_noconf()
+except (ImportError, OSError, AttributeError):
+    _libcrypto = None
+
 
 class IOFilter(threading.Thread):
     """
@@ -180,6 +213,11 @@ class ChecksummingStreamer(OutputCoprocess):
             with open(filename, 'wb') as out:
                 self.save_copy(out)
 
+    def fsync(self):
+        """Make sure everything written so far is on disk."""
+        self.tempfile.flush()
+        os.fsync(self.tempfile.fileno())
+
     def save_copy(self, ofd):
         self.tempfile.seek(0, 0)
         data = self.tempfile.read(4096)
@@ -218,8 +256,14 @@ class EncryptingStreamer(ChecksummingStreamer):
     # (yet) behave well with it.
     DEFAULT_CIPHER = "aes-256-cbc"
 
+    # The digest used to derive the key. This is recorded in the header,
+    # as the openssl default depends on its version. Data without an md:
+    # header was encrypted with that default.
+    DEFAULT_MD = "sha256"
+
     def __init__(self, key, dir=None, cipher=None):
         self.cipher = cipher or self.DEFAULT_CIPHER
+        self.md = self.DEFAULT_MD
         self.nonce, self.key = self._mutate_key(key)
         ChecksummingStreamer.__init__(self, dir=dir)
         self._send_key()
@@ -233,11 +277,12 @@ class EncryptingStreamer(ChecksummingStreamer):
 
     def _mk_command(self):
         return ["openssl", "enc", "-e", "-a", "-%s" % self.cipher,
-                "-pass", "stdin"]
+                "-md", self.md, "-pass", "stdin"]
 
     def _write_preamble(self):
         self.fd.write(self.BEGIN_DATA)
         self.fd.write('cipher: %s\n' % self.cipher)
+        self.fd.write('md: %s\n' % self.md)
         self.fd.write('nonce: %s\n' % self.nonce)
         self.fd.write('\n')
         self.fd.flush()
@@ -270,6 +315,7 @@ class DecryptingStreamer(InputCoprocess):
         self.outer_md5 = hashlib.md5()
         self.data_filter = IOFilter(fd, self._read_data)
         self.cipher = self.DEFAULT_CIPHER
+        self.md = None
         self.state = self.STATE_BEGIN
         self.buffered = ''
         self.key = key
@@ -334,6 +380,7 @@ class DecryptingStreamer(InputCoprocess):
         if self.state == self.STATE_HEADER:
             headers = dict([l.split(': ', 1) for l in headlines[1:]])
             self.cipher = headers.get('cipher', self.cipher)
+            self.md = headers.get('md')
             nonce = headers.get('nonce')
             mutated = self._mutate_key(self.key, nonce)
             data = '\n'.join((mutated, data))
@@ -360,8 +407,361 @@ class DecryptingStreamer(InputCoprocess):
             return None
         elif self.state == self.STATE_PGP_DATA:
             return ["gpg", "--batch"]
-        return ["openssl", "enc", "-d", "-a", "-%s" % self.cipher,
-                "-pass", "stdin"]
+        md = ["-md", self.md] if self.md else []
+        return ["openssl", "enc", "-d", "-a", "-%s" % self.cipher
+                ] + md + ["-pass", "stdin"]
+
+
+class EVPCipher(object):
+    """
+    An OpenSSL cipher, run in-process using libcrypto. Keys and IVs are
+    derived from a passphrase and salt the same way `openssl enc -pass`
+    does it, so the results are interchangeable with the openssl tool.
+    The key derivation digest should be given as md, otherwise we guess
+    what the openssl tool would use by default.
+    """
+    MAX_BLOCK_LENGTH = 32
+    MAX_KEY_LENGTH = 64
+
+    def __init__(self, cipher, passphrase, salt, encrypt, md=None):
+        evp = _libcrypto.EVP_get_cipherbyname(cipher)
+        if not evp:
+            raise ValueError('Unknown cipher: %s' % cipher)
+        if md:
+            evp_md = _libcrypto.EVP_get_digestbyname(md)
+            if not evp_md:
+                raise ValueError('Unknown digest: %s' % md)
+        else:
+            evp_md = self._default_md()
+        key = ctypes.create_string_buffer(self.MAX_KEY_LENGTH)
+        iv = ctypes.create_string_buffer(self.MAX_KEY_LENGTH)
+        if not _libcrypto.EVP_BytesToKey(evp, evp_md, salt,
+                                         passphrase, len(passphrase), 1,
+                                         key, iv):
+            raise ValueError('Key derivation failed')
+        self._ctx = _libcrypto.EVP_CIPHER_CTX_new()
+        if not _libcrypto.EVP_CipherInit_ex(self._ctx, evp, None, key, iv,
+                                            1 if encrypt else 0):
+            raise ValueError('Cipher setup failed')
+
+    @classmethod
+    def Available(cls):
+        return _libcrypto is not None
+
+    @classmethod
+    def _default_md(cls):
+        # This is what `openssl enc` uses, assuming the tool links against
+        # the same libcrypto as we do: MD5 until 1.1.0, SHA-256 after.
+        version = (getattr(_libcrypto, 'OpenSSL_version_num', None) or
+                   getattr(_libcrypto, 'SSLeay'))
+        version.restype = ctypes.c_ulong
+        if version() >= 0x10100000:
+            return _libcrypto.EVP_sha256()
+        return _libcrypto.EVP_md5()
+
+    def update(self, data):
+        out = ctypes.create_string_buffer(len(data) + self.MAX_BLOCK_LENGTH)
+        outlen = ctypes.c_int(0)
+        if not _libcrypto.EVP_CipherUpdate(self._ctx, out,
+                                           ctypes.byref(outlen),
+                                           data, len(data)):
+            raise ValueError('Cipher update failed')
+        return out.raw[:outlen.value]
+
+    def final(self):
+        out = ctypes.create_string_buffer(self.MAX_BLOCK_LENGTH)
+        outlen = ctypes.c_int(0)
+        if not _libcrypto.EVP_CipherFinal_ex(self._ctx, out,
+                                             ctypes.byref(outlen)):
+            raise ValueError('Bad decrypt')
+        return out.raw[:outlen.value]
+
+    def __del__(self):
+        # During interpreter shutdown _libcrypto may already be gone
+        if getattr(self, '_ctx', None) and _libcrypto is not None:
+            _libcrypto.EVP_CIPHER_CTX_free(self._ctx)
+            self._ctx = None
+
+
+class _FilteredWriter(object):
+    """A synchronous stand-in for IOFilter.writer()."""
+    def __init__(self, fd, callback):
+        self.fd = fd
+        self.callback = callback
+
+    def write(self, data):
+        self.fd.write(self.callback(data))
+
+    def flush(self):
+        self.fd.flush()
+
+    def close(self):
+        self.fd.write(self.callback(None))
+        self.fd.flush()
+
+
+class InlineChecksummingStreamer(ChecksummingStreamer):
+    """
+    A ChecksummingStreamer which does its work in-process, instead of
+    using a filter thread.
+    """
+    def __init__(self, dir=None):
+        self.tempfile = NamedTemporaryFile(dir=dir, delete=False)
+        self.outer_md5sum = None
+        self.outer_md5 = hashlib.md5()
+        self.fd = _FilteredWriter(self.tempfile, self._outer_md5_callback)
+        self.saved = False
+        self.finished = False
+        self._retval = None
+        self._write_preamble()
+
+    def write(self, data):
+        self.fd.write(data)
+
+    def flush(self):
+        self.fd.flush()
+
+    def _finish_data(self):
+        pass
+
+    def finish(self):
+        if self.finished:
+            return
+        self.finished = True
+        self._finish_data()
+        self._write_postamble()
+        self.fd.close()
+        self._retval = 0
+        self.tempfile.seek(0, 0)
+
+
+class InlineEncryptingStreamer(InlineChecksummingStreamer, EncryptingStreamer):
+    """
+    An EncryptingStreamer which encrypts in-process, instead of using an
+    openssl coprocess and a filter thread. The output is in the same
+    format and can be decrypted by either kind of decrypting streamer.
+    """
+    SALT_MAGIC = 'Salted__'
+    B64_LINE = 48  # Bytes per line, as `openssl enc -a` does it
+
+    def __init__(self, key, dir=None, cipher=None):
+        self.cipher = cipher or self.DEFAULT_CIPHER
+        self.md = self.DEFAULT_MD
+        self.nonce, self.key = self._mutate_key(key)
+        salt = os.urandom(8)
+        self._evp = EVPCipher(self.cipher, self.key, salt, True, md=self.md)
+        self._pending = self.SALT_MAGIC + salt
+        InlineChecksummingStreamer.__init__(self, dir=dir)
+
+    def _write_lines(self, final=False):
+        pending, ll = self._pending, self.B64_LINE
+        whole = len(pending) if final else (len(pending) - len(pending) % ll)
+        if whole:
+            self.fd.write(''.join(binascii.b2a_base64(pending[i:i + ll])
+                                  for i in range(0, whole, ll)))
+            self._pending = pending[whole:]
+
+    def write(self, data):
+        self._pending += self._evp.update(data)
+        if len(self._pending) >= self.B64_LINE:
+            self._write_lines()
+
+    def _finish_data(self):
+        self._pending += self._evp.final()
+        self._write_lines(final=True)
+
+
+class InlineDecryptingStreamer(object):
+    """
+    A file-like object which decrypts data written by an EncryptingStreamer
+    in-process, as it is read. Unencrypted data is passed through as-is.
+    Raises ValueError if the data is in a format we can't decrypt (PGP).
+    """
+    BLOCKSIZE = 16 * 1024
+    BEGIN_PGP = DecryptingStreamer.BEGIN_PGP
+    BEGIN_MED = DecryptingStreamer.BEGIN_MED
+    DEFAULT_CIPHER = DecryptingStreamer.DEFAULT_CIPHER
+    SALT_MAGIC = InlineEncryptingStreamer.SALT_MAGIC
+
+    def __init__(self, key, fd, md5sum=None):
+        self.expected_outer_md5sum = md5sum
+        self.outer_md5 = hashlib.md5()
+        self.fd = fd
+        self.error = False
+        self._evp = None
+        self._b64 = ''
+        self._buffer, self._offset, self._pos = '', 0, 0
+        self._done = self._eof = False
+        self._start(key)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _read_fd(self):
+        data = self.fd.read(self.BLOCKSIZE)
+        if data:
+            self.outer_md5.update(data.replace('\r', '').replace('\n', '\r\n'))
+        else:
+            self._eof = True
+        return data
+
+    def _start(self, key):
+        data = self._read_fd()
+        while not self._eof and len(data) < len(self.BEGIN_MED):
+            data += self._read_fd()
+        if data.startswith(self.BEGIN_PGP):
+            raise ValueError('Cannot decrypt PGP data in-process')
+        if not data.startswith(self.BEGIN_MED):
+            self._buffer, self._done = data, self._eof
+            return
+
+        while '\r\n\r\n' not in data and '\n\n' not in data:
+            more = self._read_fd()
+            if not more:
+                raise ValueError('Truncated header')
+            data += more
+        if '\r\n\r\n' in data:
+            header, data = data.split('\r\n\r\n', 1)
+        else:
+            header, data = data.split('\n\n', 1)
+        headers = dict([l.split(': ', 1)
+                        for l in header.strip().splitlines()[1:]])
+        cipher = headers.get('cipher', self.DEFAULT_CIPHER)
+        passphrase = genkey(key, headers.get('nonce'))[:32].strip()
+
+        # The data begins with a magic marker and the 8 byte salt, which
+        # take up the first 24 characters of base64 (along with 2 bytes
+        # of actual ciphertext).
+        while len(''.join(data.split())) < 24 and not self._eof:
+            data += self._read_fd()
+        data = ''.join(data.split())
+        try:
+            salted = binascii.a2b_base64(data[:24])
+        except binascii.Error:
+            salted = ''
+        if not salted.startswith(self.SALT_MAGIC):
+            raise ValueError('Unsalted data')
+        self._evp = EVPCipher(cipher, passphrase, salted[8:16], False,
+                              md=headers.get('md'))
+        self._append(self._evp.update(salted[16:]))
+        self._b64 = data[24:]
+        self._decrypt('')
+
+    def _decrypt(self, data):
+        data = self._b64 + data
+        end = data.find('-')
+        if end >= 0 or self._eof:
+            # Anything after the base64 data is the END marker
+            data = ''.join(data[:end if (end >= 0) else None].split())
+            try:
+                out = self._evp.update(binascii.a2b_base64(data))
+                out += self._evp.final()
+            except (ValueError, binascii.Error):
+                self.error, out = True, ''
+            self._b64, self._done = '', True
+        else:
+            data = ''.join(data.split())
+            whole = len(data) - len(data) % 4
+            self._b64 = data[whole:]
+            out = self._evp.update(binascii.a2b_base64(data[:whole]))
+        self._append(out)
+
+    def _append(self, data):
+        if self._offset:
+            self._buffer = self._buffer[self._offset:] + data
+            self._offset = 0
+        else:
+            self._buffer += data
+
+    def _fill(self):
+        data = self._read_fd()
+        if self._evp is None:
+            self._append(data)
+            self._done = self._eof
+        else:
+            self._decrypt(data)
+
+    def _take(self, end):
+        data = self._buffer[self._offset:end]
+        self._offset += len(data)
+        self._pos += len(data)
+        return data
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            while not self._done:
+                self._fill()
+            return self._take(None)
+        while not self._done and len(self._buffer) - self._offset < size:
+            self._fill()
+        return self._take(self._offset + size)
+
+    def readline(self, size=-1):
+        while True:
+            eol = self._buffer.find('\n', self._offset)
+            if (eol >= 0 or self._done or
+                    (size >= 0 and len(self._buffer) - self._offset >= size)):
+                break
+            self._fill()
+        end = None if (eol < 0) else (eol + 1)
+        if size >= 0:
+            end = min(end or len(self._buffer), self._offset + size)
+        return self._take(end)
+
+    def readlines(self, sizehint=None):
+        return list(self)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        if self.fd is not None:
+            self.fd.close()
+            self.fd = None
+        return 1 if self.error else 0
+
+    def verify(self):
+        while self.fd is not None and not self._eof:
+            self._read_fd()
+        if self.close() != 0:
+            return False
+        if not self.expected_outer_md5sum:
+            return False
+        return (self.expected_outer_md5sum == self.outer_md5.hexdigest())
+
+
+def encrypting_streamer(key, dir=None, cipher=None):
+    """Return an EncryptingStreamer, working in-process if we can."""
+    if EVPCipher.Available():
+        return InlineEncryptingStreamer(key, dir=dir, cipher=cipher)
+    return EncryptingStreamer(key, dir=dir, cipher=cipher)
+
+
+def decrypting_streamer(key, fd, md5sum=None):
+    """
+    Return a file-like object which decrypts (or just reads) fd, working
+    in-process if we can. Anything but our own format, such as PGP data,
+    is handed to a DecryptingStreamer coprocess instead.
+    """
+    if EVPCipher.Available():
+        pos = fd.tell()
+        try:
+            return InlineDecryptingStreamer(key, fd, md5sum=md5sum)
+        except ValueError:
+            fd.seek(pos, 0)
+    return DecryptingStreamer(key, fd, md5sum=md5sum)
 
 
 if __name__ == "__main__":
@@ -409,6 +809,24 @@ if __name__ == "__main__":
      assert('Hello world!' == ds.read())
      assert(ds.verify())
 
+     if EVPCipher.Available():
+         # In-process decryption of openssl output
+         ds = decrypting_streamer('test key', open(fn, 'rb'),
+                                  md5sum=es.outer_md5sum)
+         assert(isinstance(ds, InlineDecryptingStreamer))
+         assert(ds.readline() == data.splitlines(True)[0])
+         assert(ds.read() == data.splitlines(True)[1])
+         assert(ds.verify())
+
+         # ...and openssl decryption of in-process output
+         es = encrypting_streamer('test key', dir='/tmp')
+         es.write(data * 100)
+         es.save(fn)
+         ds = DecryptingStreamer('test key', open(fn, 'rb'),
+                                 md5sum=es.outer_md5sum)
+         assert(data * 100 == ds.read())
+         assert(ds.verify())
+
      # Cleanup
      os.unlink('/tmp/iofilter.tmp')
      os.unlink(fn)
@@ -26,7 +26,18 @@ CONFIG_RULES = {
         'fd_cache_size':  (_('Max files kept open at once'), int,         500),
         'history_length': (_('History length (lines, <0=no save)'), int,  100),
         'http_port':      (_('Listening port for web UI'), int,         33411),
+        'imap_connections': (_('Max IMAP connections per account'), int, 2),
+        'index_html_kb':  (_('Max KB of each HTML part to index'), int,  256),
+        'message_cache':  (_('Rendered messages kept in memory'), int,  100),
         'postinglist_kb': (_('Posting list target size in KB'), int,       64),
+        'journal_flush_kb': (_('Update search index after this many KB'),
+                             int, 16384),
+        'journal_flush_secs': (_('Update search index at least this often'),
+                               int, 600),
+        'journal_flush_words': (_('Update search index at this many words'),
+                                int, 40 * 1024),
+        'scan_processes': (_('Processes used to parse mail (0=auto)'), int, 0),
+        'scan_queue':     (_('Messages queued between scan stages'), int, 100),
         'sort_max':       (_('Max results we sort "well"'), int,         2500),
         'snippet_max':    (_('Max length of metadata snippets'), int,     250),
         'debug':          (_('Debugging flags'), str,                      ''),
@@ -63,6 +74,10 @@ CONFIG_RULES = {
         'obfuscate_index': (_('Key to use to scramble the index'), str,    ''),
         'index_encrypted': (_('Make encrypted content searchable'),
                             bool, False),
+        'index_positions': (_('Record word positions for phrase search'),
+                            bool, False),
+        'index_relevance': (_('Record word counts for relevance sorting'),
+                            bool, False),
         'rescan_command':  (_('Command run before rescanning'), str,       ''),
         'default_email':   (_('Default outgoing e-mail address'), 'email', ''),
         'default_route':   (_('Default outgoing mail route'), str, ''),
@@ -8,12 +8,14 @@
 ## info required to locate this message and this message only within the
 ## larger mailbox.
 
+import threading
+from collections import OrderedDict
 from urllib import quote, unquote
 
 
 __all__ = ['mbox', 'maildir', 'gmvault', 'imap', 'macmail', 'wervd',
            'MBX_ID_LEN',
-           'NoSuchMailboxError', 'IsMailbox', 'OpenMailbox']
+           'NoSuchMailboxError', 'IsMailbox', 'OpenMailbox', 'MailboxCache']
 
 MAILBOX_CLASSES = []
 
@@ -53,10 +55,78 @@ def OpenMailbox(fn, config, create=False):
     raise ValueError('Not a mailbox: %s' % fn)
 
 
+class MailboxCache(object):
+    """
+    A least-recently-used cache of open mailbox objects. Each of these
+    keeps (at least) one file open, so the cache holds on to at most
+    max_open of them (if set); evicted mailboxes close their files once
+    nobody else is using them.
+    """
+
+    def __init__(self, max_open=None):
+        self.max_open = max_open
+        self.hits = self.misses = self.evictions = 0
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def __contains__(self, mbx_id):
+        return mbx_id in self._cache
+
+    def get(self, mbx_id):
+        self._lock.acquire()
+        try:
+            mbox = self._cache.pop(mbx_id, None)
+            if mbox is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._cache[mbx_id] = mbox
+            return mbox
+        finally:
+            self._lock.release()
+
+    def put(self, mbx_id, mbox):
+        self._lock.acquire()
+        try:
+            self._cache.pop(mbx_id, None)
+            self._cache[mbx_id] = mbox
+            while self.max_open and len(self._cache) > self.max_open:
+                self._cache.popitem(last=False)
+                self.evictions += 1
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._cache.clear()
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'open': len(self._cache),
+            'max_open': self.max_open,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': (float(self.hits) / lookups) if lookups else 0.0
+        }
+
+
 def UnorderedPicklable(parent, editable=False):
     """A factory for generating unordered, picklable mailbox classes."""
 
     class UnorderedPicklableMailbox(parent):
+        # Set if _refresh reports changes using _toc_updated, so the set of
+        # unparsed keys can be kept up to date instead of being recomputed.
+        INCREMENTAL_TOC = False
+        _unparsed = None
+
         def __init__(self, *args, **kwargs):
             parent.__init__(self, *args, **kwargs)
             self.editable = editable
@@ -65,10 +135,23 @@ def UnorderedPicklable(parent, editable=False):
             self.parsed = {}
 
         def unparsed(self):
-            return [i for i in self.keys() if i not in self.parsed]
+            if self.INCREMENTAL_TOC and self._unparsed is not None:
+                self._refresh()
+            else:
+                self._unparsed = set(i for i in self.keys()
+                                     if i not in self.parsed)
+            return sorted(self._unparsed)
 
         def mark_parsed(self, i):
             self.parsed[i] = True
+            if self._unparsed is not None:
+                self._unparsed.discard(i)
+
+        def _toc_updated(self, added, removed):
+            if self._unparsed is not None:
+                self._unparsed |= set(i for i in added
+                                      if i not in self.parsed)
+                self._unparsed -= set(removed)
 
         def __setstate__(self, data):
             self.__dict__.update(data)
@@ -102,6 +185,12 @@ def UnorderedPicklable(parent, editable=False):
         def get_file_by_ptr(self, msg_ptr):
             return self.get_file(unquote(msg_ptr[MBX_ID_LEN:]))
 
+        def verify_ptrs(self, msg_ptrs):
+            """Check many message pointers at once, returning {ptr: valid}."""
+            keys = set(self.iterkeys())
+            return dict((ptr, unquote(ptr[MBX_ID_LEN:]) in keys)
+                        for ptr in msg_ptrs)
+
         def get_msg_size(self, toc_id):
             fd = self.get_file(toc_id)
             fd.seek(0, 2)
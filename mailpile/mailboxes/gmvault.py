@@ -9,6 +9,7 @@ import mailpile.mailboxes.maildir as maildir
 
 class MailpileMailbox(maildir.MailpileMailbox):
     """A Gmvault class that supports pickling and a few mailpile specifics."""
+    INCREMENTAL_TOC = False
 
     @classmethod
     def parse_path(cls, config, fn, create=False):
@@ -3,137 +3,617 @@ try:
 except ImportError:
     import StringIO
 
+import bisect
+import os
+import re
+import socket
+import threading
+import time
 from imaplib import IMAP4, IMAP4_SSL
 from mailbox import Mailbox, Message
+from urllib import unquote
 
 import mailpile.mailboxes
+from mailpile.crypto.streamer import encrypting_streamer, decrypting_streamer
 from mailpile.mailboxes import UnorderedPicklable
+from mailpile.util import md5_hex
+
+
+class IMAPError(IOError):
+    pass
+
+
+def _quoted(mailbox):
+    return '"%s"' % mailbox.replace('\\', '\\\\').replace('"', '\\"')
+
+
+class IMAPConnection(object):
+    """
+    A logged-in IMAP connection, as handed out by the IMAPConnectionPool.
+
+    It remembers which folder is selected and how many messages it has
+    (following the untagged EXISTS and EXPUNGE responses), so switching
+    back and forth between folders is the only thing that costs a SELECT.
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        self.key = None
+        self.selected = None
+        self.exists = None
+        self.last_used = time.time()
+
+    def _track_exists(self):
+        # imaplib collects untagged responses until somebody asks for them.
+        typ, expunged = self.conn.response('EXPUNGE')
+        typ, exists = self.conn.response('EXISTS')
+        if self.selected is None:
+            return
+        if exists and exists[-1] is not None:
+            self.exists = int(exists[-1])
+        elif expunged and expunged[0] is not None:
+            self.exists -= len(expunged)
+
+    def select(self, mailbox, force=False):
+        """Select a folder (unless it already is) and return EXISTS."""
+        if force or self.selected != mailbox:
+            self.selected = None
+            typ, data = self.conn.select(_quoted(mailbox))
+            if typ != 'OK':
+                raise IMAPError('SELECT %s failed: %s' % (mailbox, data))
+            self.selected, self.exists = mailbox, int(data[0])
+        return self.exists
+
+    def status(self, mailbox, items=('MESSAGES', 'UIDNEXT', 'UIDVALIDITY')):
+        """Return a dict of STATUS items for a folder."""
+        typ, data = self.conn.status(_quoted(mailbox),
+                                     '(%s)' % ' '.join(items))
+        if typ != 'OK':
+            raise IMAPError('STATUS %s failed: %s' % (mailbox, data))
+        values = data[0][data[0].rindex('(') + 1:].rstrip(')').split()
+        return dict((values[i].upper(), values[i + 1])
+                    for i in range(0, len(values) - 1, 2))
+
+    def noop(self):
+        typ, data = self.conn.noop()
+        if typ != 'OK':
+            raise IMAPError('NOOP failed: %s' % data)
+        self._track_exists()
+
+    def uid(self, command, *args):
+        typ, data = self.conn.uid(command, *args)
+        if typ != 'OK':
+            raise IMAPError('UID %s failed: %s' % (command, data))
+        self._track_exists()
+        return data
+
+    def close(self):
+        try:
+            self.conn.logout()
+        except (IMAP4.error, socket.error, IOError):
+            pass
+
+
+class IMAPConnectionPool(object):
+    """
+    A pool of logged-in IMAP connections, shared by all the IMAP mailboxes
+    on the same account, so opening another folder (or reopening one) does
+    not mean another TCP and TLS handshake and LOGIN.
+
+    At most max_connections are made to each account (servers tend to
+    limit this); if they are all busy, callers wait for one to be returned.
+    Connections which have been idle for a while are checked with a NOOP
+    before being reused, and ones idle for very long are dropped, as the
+    server will have timed them out anyway.
+    """
+    KEEPALIVE = 60
+    MAX_IDLE = 20 * 60
+
+    def __init__(self, max_connections=2):
+        self.max_connections = max_connections
+        self._lock = threading.Condition()
+        self._idle = {}
+        self._count = {}
+        self.connects = 0
+
+    def _connect(self, host, port, user, password, use_ssl):
+        if use_ssl:
+            conn = IMAP4_SSL(host, port)
+        else:
+            conn = IMAP4(host, port)
+        try:
+            typ, data = conn.login(user, password)
+        except IMAP4.error, e:
+            raise IMAPError('LOGIN %s@%s failed: %s' % (user, host, e))
+        self.connects += 1
+        return IMAPConnection(conn)
+
+    def _checkout(self, key, mailbox):
+        self._lock.acquire()
+        try:
+            while True:
+                idle = self._idle.get(key)
+                if idle:
+                    # Prefer a connection that already has our folder open
+                    same = [c for c in idle if c.selected == mailbox]
+                    conn = (same or idle)[-1]
+                    idle.remove(conn)
+                    return conn
+                if self._count.get(key, 0) < max(1, self.max_connections):
+                    self._count[key] = self._count.get(key, 0) + 1
+                    return None
+                self._lock.wait()
+        finally:
+            self._lock.release()
+
+    def _checkin(self, key, conn, reuse):
+        self._lock.acquire()
+        try:
+            if reuse:
+                conn.last_used = time.time()
+                self._idle.setdefault(key, []).append(conn)
+            else:
+                self._count[key] -= 1
+            self._lock.notify()
+        finally:
+            self._lock.release()
+        if conn and not reuse:
+            conn.close()
+
+    def get(self, host, port, user, password, use_ssl=True, mailbox=None):
+        """
+        Check out a connection to (host, port, user); it must be handed
+        back using release(). Prefers one with the mailbox selected.
+        """
+        key = (host, port, user, use_ssl)
+        conn = self._checkout(key, mailbox)
+        try:
+            idle = conn and (time.time() - conn.last_used)
+            if conn and idle > self.MAX_IDLE:
+                conn.close()
+                conn = None
+            elif conn and idle > self.KEEPALIVE:
+                try:
+                    conn.noop()
+                except (IMAP4.error, socket.error, IOError):
+                    conn.close()
+                    conn = None
+            if conn is None:
+                conn = self._connect(host, port, user, password, use_ssl)
+            conn.key = key
+            return conn
+        except:
+            self._checkin(key, None, False)
+            raise
+
+    def release(self, conn, error=None):
+        """
+        Return a connection to the pool. Connections which saw anything
+        other than an IMAP NO or BAD response are dropped, they may no
+        longer be in a usable state.
+        """
+        self._checkin(conn.key, conn, (error is None or
+                                       isinstance(error, IMAPError) or
+                                       not isinstance(error, (IMAP4.error,
+                                                              socket.error,
+                                                              IOError))))
+
+    def keepalive(self):
+        """NOOP connections which have been idle for a while."""
+        self._lock.acquire()
+        try:
+            now = time.time()
+            stale = []
+            for key, idle in self._idle.iteritems():
+                stale.extend((key, c) for c in idle
+                             if now - c.last_used > self.KEEPALIVE)
+                idle[:] = [c for c in idle
+                           if now - c.last_used <= self.KEEPALIVE]
+        finally:
+            self._lock.release()
+        for key, conn in stale:
+            try:
+                if time.time() - conn.last_used > self.MAX_IDLE:
+                    raise IMAPError('Idle for too long')
+                conn.noop()
+                self._checkin(key, conn, True)
+            except (IMAP4.error, socket.error, IOError):
+                self._checkin(key, conn, False)
+
+    def close(self):
+        """Log out all idle connections."""
+        self._lock.acquire()
+        try:
+            idle, self._idle = self._idle, {}
+            for key, conns in idle.iteritems():
+                self._count[key] -= len(conns)
+        finally:
+            self._lock.release()
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+
+POOL = IMAPConnectionPool()
 
 
 class IMAPMailbox(Mailbox):
     """
-    Basic implementation of IMAP Mailbox. Needs a lot of work.
+    An IMAP folder, keyed by message UID.
 
-    As of now only get_* is implemented.
+    The table of contents maps UIDs to message sizes and is synced
+    incrementally: as long as the UIDVALIDITY stays the same, only messages
+    with UIDs above the last UIDNEXT are fetched (and the whole folder is
+    only searched if messages have been expunged). Sizes come from batched
+    UID FETCHes, message bodies are only downloaded when asked for, and
+    are kept in an on-disk cache if a cache directory is given.
+
+    When messages are read in order, as during a scan, the following
+    messages are fetched in the same round-trip.
+
+    Connections come from the shared POOL, so folders on the same account
+    share logins, and a folder which is still selected is checked for
+    changes with a NOOP. Other folders are checked using STATUS, and only
+    selected if something has changed.
     """
+    FETCH_BATCH = 500
+    READAHEAD = 25
+    REFRESH_INTERVAL = 5
+
     def __init__(self, host,
                  port=993, user=None, password=None, mailbox=None,
-                 use_ssl=True, factory=None):
+                 use_ssl=True, factory=None, cache_dir=None):
         """Initialize a Mailbox instance."""
-        if use_ssl:
-            self._mailbox = IMAP4_SSL(host, port)
-        else:
-            self._mailbox = IMAP4(host, port)
-        self._mailbox.login(user, password)
-        if not mailbox:
-            mailbox = "INBOX"
-        self.mailbox = mailbox
-        self._mailbox.select(mailbox)
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.use_ssl = use_ssl
+        self.mailbox = mailbox or 'INBOX'
         self._factory = factory
+        self._cache_dir = cache_dir
+        self._uidvalidity = None
+        self._uidnext = 1
+        self._toc = {}
+        self._uids = []
+        self._last_refresh = 0
+        self._last_key = None
+        self._prefetched = {}
+        self._encryption_key_func = lambda: None
+        self._refresh(force=True)
+
+    ##[ Talking to the server ]##############################################
+
+    def _with_connection(self, func, retry=True):
+        """
+        Call func with a pooled connection. If the connection turns out
+        to have been dropped (servers do time them out), retry once.
+        """
+        conn = POOL.get(self.host, self.port, self.user, self.password,
+                        self.use_ssl, self.mailbox)
+        try:
+            result = func(conn)
+        except Exception, e:
+            POOL.release(conn, error=e)
+            if retry and isinstance(e, (IMAP4.abort, socket.error)):
+                return self._with_connection(func, retry=False)
+            raise
+        POOL.release(conn)
+        return result
+
+    RE_UID = re.compile(r'\bUID (\d+)')
+    RE_SIZE = re.compile(r'\bRFC822\.SIZE (\d+)')
+
+    @classmethod
+    def _parse_fetch(cls, data):
+        """
+        Turn the (rather messy) imaplib FETCH results into a list of
+        (uid, size, literal) tuples.
+
+        >>> IMAPMailbox._parse_fetch([
+        ...     '1 (UID 5 RFC822.SIZE 12)',
+        ...     ('2 (RFC822.SIZE 3 BODY[] {3}', 'Hi!'), ' UID 7)'])
+        [('5', 12, None), ('7', 3, 'Hi!')]
+        """
+        results = []
+        for item in data:
+            if item is None:
+                continue
+            if isinstance(item, tuple):
+                results.append([item[0], item[1]])
+            elif results and (item.startswith(')') or item.startswith(' ')):
+                # The rest of the previous response, after a literal.
+                results[-1][0] += item
+            else:
+                results.append([item, None])
+        parsed = []
+        for text, literal in results:
+            uid = cls.RE_UID.search(text)
+            size = cls.RE_SIZE.search(text)
+            if uid:
+                parsed.append((uid.group(1),
+                               int(size.group(1)) if size else None,
+                               literal))
+        return parsed
+
+    ##[ Table of contents ]##################################################
+
+    def _refresh(self, force=False):
+        if not force and (time.time() - self._last_refresh <
+                          self.REFRESH_INTERVAL):
+            return
+        self._with_connection(self._sync_toc)
+        self._uids = sorted(int(k) for k in self._toc)
+        self._last_refresh = time.time()
+
+    def _sync_toc(self, conn):
+        if conn.selected == self.mailbox and self._uidvalidity:
+            # The folder is already open, any changes are reported to us
+            # in reply to a NOOP. New UIDs are found below.
+            conn.noop()
+            exists = conn.exists
+            uidvalidity, uidnext = self._uidvalidity, None
+        else:
+            # Checking the STATUS avoids a SELECT if nothing has changed.
+            status = conn.status(self.mailbox)
+            exists = int(status['MESSAGES'])
+            uidvalidity = status.get('UIDVALIDITY')
+            uidnext = status.get('UIDNEXT')
+            if (uidvalidity == self._uidvalidity and
+                    uidnext is not None and int(uidnext) == self._uidnext and
+                    exists == len(self._toc)):
+                return
+            exists = conn.select(self.mailbox)
+
+        if uidvalidity != self._uidvalidity:
+            # All the UIDs we know have become meaningless.
+            self._uidvalidity = uidvalidity
+            self._uidnext = 1
+            self._toc = {}
+            self._prefetched = {}
+
+        if uidnext is None or int(uidnext) > self._uidnext:
+            new_uid = self._uidnext
+            for uid, size, literal in self._parse_fetch(conn.uid(
+                    'FETCH', '%d:*' % self._uidnext,
+                    '(UID RFC822.SIZE)')):
+                # Note: 'n:*' always matches the last message, even if
+                # its UID is lower than n.
+                if int(uid) >= self._uidnext:
+                    self._toc[uid] = size
+                    new_uid = max(new_uid, int(uid) + 1)
+            self._uidnext = int(uidnext) if uidnext else new_uid
+
+        if exists != len(self._toc):
+            # Something was expunged, find out what.
+            data = conn.uid('SEARCH', None, 'ALL')
+            uids = set((data[0] or '').split())
+            conn.exists = len(uids)
+            for uid in [u for u in self._toc if u not in uids]:
+                del self._toc[uid]
+            for uid in [u for u in uids if u not in self._toc]:
+                self._toc[uid] = None
+            self._fetch_sizes(conn, [u for u, s in self._toc.iteritems()
+                                     if s is None])
+
+    def _fetch_sizes(self, conn, uids):
+        conn.select(self.mailbox)
+        for i in range(0, len(uids), self.FETCH_BATCH):
+            batch = ','.join(uids[i:i + self.FETCH_BATCH])
+            for uid, size, literal in self._parse_fetch(conn.uid(
+                    'FETCH', batch, '(UID RFC822.SIZE)')):
+                self._toc[uid] = size
+
+    def _sorted_keys(self):
+        return [str(uid) for uid in self._uids]
+
+    ##[ Message bodies ]#####################################################
+
+    def _cache_path(self, key):
+        if self._cache_dir:
+            return os.path.join(self._cache_dir,
+                                '%s-%s' % (self._uidvalidity, key))
+        return None
+
+    def _cache_get(self, key):
+        path = self._cache_path(key)
+        if not (path and os.path.exists(path)):
+            return None
+        with open(path, 'rb') as fd:
+            enc_key = self._encryption_key_func()
+            if enc_key:
+                with decrypting_streamer(enc_key, fd) as streamer:
+                    return streamer.read()
+            return fd.read()
+
+    def _cache_put(self, key, data):
+        path = self._cache_path(key)
+        if not path:
+            return
+        if not os.path.exists(self._cache_dir):
+            os.makedirs(self._cache_dir)
+        enc_key = self._encryption_key_func()
+        if enc_key:
+            fd = encrypting_streamer(enc_key, dir=self._cache_dir)
+            try:
+                fd.write(data)
+                fd.save(path)
+            finally:
+                fd.close()
+        else:
+            with open(path + '.tmp', 'wb') as fd:
+                fd.write(data)
+            os.rename(path + '.tmp', path)
+
+    def _readahead_keys(self, key):
+        # Only read ahead if messages are being read in order.
+        if self._last_key is None:
+            return []
+        pos = bisect.bisect_left(self._uids, int(key))
+        if pos == 0 or self._uids[pos - 1] != int(self._last_key):
+            return []
+        keys = [str(uid) for uid in self._uids[pos + 1:
+                                               pos + 1 + self.READAHEAD]]
+        return [k for k in keys
+                if k not in self._prefetched and
+                not (self._cache_dir and os.path.exists(self._cache_path(k)))]
+
+    def _get(self, key):
+        if key not in self._toc:
+            self._refresh()
+            if key not in self._toc:
+                raise KeyError(key)
+        try:
+            data = self._prefetched.pop(key, None) or self._cache_get(key)
+            if data is not None:
+                return data
+
+            def fetch(conn):
+                conn.select(self.mailbox)
+                return self._parse_fetch(conn.uid(
+                    'FETCH', ','.join(keys), '(UID BODY.PEEK[])'))
+
+            fetched = {}
+            keys = [key] + self._readahead_keys(key)
+            for uid, size, literal in self._with_connection(fetch):
+                if literal is not None:
+                    fetched[uid] = literal
+                    self._cache_put(uid, literal)
+            if key not in fetched:
+                raise KeyError(key)
+            data = fetched.pop(key)
+            if not self._cache_dir:
+                self._prefetched = fetched
+            return data
+        finally:
+            self._last_key = key
+
+    ##[ The Mailbox API ]####################################################
 
     def add(self, message):
         """Add message and return assigned key."""
         # TODO(halldor): not tested...
-        self._mailbox.append(self.mailbox, message=message)
+        self._with_connection(lambda conn: conn.conn.append(
+            _quoted(self.mailbox), None, None, message))
 
     def remove(self, key):
         """Remove the keyed message; raise KeyError if it doesn't exist."""
         # TODO(halldor): not tested...
-        self._mailbox.store(key, "+FLAGS", r"\Deleted")
+        def store(conn):
+            conn.select(self.mailbox)
+            conn.uid('STORE', key, '+FLAGS', r'(\Deleted)')
+        self._with_connection(store)
 
     def __setitem__(self, key, message):
         """Replace the keyed message; raise KeyError if it doesn't exist."""
         raise NotImplementedError('Method must be implemented by subclass')
 
-    def _get(self, key):
-        typ, data = self._mailbox.fetch(key, '(RFC822)')
-        response = data[0]
-        if typ != "OK" or response is None:
-            raise KeyError
-        return response[1]
-
     def get_message(self, key):
         """Return a Message representation or raise a KeyError."""
         return Message(self._get(key))
 
     def get_bytes(self, key):
         """Return a byte string representation or raise a KeyError."""
-        raise NotImplementedError('Method must be implemented by subclass')
+        return self._get(key)
+
+    get_string = get_bytes
 
     def get_file(self, key):
         """Return a file-like representation or raise a KeyError."""
-        message = self._get(key)
-        fd = StringIO.StringIO()
-        fd.write(message)
-        fd.seek(0)
-        return fd
+        return StringIO.StringIO(self._get(key))
+
+    def get_msg_size(self, key):
+        if self._toc.get(key) is None:
+            self._with_connection(lambda conn: self._fetch_sizes(conn, [key]))
+        return self._toc[key]
 
     def iterkeys(self):
         """Return an iterator over keys."""
-        typ, data = self._mailbox.search(None, "ALL")
-        return data[0].split()
+        self._refresh()
+        return iter(self._sorted_keys())
 
     def __contains__(self, key):
         """Return True if the keyed message exists, False otherwise."""
-        typ, data = self._mailbox.fetch(key, '(RFC822)')
-        response = data[0]
-        if response is None:
-            return False
-        return True
+        self._refresh()
+        return key in self._toc
 
     def __len__(self):
         """Return a count of messages in the mailbox."""
-        return len(self.iterkeys())
+        self._refresh()
+        return len(self._toc)
 
     def flush(self):
         """Write any pending changes to the disk."""
-        raise NotImplementedError('Method must be implemented by subclass')
+        pass
 
     def lock(self):
         """Lock the mailbox."""
-        raise NotImplementedError('Method must be implemented by subclass')
+        pass
 
     def unlock(self):
         """Unlock the mailbox if it is locked."""
-        raise NotImplementedError('Method must be implemented by subclass')
+        pass
 
     def close(self):
         """Flush and close the mailbox."""
-        self._mailbox.close()
-        self._mailbox.logout()
+        # The connections belong to the pool, which keeps them open.
+        pass
 
     # Whether each message must end in a newline
     _append_newline = False
 
 
-class MailpileMailbox(UnorderedPicklable(IMAPMailbox)):
+_IMAPBase = UnorderedPicklable(IMAPMailbox)
+
+
+class MailpileMailbox(_IMAPBase):
     @classmethod
     def parse_path(cls, config, path, create=False):
         if path.startswith("imap://"):
             url = path[7:]
             try:
-                serverpart, mailbox = url.split("/")
+                serverpart, mailbox = url.split("/", 1)
             except ValueError:
                 serverpart = url
                 mailbox = None
-            userpart, server = serverpart.split("@")
-            user, password = userpart.split(":")
+            userpart, server = serverpart.rsplit("@", 1)
+            user, password = userpart.split(":", 1)
+            if ':' in server:
+                server, port = server.split(':', 1)
+                port = int(port)
+            else:
+                port = 993
+            cache_dir = os.path.join(config.workdir, 'cache', 'imap',
+                                     md5_hex(path)[:16])
             # WARNING: Order must match IMAPMailbox.__init__(...)
-            return (server, 993, user, password)
+            return (server, port, unquote(user), unquote(password),
+                    mailbox and unquote(mailbox), True, None, cache_dir)
         raise ValueError('Not an IMAP url: %s' % path)
 
     def __getstate__(self):
         odict = self.__dict__.copy()
-        # Pickle can't handle file and function objects.
-        del odict['_mailbox']
-        del odict['_save_to']
+        # Pickle can't handle function objects.
+        for dk in ('_prefetched', '_save_to', '_encryption_key_func'):
+            odict.pop(dk, None)
         return odict
 
+    def __setstate__(self, data):
+        data.update({
+            '_prefetched': {},
+            '_last_refresh': 0})
+        _IMAPBase.__setstate__(self, data)
+
     def get_msg_size(self, toc_id):
-        # FIXME: We should make this less horrible.
-        fd = self.get_file(toc_id)
-        fd.seek(0, 2)
-        return fd.tell()
+        # We know the sizes, no need to download anything.
+        return IMAPMailbox.get_msg_size(self, toc_id)
 
 
 mailpile.mailboxes.register(10, MailpileMailbox)
+
+
+if __name__ == "__main__":
+    import doctest
+    import sys
+    results = doctest.testmod(optionflags=doctest.ELLIPSIS)
+    print '%s' % (results, )
+    if results.failed:
+        sys.exit(1)
@@ -141,6 +141,10 @@ class MacMaildir(mailbox.Mailbox):
 
 class MailpileMailbox(UnorderedPicklable(MacMaildir)):
     """A Mac Mail.app maildir class that supports pickling etc."""
+
+    # Unpickled copies can safely read messages in other processes
+    PARALLEL_SCAN = True
+
     @classmethod
     def parse_path(cls, config, fn, create=False):
         if (os.path.isdir(fn)
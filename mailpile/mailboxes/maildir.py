@@ -1,13 +1,47 @@
 import mailbox
 import os
+import time
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 import mailpile.mailboxes
 from mailpile.mailboxes import UnorderedPicklable
 
 
-class MailpileMailbox(UnorderedPicklable(mailbox.Maildir, editable=True)):
-    """A Maildir class that supports pickling and a few mailpile specifics."""
+def ListMaildir(path):
+    """
+    List the files in a Maildir subdirectory, avoiding a stat() per file
+    where possible: scandir gets the file types from the directory itself,
+    and without it we rely on a directory's link count being 2 plus the
+    number of subdirectories (on filesystems where that holds).
+    """
+    if scandir is not None:
+        return [e.name for e in scandir(path) if not e.is_dir()]
+    names = os.listdir(path)
+    if os.stat(path).st_nlink == 2:
+        return names
+    return [n for n in names if not os.path.isdir(os.path.join(path, n))]
+
+
+_MaildirBase = UnorderedPicklable(mailbox.Maildir, editable=True)
+
+
+class MailpileMailbox(_MaildirBase):
+    """
+    A Maildir class that supports pickling and a few mailpile specifics.
+
+    The table of contents is kept per subdirectory (cur, new), and only
+    subdirectories whose mtime has changed get listed again. Changes are
+    reported to the parent class, which keeps the set of unparsed keys.
+    """
     supported_platform = None
+    INCREMENTAL_TOC = True
 
     @classmethod
     def parse_path(cls, config, fn, create=False):
@@ -19,11 +53,69 @@ class MailpileMailbox(UnorderedPicklable(mailbox.Maildir, editable=True)):
             return (fn, )
         raise ValueError('Not a Maildir: %s' % fn)
 
-    def _refresh(self):
-        mailbox.Maildir._refresh(self)
+    def __getstate__(self):
+        odict = _MaildirBase.__getstate__(self)
+        # The full TOC can be rebuilt from the per-subdirectory ones
+        if '_subdir_tocs' in odict:
+            del odict['_toc']
+        return odict
+
+    def __setstate__(self, data):
+        if '_subdir_tocs' in data:
+            data['_toc'] = {}
+            for subdir_toc in data['_subdir_tocs'].values():
+                data['_toc'].update(subdir_toc)
+        _MaildirBase.__setstate__(self, data)
+
+    def _is_mail(self, key):
         # Dotfiles are not mail. Ignore them.
-        for t in [k for k in self._toc.keys() if k.startswith('.')]:
-            del self._toc[t]
+        return not key.startswith('.')
+
+    def _refresh(self):
+        if not hasattr(self, '_subdir_tocs'):
+            self._subdir_tocs = {}
+            self._toc = {}
+
+        # As in mailbox.Maildir, we re-read everything if the last read was
+        # so recent that the mtime might not have changed yet.
+        recent = (time.time() - self._last_read <= 2 + self._skewfactor)
+
+        added, removed = [], []
+        for subdir in self._toc_mtimes:
+            path = self._paths[subdir]
+            mtime = os.path.getmtime(path)
+            if (not recent and subdir in self._subdir_tocs and
+                    mtime <= self._toc_mtimes[subdir]):
+                continue
+            self._toc_mtimes[subdir] = mtime
+
+            old_toc = self._subdir_tocs.get(subdir, {})
+            new_toc = {}
+            for entry in ListMaildir(path):
+                key = entry.split(self.colon)[0]
+                if self._is_mail(key):
+                    new_toc[key] = os.path.join(subdir, entry)
+            self._subdir_tocs[subdir] = new_toc
+
+            for key in old_toc:
+                if key not in new_toc:
+                    removed.append(key)
+                    self._toc.pop(key, None)
+            for key, fn in new_toc.iteritems():
+                if key not in old_toc:
+                    added.append(key)
+                self._toc[key] = fn
+
+        if added or removed:
+            # Messages moving from new/ to cur/ show up in both lists
+            moved = set(added) & set(removed)
+            for key in moved:
+                for subdir_toc in self._subdir_tocs.values():
+                    if key in subdir_toc:
+                        self._toc[key] = subdir_toc[key]
+            self._toc_updated([k for k in added if k not in moved],
+                              [k for k in removed if k not in moved])
+        self._last_read = time.time()
 
 
 mailpile.mailboxes.register(25, MailpileMailbox)
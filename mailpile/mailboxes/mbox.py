@@ -1,14 +1,100 @@
+import array
+import cPickle
 import mailbox
+import mmap
 import os
+import struct
 import threading
+import types
+from gettext import gettext as _
 
 import mailpile.mailboxes
 from mailpile.mailboxes import MBX_ID_LEN, NoSuchMailboxError
 from mailpile.util import *
 
 
+class MappedFile(object):
+    r"""
+    A read-only file-like object for a slice of a memory mapped mailbox.
+    The slice is a buffer, so no data is copied until it is read.
+
+    >>> mf = MappedFile('From me\nSubject: hi\n\nHello!\n', 8, 28)
+    >>> mf.readline()
+    'Subject: hi\n'
+    >>> mf.tell()
+    12
+    >>> mf.read()
+    '\nHello!\n'
+    >>> mf.seek(0, 2)
+    >>> mf.tell()
+    20
+    """
+
+    def __init__(self, data, start, stop):
+        self._buf = buffer(data, start, max(0, stop - start))
+        self._pos = 0
+        self.closed = False
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            end = len(self._buf)
+        else:
+            end = min(len(self._buf), self._pos + size)
+        data = self._buf[self._pos:end]
+        self._pos = max(self._pos, end)
+        return data
+
+    def readline(self, size=-1):
+        end = len(self._buf)
+        if size is not None and size >= 0:
+            end = min(end, self._pos + size)
+        data = self._buf[self._pos:end]
+        eol = data.find('\n')
+        if eol >= 0:
+            data = data[:eol + 1]
+        self._pos += len(data)
+        return data
+
+    def readlines(self, sizehint=None):
+        return list(iter(self.readline, ''))
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += len(self._buf)
+        self._pos = max(0, offset)
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        self.closed = True
+        self._buf = ''
+
+
 class MailpileMailbox(mailbox.mbox):
-    """A mbox class that supports pickling and a few mailpile specifics."""
+    """
+    A mbox class that supports pickling and a few mailpile specifics.
+
+    Reading is done using a read-only memory map of the file, which is
+    used to find the From_ lines when building the table of contents and
+    to hand out messages (see MappedFile) without seeking or locking the
+    shared file object. The map is recreated whenever the file changes
+    size. Writing still goes through the standard mailbox.mbox code.
+    """
+
+    # Unpickled copies can safely read messages in other processes
+    PARALLEL_SCAN = True
+
+    # The TOC cache stores offsets as native longs, so the magic records
+    # their size; caches from a different platform are just ignored.
+    TOC_MAGIC = 'MPTOC1%d' % array.array('l').itemsize
+    TOC_MAX_CHUNKS = 64
+    CS_CACHE_SIZE = 10000
 
     @classmethod
     def parse_path(cls, config, fn, create=False):
@@ -29,12 +115,21 @@ class MailpileMailbox(mailbox.mbox):
         self._save_to = None
         self._encryption_key_func = lambda: None
         self._lock = threading.Lock()
+        self._map = None
+        self._map_file = None
+        self._toc_saved = 0
+        self._toc_chunks = 0
+        self._cs_cache = {}
+        self._cs_generation = None
 
     def __getstate__(self):
         odict = self.__dict__.copy()
         # Pickle can't handle file objects.
         del odict['_file']
         del odict['_lock']
+        odict.pop('_map', None)
+        odict.pop('_map_file', None)
+        odict.pop('_cs_cache', None)
         del odict['_save_to']
         del odict['_encryption_key_func']
         return odict
@@ -45,6 +140,12 @@ class MailpileMailbox(mailbox.mbox):
     def __setstate__(self, dict):
         self.__dict__.update(dict)
         self._lock = threading.Lock()
+        self._map = None
+        self._map_file = None
+        self.__dict__.setdefault('_toc_saved', 0)
+        self.__dict__.setdefault('_toc_chunks', 0)
+        self._cs_cache = {}
+        self._cs_generation = None
         self._lock.acquire()
         self._save_to = None
         self._encryption_key_func = lambda: None
@@ -89,32 +190,30 @@ class MailpileMailbox(mailbox.mbox):
                     del self._toc[i]
                     break
 
-            fd = self._file
-            self._file.seek(0, 2)
-            if self._file_length == fd.tell():
+            data = self._get_map(locked=True)
+            if self._file_length == len(data):
                 return
 
-            fd.seek(self._toc[self._next_key-1][0])
-            line = fd.readline()
-            if not line.startswith('From '):
+            last = self._toc[self._next_key-1][0]
+            if data[last:last+5] != 'From ':
                 raise IOError(_("Mailbox has been modified"))
 
-            fd.seek(self._file_length-len(os.linesep))
             start = None
+            pos = self._file_length - len(os.linesep)
             while True:
-                line_pos = fd.tell()
-                line = fd.readline()
-                if line.startswith('From '):
-                    if start:
-                        self._toc[self._next_key] = (
-                            start, line_pos - len(os.linesep))
+                line_pos = self._find_from(data, pos)
+                if line_pos < 0:
+                    if start is not None:
+                        self._toc[self._next_key] = (start, len(data))
                         self._next_key += 1
-                    start = line_pos
-                elif line == '':
-                    self._toc[self._next_key] = (start, line_pos)
-                    self._next_key += 1
                     break
-            self._file_length = fd.tell()
+                if start is not None:
+                    self._toc[self._next_key] = (
+                        start, line_pos - len(os.linesep))
+                    self._next_key += 1
+                start = line_pos
+                pos = line_pos + 1
+            self._file_length = len(data)
         finally:
             self._lock.release()
         self.save(None)
@@ -132,20 +231,175 @@ class MailpileMailbox(mailbox.mbox):
             finally:
                 self._lock.release()
 
+    def get_toc_chunk(self, full=False):
+        """
+        Return the table of contents as a compact binary chunk, covering
+        only the entries added since the last call unless full is set or
+        too many chunks have been written. Returns (full, chunk); chunks
+        can be appended to a full one and loaded with FromTocCache.
+
+        This is called by save(), which already holds the lock.
+        """
+        if (full or not self._toc_saved or
+                self._toc_chunks >= self.TOC_MAX_CHUNKS):
+            first, self._toc_chunks = 0, 0
+        else:
+            # Back up a little, update_toc may have redone these.
+            first = max(0, min(self._toc_saved, self._next_key) - 2)
+        offsets = array.array('l')
+        for key in xrange(first, self._next_key):
+            start, stop = self._toc.get(key, (None, None))
+            offsets.append(-1 if (start is None) else start)
+            offsets.append(-1 if (stop is None) else stop)
+
+        state = self.__getstate__()
+        for key in ('_toc', '_toc_saved', '_toc_chunks'):
+            state.pop(key, None)
+        state = cPickle.dumps((self.__class__, state), protocol=2)
+
+        self._toc_saved = self._next_key
+        self._toc_chunks += 1
+        return (first == 0, ''.join([
+            self.TOC_MAGIC,
+            struct.pack('<III', first, len(offsets) // 2, len(state)),
+            state,
+            offsets.tostring()]))
+
+    @classmethod
+    def FromTocCache(cls, data):
+        """
+        Recreate a mailbox from one or more TOC chunks, as returned by
+        get_toc_chunk. A truncated final chunk (from an interrupted save)
+        is ignored and forces a full save next time.
+        """
+        toc, mbx_cls, state, chunks = {}, None, None, 0
+        header = len(cls.TOC_MAGIC) + struct.calcsize('<III')
+        pos = 0
+        while pos < len(data):
+            if data[pos:pos + len(cls.TOC_MAGIC)] != cls.TOC_MAGIC:
+                raise ValueError(_('Invalid TOC cache'))
+            first, count, state_len = struct.unpack(
+                '<III', data[pos + len(cls.TOC_MAGIC):pos + header])
+            offsets = array.array('l')
+            end = pos + header + state_len + 2 * count * offsets.itemsize
+            if end > len(data):
+                chunks = cls.TOC_MAX_CHUNKS
+                break
+            mbx_cls, state = cPickle.loads(
+                data[pos + header:pos + header + state_len])
+            offsets.fromstring(data[pos + header + state_len:end])
+            if -1 in offsets:
+                offsets = [(None if (o < 0) else o) for o in offsets]
+            toc.update(zip(xrange(first, first + count),
+                           zip(offsets[0::2], offsets[1::2])))
+            chunks += 1
+            pos = end
+
+        if state is None or not issubclass(mbx_cls, cls):
+            raise ValueError(_('Invalid TOC cache'))
+        if len(toc) > state['_next_key']:
+            for key in [k for k in toc if k >= state['_next_key']]:
+                del toc[key]
+
+        state.update({
+            '_toc': toc,
+            '_toc_saved': state['_next_key'],
+            '_toc_chunks': chunks})
+        # Like unpickling: mailbox.mbox is an old-style class, so this
+        # makes an instance without calling __init__.
+        mbox = types.InstanceType(mbx_cls)
+        mbox.__setstate__(state)
+        return mbox
+
+    def flush(self):
+        mailbox.mbox.flush(self)
+        # Rewriting the file moves everything, so cached offsets are stale.
+        self._toc_saved = 0
+
+    def _get_map(self, locked=False):
+        """
+        Return a read-only memory map of the whole file, remapping if the
+        file has been replaced or changed size since last time. Empty files
+        are mapped to an empty string, as mmap can't handle them.
+
+        Note: if another program truncates the file while we are reading
+        from the map, we will get a SIGBUS instead of a short read. Mail
+        clients only ever append to or rewrite (replace) mailboxes, so in
+        practice this is no worse than reading stale offsets.
+        """
+        if not locked:
+            self._lock.acquire()
+        try:
+            self._file.flush()
+            st = os.fstat(self._file.fileno())
+            size = st.st_size
+            if (size, st.st_mtime) != self._cs_generation:
+                # The file has changed, forget which pointers were valid
+                self._cs_cache = {}
+                self._cs_generation = (size, st.st_mtime)
+            if (self._map is None or len(self._map) != size or
+                    self._map_file is not self._file):
+                if size > 0:
+                    self._map = mmap.mmap(self._file.fileno(), size,
+                                          access=mmap.ACCESS_READ)
+                else:
+                    self._map = ''
+                self._map_file = self._file
+            return self._map
+        finally:
+            if not locked:
+                self._lock.release()
+
+    @classmethod
+    def _find_from(cls, data, pos):
+        """Find the next From_ line at or after pos, or return -1."""
+        if pos <= 0:
+            if data[:5] == 'From ':
+                return 0
+            pos = 0
+        pos = data.find('\nFrom ', max(0, pos - 1))
+        return pos + 1 if (pos >= 0) else -1
+
+    def _generate_toc(self):
+        """
+        Generate the key-to-(start, stop) table of contents, following the
+        same rules as mailbox.mbox but without reading line by line.
+        """
+        data = self._get_map()
+        starts, stops = [], []
+        pos = self._find_from(data, 0)
+        while pos >= 0:
+            if starts:
+                stops.append(self._msg_stop(data, pos))
+            starts.append(pos)
+            pos = self._find_from(data, pos + 1)
+        if starts:
+            stops.append(self._msg_stop(data, len(data)))
+        self._toc = dict(enumerate(zip(starts, stops)))
+        self._next_key = len(self._toc)
+        self._file_length = len(data)
+        self._toc_saved = 0
+
+    @classmethod
+    def _msg_stop(cls, data, pos):
+        # A message ends before the blank line preceding the next one
+        eol = len(os.linesep)
+        if data[max(0, pos - 2 * eol):pos] == os.linesep * 2:
+            return pos - eol
+        return pos
+
     def get_msg_size(self, toc_id):
         return self._toc[toc_id][1] - self._toc[toc_id][0]
 
+    @classmethod
+    def _msg_cs(cls, data, start, cs_size, max_length):
+        firstKB = data[start:start + min(cs_size, max_length)]
+        if firstKB == '':
+            raise IOError(_('No data found'))
+        return b64w(sha1b64(firstKB)[:4])
+
     def get_msg_cs(self, start, cs_size, max_length):
-        self._lock.acquire()
-        try:
-            fd = self._file
-            fd.seek(start, 0)
-            firstKB = fd.read(min(cs_size, max_length))
-            if firstKB == '':
-                raise IOError(_('No data found'))
-            return b64w(sha1b64(firstKB)[:4])
-        finally:
-            self._lock.release()
+        return self._msg_cs(self._get_map(), start, cs_size, max_length)
 
     def get_msg_cs1k(self, start, max_length):
         return self.get_msg_cs(start, 1024, max_length)
@@ -161,23 +415,73 @@ class MailpileMailbox(mailbox.mbox):
                                b36(msg_size),
                                self.get_msg_cs80b(msg_start, msg_size))
 
+    def _get_range(self, key, from_):
+        start, stop = self._lookup(key)
+        data = self._get_map()
+        if not from_:
+            # Skip the From_ line, like mailbox.mbox does
+            eol = data.find('\n', start, stop)
+            start = stop if (eol < 0) else (eol + 1)
+        return data, start, stop
+
+    def get_string(self, key, from_=False):
+        data, start, stop = self._get_range(key, from_)
+        return data[start:stop].replace(os.linesep, '\n')
+
+    def get_file(self, key, from_=False):
+        return MappedFile(*self._get_range(key, from_))
+
+    def _verify_ptr(self, data, msg_ptr):
+        """
+        Check that a pointer still points at the message it was made for:
+        the checksum of its first 80 bytes or 1KB must still match. The
+        results are cached until the file changes.
+        """
+        cached = self._cs_cache.get(msg_ptr)
+        if cached is not None:
+            return cached
+        try:
+            parts = msg_ptr[MBX_ID_LEN:].split(':')
+            start = int(parts[0], 36)
+            length = int(parts[1], 36)
+            if len(parts) > 2:
+                cs = parts[2][:4]
+                valid = (self._msg_cs(data, start, 80, length) == cs or
+                         self._msg_cs(data, start, 1024, length) == cs)
+            else:
+                valid = (data[start:start + 1] != '')
+        except (IOError, ValueError, IndexError):
+            valid = False
+        if len(self._cs_cache) >= self.CS_CACHE_SIZE:
+            self._cs_cache = {}
+        self._cs_cache[msg_ptr] = valid
+        return valid
+
+    def verify_ptrs(self, msg_ptrs):
+        """Check many message pointers at once, returning {ptr: valid}."""
+        data = self._get_map()
+        return dict((ptr, self._verify_ptr(data, ptr)) for ptr in msg_ptrs)
+
     def get_file_by_ptr(self, msg_ptr):
+        # Make sure we can actually read the message
+        data = self._get_map()
+        if not self._verify_ptr(data, msg_ptr):
+            raise IOError(_('Message not found'))
+
+        # Each MappedFile has its own position, so other threads reading
+        # the same mailbox can't move things around under us.
         parts = msg_ptr[MBX_ID_LEN:].split(':')
         start = int(parts[0], 36)
-        length = int(parts[1], 36)
+        return MappedFile(data, start, start + int(parts[1], 36))
 
-        # Make sure we can actually read the message
-        cs80b = self.get_msg_cs80b(start, length)
-        if len(parts) > 2:
-            cs1k = self.get_msg_cs1k(start, length)
-            cs = parts[2][:4]
-            if (cs1k != cs and cs80b != cs):
-                raise IOError(_('Message not found'))
 
-        # We duplicate the file descriptor here, in case other threads are
-        # accessing the same mailbox and moving it around, or in case we have
-        # multiple PartialFile objects in flight at once.
-        return mailbox._PartialFile(self._get_fd(), start, start + length)
+mailpile.mailboxes.register(90, MailpileMailbox)
 
 
-mailpile.mailboxes.register(90, MailpileMailbox)
+if __name__ == "__main__":
+    import doctest
+    import sys
+    results = doctest.testmod(optionflags=doctest.ELLIPSIS)
+    print '%s' % (results, )
+    if results.failed:
+        sys.exit(1)
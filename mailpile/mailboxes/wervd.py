@@ -1,17 +1,17 @@
 import email.generator
 import email.message
 import mailbox
-import StringIO
 from gettext import gettext as _
 
 import mailpile.mailboxes
-from mailpile.mailboxes import UnorderedPicklable
+import mailpile.mailboxes.maildir as maildir
 from mailpile.crypto.streamer import *
 
 
-class MailpileMailbox(UnorderedPicklable(mailbox.Maildir, editable=True)):
+class MailpileMailbox(maildir.MailpileMailbox):
     """A Maildir class that supports pickling and a few mailpile specifics."""
     supported_platform = None
+    FSYNC_GROUP = 100
 
     @classmethod
     def parse_path(cls, config, fn, create=False):
@@ -32,17 +32,15 @@ class MailpileMailbox(UnorderedPicklable(mailbox.Maildir, editable=True)):
         # FIXME: Remove all the copies of this message!
         os.remove(os.path.join(self._path, self._lookup(key)))
 
-    def _refresh(self):
-        mailbox.Maildir._refresh(self)
+    def _is_mail(self, key):
         # WERVD mail names don't have dots in them
-        for t in [k for k in self._toc.keys() if '.' in k]:
-            del self._toc[t]
+        return '.' not in key
 
     def _get_fd(self, key):
         fd = open(os.path.join(self._path, self._lookup(key)), 'rb')
         key = self._encryption_key_func()
         if key:
-            fd = DecryptingStreamer(key, fd)
+            fd = decrypting_streamer(key, fd)
         return fd
 
     def get_message(self, key):
@@ -66,44 +64,101 @@ class MailpileMailbox(UnorderedPicklable(mailbox.Maildir, editable=True)):
                 fd.close()
 
     def get_file(self, key):
-        return StringIO.StringIO(self.get_string(key))
+        """Return a file-like object, decrypting as it is read."""
+        return self._get_fd(key)
+
+    def _new_streamer(self):
+        key = self._encryption_key_func()
+        tmp = os.path.join(self._path, 'tmp')
+        if key:
+            return encrypting_streamer(key, dir=tmp)
+        else:
+            return InlineChecksummingStreamer(dir=tmp)
+
+    def _new_key(self, md5sum, taken):
+        # We are using the MD5 to detect file system corruption, not in a
+        # security context - so using as little as 40 bits should be fine.
+        for l in range(10, len(md5sum)):
+            if not taken(md5sum[:l]):
+                return md5sum[:l]
+        raise mailbox.ExternalClashError(_('Could not find a filename '
+                                           'for the message.'))
+
+    def _save(self, es, key, copies, fsync=False):
+        es.save(os.path.join(self._path, 'new', key))
+        self._toc[key] = os.path.join('new', key)
+        for cpn in range(1, copies):
+            fn = os.path.join(self._path, 'new', '%s.%s' % (key, cpn))
+            with mailbox._create_carefully(fn) as ofd:
+                es.save_copy(ofd)
+                if fsync:
+                    ofd.flush()
+                    os.fsync(ofd.fileno())
 
     def add(self, message, copies=1):
         """Add message and return assigned key."""
-        key = self._encryption_key_func()
+        es = self._new_streamer()
         try:
-            if key:
-                es = EncryptingStreamer(key,
-                                        dir=os.path.join(self._path, 'tmp'))
-            else:
-                es = ChecksummingStreamer(dir=os.path.join(self._path, 'tmp'))
             self._dump_message(message, es)
             es.finish()
-
-            # We are using the MD5 to detect file system corruption, not in a
-            # security context - so using as little as 40 bits should be fine.
-            saved = False
-            key = None
-            for l in range(10, len(es.outer_md5sum)):
-                key = es.outer_md5sum[:l]
-                fn = os.path.join(self._path, 'new', key)
-                if not os.path.exists(fn):
-                    es.save(fn)
-                    saved = self._toc[key] = os.path.join('new', key)
-                    break
-            if not saved:
-                raise mailbox.ExternalClashError(_('Could not find a filename '
-                                                   'for the message.'))
-
-            for cpn in range(1, copies):
-                fn = os.path.join(self._path, 'new', '%s.%s' % (key, cpn))
-                with mailbox._create_carefully(fn) as ofd:
-                    es.save_copy(ofd)
-
+            key = self._new_key(es.outer_md5sum, lambda k: os.path.exists(
+                os.path.join(self._path, 'new', k)))
+            self._save(es, key, copies)
             return key
         finally:
             es.close()
 
+    def add_many(self, messages, copies=1, fsync=True):
+        """
+        Add many messages and return their keys, in order.
+
+        This is a faster add() for bulk imports: filenames are allocated
+        using a single directory listing, and messages are written out in
+        groups of FSYNC_GROUP, which are synced to disk together before
+        being moved into place (if fsync is set).
+        """
+        taken = set()
+        for subdir in ('new', 'cur'):
+            taken |= set(fn.split(self.colon)[0] for fn in
+                         maildir.ListMaildir(os.path.join(self._path, subdir)))
+        keys, group = [], []
+        try:
+            for message in messages:
+                es = self._new_streamer()
+                group.append(es)
+                self._dump_message(message, es)
+                es.finish()
+                if len(group) >= self.FSYNC_GROUP:
+                    keys.extend(self._save_group(group, taken, copies, fsync))
+            keys.extend(self._save_group(group, taken, copies, fsync))
+            return keys
+        finally:
+            for es in group:
+                es.close()
+
+    def _save_group(self, group, taken, copies, fsync):
+        if fsync:
+            for es in group:
+                es.fsync()
+        keys = []
+        while group:
+            es = group.pop(0)
+            try:
+                key = self._new_key(es.outer_md5sum, taken.__contains__)
+                taken.add(key)
+                self._save(es, key, copies, fsync=fsync)
+                keys.append(key)
+            finally:
+                es.close()
+        if fsync and keys:
+            # The renames are only durable once the directory is synced
+            dfd = os.open(os.path.join(self._path, 'new'), os.O_RDONLY)
+            try:
+                os.fsync(dfd)
+            finally:
+                os.close(dfd)
+        return keys
+
     def _dump_message(self, message, target):
         if isinstance(message, email.message.Message):
             gen = email.generator.Generator(target, False, 0)
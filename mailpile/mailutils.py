@@ -1,5 +1,6 @@
 import base64
 import copy
+import email.feedparser
 import email.header
 import email.parser
 import email.utils
@@ -57,8 +58,75 @@ class NoSuchMailboxError(OSError):
     pass
 
 
-def ParseMessage(fd, pgpmime=True):
-    message = email.parser.Parser().parse(fd)
+def ReadHeaders(fd, max_bytes=64*1024):
+    r"""
+    Read just the header block of a message from a file-like object,
+    including the blank line which ends it, so the rest of the message
+    can still be read from fd if necessary.
+
+    >>> fd = StringIO.StringIO('Subject: hi\r\n\r\nBody\n')
+    >>> ReadHeaders(fd), fd.read()
+    ('Subject: hi\r\n\r\n', 'Body\n')
+    """
+    headers, size = [], 0
+    while size < max_bytes:
+        line = fd.readline()
+        headers.append(line)
+        size += len(line)
+        if line in ('', '\n', '\r\n'):
+            break
+    return ''.join(headers)
+
+
+def ParseHeaders(headers):
+    r"""
+    Parse a header block (as returned by ReadHeaders), returning a parser
+    and the message parsed so far, which only has headers. The parser can
+    be fed the rest of the message and passed to FinishMessage, so the
+    headers need not be parsed twice.
+
+    >>> parser, msg = ParseHeaders('Subject: hi\n\n')
+    >>> msg['Subject'], msg.get_payload()
+    ('hi', None)
+    >>> parser.feed('Body\n')
+    >>> msg = FinishMessage(parser, pgpmime=False)
+    >>> msg['Subject'], msg.get_payload()
+    ('hi', 'Body\n')
+
+    Without a blank line at the end, the parser can't tell whether the
+    last header continues, so we parse the headers on their own:
+
+    >>> ParseHeaders('Subject: hi\n')[1]['Subject']
+    'hi'
+    """
+    parser = email.feedparser.FeedParser()
+    parser.feed(headers)
+    if headers.splitlines(True)[-1:] in (['\n'], ['\r\n']):
+        # The message object being built is the one close() will return.
+        message = parser._msgstack[0]
+    else:
+        message = email.parser.HeaderParser().parsestr(headers)
+    message.signature_info = SignatureInfo()
+    message.encryption_info = EncryptionInfo()
+    return parser, message
+
+
+def FinishMessage(parser, pgpmime=True):
+    return _ProcessMessage(parser.close(), pgpmime)
+
+
+def ParseMessage(fd, pgpmime=True, headers_only=False):
+    if headers_only:
+        # Parse the header block only, leaving the body unread.
+        message = email.parser.HeaderParser().parsestr(ReadHeaders(fd))
+        message.signature_info = SignatureInfo()
+        message.encryption_info = EncryptionInfo()
+        return message
+
+    return _ProcessMessage(email.parser.Parser().parse(fd), pgpmime)
+
+
+def _ProcessMessage(message, pgpmime):
     if pgpmime and GnuPG:
         UnwrapMimeCrypto(message, protocols={
             'openpgp': GnuPG
@@ -103,6 +171,40 @@ def ExtractEmailAndName(string):
     return email, (name or email)
 
 
+def PayloadLength(part):
+    """
+    Get the decoded size of a MIME part. The size of base64 data can be
+    calculated from the encoded size, so we avoid decoding it if we can.
+
+    >>> part = MIMEBase('application', 'octet-stream')
+    >>> part.set_payload('Hello world!' * 100 + 'Bye')
+    >>> encoders.encode_base64(part)
+    >>> PayloadLength(part)
+    1203
+    >>> len(part.get_payload(None, True))
+    1203
+    """
+    payload = part.get_payload()
+    if not isinstance(payload, str):
+        return len(part.get_payload(None, True) or '')
+    cte = (part.get('content-transfer-encoding') or '').strip().lower()
+    if cte == 'base64':
+        length = len(payload) - sum(payload.count(c) for c in ' \t\r\n')
+        tail = payload[-16:].translate(None, ' \t\r\n')
+        if length % 4 == 0:
+            return (length // 4) * 3 - tail[-2:].count('=')
+    elif cte in ('', '7bit', '8bit', 'binary'):
+        return len(payload)
+    # Quoted-printable, uuencoded or broken base64; just decode it.
+    return len(part.get_payload(None, True) or '')
+
+
+# FIXME: Decide if this is strict enough or too strict...?
+HTML_CLEANER = Cleaner(page_structure=True, meta=True, links=True,
+                       javascript=True, scripts=True, frames=True,
+                       embedded=True, safe_attrs_only=True)
+
+
 def MessageAsString(part, unixfrom=False):
     buf = StringIO.StringIO()
     Generator(buf).flatten(part, unixfrom=unixfrom, linesep='\r\n')
@@ -388,6 +490,35 @@ class Email(object):
                        msg_parsed=msg, msg_parsed_pgpmime=msg,
                        ephemeral_mid=ephemeral_mid)
 
+    @classmethod
+    def Import(cls, session, idx, mbox_id, mbx, messages):
+        """
+        Add many raw messages to a mailbox and index them, returning an
+        Email for each. Mailboxes which support it store them all in one
+        batch (add_many), so this is much faster than Create()-ing them
+        one by one.
+        """
+        if hasattr(mbx, 'add_many'):
+            msg_keys = mbx.add_many(messages)
+        else:
+            msg_keys = [mbx.add(message) for message in messages]
+        emails = []
+        for msg_key, data in zip(msg_keys, messages):
+            msg = ParseMessage(StringIO.StringIO(data), pgpmime=False)
+            msg_ptr = mbx.get_msg_ptr(mbox_id, msg_key)
+            msg_id = idx.get_msg_id(msg, msg_ptr)
+            msg_idx, msg_info = idx.add_new_msg(msg_ptr, msg_id,
+                                                int(time.time()),
+                                                idx.hdr(msg, 'from'), [], [],
+                                                len(data),
+                                                idx.hdr(msg, 'subject'),
+                                                '', [])
+            idx.set_conversation_ids(msg_info[idx.MSG_MID], msg)
+            email = cls(idx, msg_idx)
+            idx.index_email(session, email)
+            emails.append(email)
+        return emails
+
     def is_editable(self):
         return (self.ephemeral_mid or
                 self.config.is_editable_message(self.get_msg_info()))
@@ -586,6 +717,8 @@ class Email(object):
         self.msg_info = msg_info
         self.msg_parsed = msg_parsed
         self.msg_parsed_pgpmime = msg_parsed_pgpmime
+        self.msg_headers = None
+        self.valid_ptrs = None
 
     def get_msg_info(self, field=None):
         if not self.msg_info:
@@ -595,8 +728,38 @@ class Email(object):
         else:
             return self.msg_info[field]
 
-    def get_mbox_ptr_and_fd(self):
-        for msg_ptr in self.get_msg_info(self.index.MSG_PTRS).split(','):
+    @classmethod
+    def VerifyPointers(cls, emails):
+        """
+        Check the pointers of many emails at once, opening each mailbox
+        only once. Afterwards get_mbox_ptr_and_fd() only tries pointers
+        which were found to be valid.
+        """
+        by_mbox = {}
+        for e in emails:
+            for msg_ptr in e.get_msg_info(e.index.MSG_PTRS).split(','):
+                if msg_ptr:
+                    mbx_id = msg_ptr[:MBX_ID_LEN]
+                    by_mbox.setdefault(mbx_id, []).append(msg_ptr)
+        valid = {}
+        for mbx_id, msg_ptrs in by_mbox.iteritems():
+            try:
+                mbox = emails[0].config.open_mailbox(None, mbx_id)
+                valid.update(mbox.verify_ptrs(msg_ptrs))
+            except (IOError, OSError, KeyError, ValueError, IndexError):
+                pass
+            if not all(valid.get(p) for p in msg_ptrs):
+                emails[0].index.repair_pointers_later(mbx_id)
+        for e in emails:
+            e.valid_ptrs = [p for p in
+                            e.get_msg_info(e.index.MSG_PTRS).split(',')
+                            if valid.get(p)]
+
+    def get_mbox_ptr_and_fd(self, _retry=True):
+        msg_ptrs = self.valid_ptrs
+        if msg_ptrs is None:
+            msg_ptrs = self.get_msg_info(self.index.MSG_PTRS).split(',')
+        for msg_ptr in msg_ptrs:
             if msg_ptr == '':
                 continue
             try:
@@ -605,8 +768,15 @@ class Email(object):
                 # FIXME: How do we know we have the right message?
                 return mbox, msg_ptr, fd
             except (IOError, OSError, KeyError, ValueError, IndexError):
-                # FIXME: If this pointer is wrong, should we fix the index?
-                print 'WARNING: %s not found' % msg_ptr
+                # The mailbox has changed under us, go find where it went.
+                self.index.repair_pointers_later(msg_ptr[:MBX_ID_LEN])
+
+        # If the repair has already happened, try the new locations.
+        if _retry and not self.ephemeral_mid:
+            self.msg_info = self.valid_ptrs = None
+            new_ptrs = self.get_msg_info(self.index.MSG_PTRS).split(',')
+            if set(new_ptrs) - set(msg_ptrs):
+                return self.get_mbox_ptr_and_fd(_retry=False)
         return None, None, None
 
     def get_file(self):
@@ -635,12 +805,25 @@ class Email(object):
             raise IndexError(_('Message not found?'))
         return result
 
+    def get_msg_headers(self):
+        """Get just the headers, without parsing the whole message."""
+        parsed = self.msg_parsed_pgpmime or self.msg_parsed
+        if parsed:
+            return parsed
+        if not self.msg_headers:
+            fd = self.get_file()
+            if fd:
+                self.msg_headers = ParseMessage(fd, headers_only=True)
+        if not self.msg_headers:
+            raise IndexError(_('Message not found?'))
+        return self.msg_headers
+
     def get_headerprint(self):
-        return HeaderPrint(self.get_msg())
+        return HeaderPrint(self.get_msg_headers())
 
     def is_thread(self):
         return ((self.get_msg_info(self.index.MSG_THREAD_MID)) or
-                (0 < len(self.get_msg_info(self.index.MSG_REPLIES))))
+                (0 < len(self.index.get_thread(self.msg_idx_pos))))
 
     def get(self, field, default=''):
         """Get one (or all) indexed fields for this mail."""
@@ -650,7 +833,7 @@ class Email(object):
         elif field == 'from':
             return self.get_msg_info(self.index.MSG_FROM)
         else:
-            raw = ' '.join(self.get_msg().get_all(field, default))
+            raw = ' '.join(self.get_msg_headers().get_all(field, default))
             return self.index.hdr(0, 0, value=raw) or raw
 
     def get_msg_summary(self):
@@ -814,11 +997,8 @@ class Email(object):
             if conv_id:
                 conv = Email(self.index, int(conv_id, 36))
                 tree['conversation'] = convs = [conv.get_msg_summary()]
-                for rid in conv.get_msg_info(self.index.MSG_REPLIES
-                                             ).split(','):
-                    if rid:
-                        convs.append(Email(self.index, int(rid, 36)
-                                           ).get_msg_summary())
+                for rid in self.index.get_thread(int(conv_id, 36)):
+                    convs.append(Email(self.index, rid).get_msg_summary())
 
         if (want is None
                 or 'headers' in want
@@ -844,10 +1024,11 @@ class Email(object):
                 if hdrl in ('reply-to', 'from', 'to', 'cc', 'bcc'):
                     tree['addresses'][hdrl] = AddressHeaderParser(msg[hdr])
 
-        # FIXME: Decide if this is strict enough or too strict...?
-        html_cleaner = Cleaner(page_structure=True, meta=True, links=True,
-                               javascript=True, scripts=True, frames=True,
-                               embedded=True, safe_attrs_only=True)
+        # Parts are only decoded if we need their contents, and we only
+        # need the first HTML part if there turn out to be no text parts.
+        want_html = want is None or 'html_parts' in want
+        want_text = want is None or 'text_parts' in want
+        first_html = None
 
         # Note: count algorithm must match that used in extract_attachment
         #       above
@@ -867,20 +1048,15 @@ class Email(object):
             count += 1
             if (part.get('content-disposition', 'inline') == 'inline'
                     and mimetype in ('text/plain', 'text/html')):
-                payload, charset = self.decode_payload(part)
-                start = payload[:100].strip()
-
                 if mimetype == 'text/html':
-                    if want is None or 'html_parts' in want:
-                        tree['html_parts'].append({
-                            'charset': charset,
-                            'type': 'html',
-                            'data': ((payload.strip()
-                                      and html_cleaner.clean_html(payload))
-                                     or '')
-                        })
-
-                elif want is None or 'text_parts' in want:
+                    if want_html:
+                        tree['html_parts'].append(self._html_part(part))
+                    elif want_text and first_html is None:
+                        first_html = part
+
+                elif want_text:
+                    payload, charset = self.decode_part(part)
+                    start = payload[:100].strip()
                     if start[:3] in ('<di', '<ht', '<p>', '<p ', '<ta', '<bo'):
                         payload = self._extract_text_from_html(payload)
                     # Ignore white-space only text parts, they usually mean
@@ -895,14 +1071,16 @@ class Email(object):
                     'mimetype': mimetype,
                     'count': count,
                     'part': part,
-                    'length': len(part.get_payload(None, True) or ''),
+                    'length': PayloadLength(part),
                     'content-id': part.get('content-id', ''),
                     'filename': part.get_filename() or ''
                 })
 
-        if want is None or 'text_parts' in want:
-            if tree.get('html_parts') and not tree.get('text_parts'):
-                html_part = tree['html_parts'][0]
+        if want_text and not tree['text_parts']:
+            html_part = (tree.get('html_parts') or [None])[0]
+            if html_part is None and first_html is not None:
+                html_part = self._html_part(first_html)
+            if html_part:
                 payload = self._extract_text_from_html(html_part['data'])
                 text_parts = self.parse_text_part(payload,
                                                   html_part['charset'])
@@ -952,6 +1130,24 @@ class Email(object):
         payload = part.get_payload(None, True) or ''
         return self.decode_text(payload, charset=charset)
 
+    def decode_part(self, part):
+        """Decode the payload of a part, caching the result on the part."""
+        try:
+            return part.decoded_payload
+        except AttributeError:
+            part.decoded_payload = self.decode_payload(part)
+            return part.decoded_payload
+
+    def _html_part(self, part):
+        payload, charset = self.decode_part(part)
+        return {
+            'charset': charset,
+            'type': 'html',
+            'data': ((payload.strip()
+                      and HTML_CLEANER.clean_html(payload))
+                     or '')
+        }
+
     def parse_text_part(self, data, charset):
         current = {
             'type': 'bogus',
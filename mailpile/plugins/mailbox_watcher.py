@@ -0,0 +1,222 @@
+# This plugin watches local mailboxes for changes using the Linux inotify
+# API, and rescans just the mailboxes that changed. On other platforms (or
+# if prefs.watch_mailboxes is off) it does nothing at all, and new mail is
+# only found by the periodic or manual rescans.
+#
+import os
+import select
+import struct
+import sys
+import threading
+import time
+from gettext import gettext as _
+
+import mailpile.util
+from mailpile.commands import Rescan
+from mailpile.plugins import PluginManager
+
+try:
+    import ctypes
+    import ctypes.util
+    _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                        use_errno=True)
+    _libc.inotify_init
+    _libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                        ctypes.c_uint32]
+    _libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+except (ImportError, OSError, AttributeError):
+    _libc = None
+
+
+_plugins = PluginManager(builtin=__file__)
+
+
+##[ Configuration ]##########################################################
+
+_plugins.register_config_variables('prefs', {
+    'watch_mailboxes': (_('Watch local mailboxes for new mail'), bool, True),
+})
+
+
+##[ Inotify ]################################################################
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+
+MBOX_EVENTS = (IN_MODIFY | IN_CLOSE_WRITE | IN_ATTRIB |
+               IN_DELETE_SELF | IN_MOVE_SELF)
+MAILDIR_EVENTS = (IN_CREATE | IN_MOVED_TO | IN_DELETE_SELF | IN_MOVE_SELF)
+GONE_EVENTS = (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED)
+
+
+class Inotify(object):
+    """A minimal wrapper around the Linux inotify API, using ctypes."""
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self):
+        self.fd = _libc.inotify_init()
+        if self.fd < 0:
+            self._raise()
+
+    def _raise(self, path=None):
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno), path)
+
+    def add_watch(self, path, mask):
+        if isinstance(path, unicode):
+            path = path.encode(sys.getfilesystemencoding() or 'utf-8')
+        wd = _libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            self._raise(path)
+        return wd
+
+    def rm_watch(self, wd):
+        _libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self, timeout):
+        """Wait up to timeout seconds, returning (wd, mask, name) tuples."""
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        data = os.read(self.fd, 64 * 1024)
+        events, pos = [], 0
+        while pos + self.EVENT.size <= len(data):
+            wd, mask, cookie, length = self.EVENT.unpack_from(data, pos)
+            pos += self.EVENT.size
+            name = data[pos:pos + length].rstrip('\0')
+            pos += length
+            events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+##[ Background worker ]######################################################
+
+class MailboxWatcher(threading.Thread):
+    """
+    This worker watches local mbox files and the new/ and cur/ directories
+    of Maildirs, and queues a rescan of just the mailboxes that changed.
+    Changes are collected until things have been quiet for SETTLE_TIME
+    seconds (or for at most MAX_DELAY), so a burst of deliveries only
+    causes a single rescan.
+    """
+    SETTLE_TIME = 0.25
+    MAX_DELAY = 2.0
+    RESYNC_INTERVAL = 60
+
+    def __init__(self, session):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.session = session
+        self.quitting = False
+        self.inotify = None
+        self.watches = {}
+        self.queued = set()
+        self.lock = threading.Lock()
+
+    def _watched_paths(self):
+        config = self.session.config
+        local_id = config.sys.get('local_mailbox_id', None)
+        for mbx_id, path in config.get_mailboxes():
+            # Our own mailbox only changes when we change it
+            if path == '/dev/null' or (local_id and
+                                       int(mbx_id, 36) == int(local_id, 36)):
+                continue
+            if os.path.isfile(path):
+                yield mbx_id, path, MBOX_EVENTS
+            elif os.path.isdir(os.path.join(path, 'new')):
+                for subdir in ('new', 'cur'):
+                    yield mbx_id, os.path.join(path, subdir), MAILDIR_EVENTS
+
+    def _sync_watches(self):
+        wanted = {}
+        for mbx_id, path, mask in self._watched_paths():
+            try:
+                wanted[self.inotify.add_watch(path, mask)] = mbx_id
+            except OSError, e:
+                self.session.ui.debug(_('Cannot watch %s: %s') % (path, e))
+        for wd in set(self.watches.keys()) - set(wanted.keys()):
+            self.inotify.rm_watch(wd)
+        self.watches = wanted
+
+    def _rescan(self, mbx_ids):
+        session, config = self.session, self.session.config
+        if not config.slow_worker:
+            return
+
+        self.lock.acquire()
+        try:
+            mbx_ids = sorted(set(mbx_ids) - self.queued)
+            self.queued |= set(mbx_ids)
+        finally:
+            self.lock.release()
+        if not mbx_ids:
+            return
+
+        def rescan():
+            self.lock.acquire()
+            try:
+                self.queued -= set(mbx_ids)
+            finally:
+                self.lock.release()
+            rsc = Rescan(session, 'rescan', arg=['mailboxes'] + mbx_ids)
+            rsc.serialize = False
+            return rsc.run()
+
+        config.slow_worker.add_task(session, 'Rescan: %s' % ' '.join(mbx_ids),
+                                    rescan)
+
+    def run(self):
+        if _libc is None or not self.session.config.prefs.watch_mailboxes:
+            return
+        try:
+            self.inotify = Inotify()
+        except OSError, e:
+            self.session.ui.debug(_('Not watching mailboxes: %s') % e)
+            return
+        try:
+            changed, first_change, next_sync = set(), 0, 0
+            while not self.quitting and not mailpile.util.QUITTING:
+                if time.time() >= next_sync:
+                    self._sync_watches()
+                    next_sync = time.time() + self.RESYNC_INTERVAL
+
+                events = self.inotify.read_events(
+                    self.SETTLE_TIME if changed else 1.0)
+                for wd, mask, name in events:
+                    if mask & IN_Q_OVERFLOW:
+                        changed |= set(self.watches.values())
+                    elif wd in self.watches:
+                        changed.add(self.watches[wd])
+                    if mask & GONE_EVENTS:
+                        # Replaced or deleted, watch again after a moment
+                        self.watches.pop(wd, None)
+                        next_sync = min(next_sync, time.time() + 1)
+                if changed and not first_change:
+                    first_change = time.time()
+
+                if changed and (not events or
+                                time.time() - first_change > self.MAX_DELAY):
+                    self._rescan(changed)
+                    changed, first_change = set(), 0
+        finally:
+            self.inotify.close()
+
+    def quit(self, join=True):
+        self.quitting = True
+        if join:
+            try:
+                self.join()
+            except RuntimeError:
+                pass
+
+
+_plugins.register_worker(MailboxWatcher)
@@ -109,8 +109,8 @@ class Search(Command):
             start = 0
 
         # FIXME: Is this dumb?
-        for arg in args:
-            if ':' in arg or (arg and arg[0] in ('-', '+')):
+        for arg in MailIndex.merge_phrases(args):
+            if ':' in arg or (arg and arg[0] in ('-', '+', '"')):
                 session.searched.append(arg.lower())
             else:
                 session.searched.extend(re.findall(WORD_REGEXP, arg.lower()))
@@ -177,7 +177,7 @@ class Previous(Search):
 
 
 class Order(Search):
-    """Sort by: date, from, subject, random or index"""
+    """Sort by: date, from, subject, relevance, random or index"""
     SYNOPSIS = ('o', 'order', None, '<how>')
     ORDER = ('Searching', 3)
     HTTP_CALLABLE = ()
@@ -240,6 +240,7 @@ class View(Search):
         else:
             raw = False
         emails = [Email(idx, mid) for mid in self._choose_messages(args)]
+        Email.VerifyPointers(emails)
 
         rv = self._side_effects(emails)
         if rv is not None:
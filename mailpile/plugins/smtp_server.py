@@ -1,5 +1,4 @@
 import asyncore
-import email.parser
 import smtpd
 import threading
 import traceback
@@ -24,15 +23,35 @@ _plugins.register_config_section(
     }])
 
 
+# process_message() returns this to hold back the reply to DATA until the
+# message has been delivered, see SMTPServer.deliver_queued().
+DEFERRED = '250 Deferred'
+
+
 class SMTPChannel(smtpd.SMTPChannel):
-    def __init__(self, session, *args, **kwargs):
-        smtpd.SMTPChannel.__init__(self, *args, **kwargs)
+    def __init__(self, session, server, *args, **kwargs):
+        # The base class says hello right away, via push()
+        self.mp_server = server
+        self.held = None
+        smtpd.SMTPChannel.__init__(self, server, *args, **kwargs)
         self.session = session
         # Lie lie lie lie...
         self.__fqdn = 'cs.utah.edu'
 
+    def release(self, status):
+        """Send the deferred reply to DATA, and anything held behind it."""
+        held, self.held = self.held, None
+        for msg in [status] + held:
+            self.push(msg)
+
     def push(self, msg):
-        if msg.startswith('220'):
+        if self.held is not None:
+            # Replies must go out in order, so wait for the deferred one
+            self.held.append(msg)
+        elif msg is DEFERRED:
+            self.held = []
+            self.mp_server.queue[-1][1] = self
+        elif msg.startswith('220'):
             # This is a hack, because these days it is no longer considered
             # reasonable to tell everyone your hostname and version number.
             # Lie lie lie lie! ... https://snowplow.org/tom/worm/worm.html
@@ -53,6 +72,7 @@ class SMTPChannel(smtpd.SMTPChannel):
 class SMTPServer(smtpd.SMTPServer):
     def __init__(self, session, localaddr):
         self.session = session
+        self.queue = []
         smtpd.SMTPServer.__init__(self, localaddr, None)
 
     def handle_accept(self):
@@ -63,24 +83,27 @@ class SMTPServer(smtpd.SMTPServer):
 
     def process_message(self, peer, mailfrom, rcpttos, data):
         # We can assume that the mailfrom and rcpttos have checked out
-        # and this message is indeed intended for us. Spool it to disk
-        # and add to the index!
+        # and this message is indeed intended for us. Queue it, so all
+        # the mail which arrives at once gets spooled to disk together.
+        self.queue.append([data, None])
+        return DEFERRED
+
+    def deliver_queued(self):
+        """Spool the queued messages to disk and add them to the index."""
+        queue, self.queue = self.queue, []
+        if not queue:
+            return
         session, config = self.session, self.session.config
-        blank_tid = config.get_tags(type='blank')[0]._key
-        idx = config.index
         try:
-            message = email.parser.Parser().parsestr(data)
             lid, lmbox = config.open_local_mailbox(session)
-            e = Email.Create(idx, lid, lmbox, ephemeral_mid=False)
-            idx.add_tag(session, blank_tid, msg_idxs=[e.msg_idx_pos],
-                        conversation=False)
-            e.update_from_msg(session, message)
-            idx.remove_tag(session, blank_tid, msg_idxs=[e.msg_idx_pos],
-                           conversation=False)
-            return None
+            Email.Import(session, config.index, lid, lmbox,
+                         [data for data, channel in queue])
+            status = '250 Ok'
         except:
             traceback.print_exc()
-            return '400 Oops wtf'
+            status = '451 Oops wtf'
+        for data, channel in queue:
+            channel.release(status)
 
 
 class SMTPWorker(threading.Thread):
@@ -95,6 +118,7 @@ class SMTPWorker(threading.Thread):
             server = SMTPServer(self.session, (cfg.host, cfg.port))
             while not self.quitting:
                 asyncore.poll(timeout=1.0)
+                server.deliver_queued()
             asyncore.close_all()
 
     def quit(self, join=True):
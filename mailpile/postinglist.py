@@ -1,6 +1,9 @@
+import bisect
 import os
 import random
 import threading
+import time
+import zlib
 from gettext import gettext as _
 
 import mailpile.util
@@ -270,13 +273,23 @@ GLOBAL_GPL_LOCK = threading.Lock()
 
 class GlobalPostingList(PostingList):
 
+    # Roughly how much has been written to the journal since it was last
+    # migrated to the posting lists.
+    JOURNAL_BYTES = 0
+
     @classmethod
     def _Optimize(cls, session, idx, force=False, lazy=False, quick=False):
         count = 0
         global GLOBAL_POSTING_LIST
         if (GLOBAL_POSTING_LIST
-                and (not lazy or len(GLOBAL_POSTING_LIST) > 40*1024)):
-            keys = sorted(GLOBAL_POSTING_LIST.keys())
+                and (not lazy or (len(GLOBAL_POSTING_LIST) >
+                                  session.config.sys.journal_flush_words))):
+            GLOBAL_GPL_LOCK.acquire()
+            try:
+                keys = sorted(GLOBAL_POSTING_LIST.keys())
+                journal_bytes = cls.JOURNAL_BYTES
+            finally:
+                GLOBAL_GPL_LOCK.release()
             pls = GlobalPostingList(session, '')
             for sig in keys:
                 if (count % 25) == 0:
@@ -289,6 +302,12 @@ class GlobalPostingList(PostingList):
                 pls._migrate(sig, compact=quick)
                 count += 1
             pls.save()
+            # Anything appended while we were migrating is still pending.
+            GLOBAL_GPL_LOCK.acquire()
+            try:
+                cls.JOURNAL_BYTES = max(0, cls.JOURNAL_BYTES - journal_bytes)
+            finally:
+                GLOBAL_GPL_LOCK.release()
 
         if quick:
             return count
@@ -321,6 +340,8 @@ class GlobalPostingList(PostingList):
                 GLOBAL_POSTING_LIST[sig] = set()
             for mail_id in mail_ids:
                 GLOBAL_POSTING_LIST[sig].add(mail_id)
+                cls.JOURNAL_BYTES += len(mail_id) + 1
+            cls.JOURNAL_BYTES += len(sig) + 1
         finally:
             GLOBAL_GPL_LOCK.release()
 
@@ -363,3 +384,325 @@ class GlobalPostingList(PostingList):
         return (self.WORDS.get(self.sig, set())
                 | PostingList(self.session, self.word,
                               sig=self.sig, config=self.config).hits())
+
+
+class JournalFlusher(object):
+    """
+    Decides when long running jobs (such as a rescan) should migrate the
+    keyword journal to the posting lists. This happens once enough data
+    has gone into the journal, once enough time has passed or once the
+    journal has too many keywords in it, whichever comes first (see the
+    sys.journal_flush_* settings). The settings are read once, up front,
+    and checking does not lock anything, so it is cheap enough to do for
+    every message.
+    """
+
+    def __init__(self, session, idx):
+        self.session = session
+        self.idx = idx
+        self.flushes = 0
+        self.flushed_at = time.time()
+        config = session.config
+        self.max_bytes = 1024 * config.sys.journal_flush_kb
+        self.max_secs = config.sys.journal_flush_secs
+        self.max_words = config.sys.journal_flush_words
+
+    def due(self):
+        max_words, max_bytes = self.max_words, self.max_bytes
+        return ((max_words and len(GLOBAL_POSTING_LIST or []) > max_words) or
+                (max_bytes and GlobalPostingList.JOURNAL_BYTES > max_bytes) or
+                (self.max_secs and
+                 time.time() - self.flushed_at > self.max_secs))
+
+    def flush(self):
+        GlobalPostingList.Optimize(self.session, self.idx, quick=True)
+        self.flushed_at = time.time()
+        self.flushes += 1
+
+    def check(self):
+        """Flush the journal if it is due, returning True if we did."""
+        if GLOBAL_POSTING_LIST and self.due():
+            self.flush()
+            return True
+        return False
+
+
+GLOBAL_SEGMENTS_LOCK = threading.Lock()
+
+
+class MessageSegments(object):
+    """
+    Per-message data which is too bulky for the metadata index lives in
+    segment files (one per block of SEGMENT_SIZE messages) under a
+    subdirectory of the workdir, one line per message:
+
+        <msg_mid> TAB <base64(zlib(...))>
+
+    Later lines override earlier ones, so re-indexing a message just
+    appends. Subclasses define the directory and the Encode/Decode pair.
+    """
+
+    DIRNAME = None
+    SEGMENT_SIZE = 1024
+    CACHE_SEGMENTS = 16
+
+    @classmethod
+    def SaveDir(cls, config):
+        d = os.path.join(config.workdir, cls.DIRNAME)
+        if not os.path.exists(d):
+            os.mkdir(d)
+        return d
+
+    @classmethod
+    def SaveFile(cls, config, msg_idx_pos):
+        return os.path.join(cls.SaveDir(config),
+                            b36(msg_idx_pos // cls.SEGMENT_SIZE))
+
+    @classmethod
+    def Key(cls, sig):
+        """
+        A short per-message key for a word signature. Collisions only
+        matter within a single message, so 32 bits is plenty.
+        """
+        return b36(zlib.crc32(sig) & 0xffffffff)
+
+    @classmethod
+    def Compress(cls, data):
+        return zlib.compress(data).encode('base64').replace('\n', '')
+
+    @classmethod
+    def Decompress(cls, data):
+        return zlib.decompress(data.decode('base64'))
+
+    @classmethod
+    def Record(cls, session, msg_mid, words):
+        config = session.config
+        data = cls.Encode(config, words)
+        msg_idx_pos = int(msg_mid, 36)
+        fn = cls.SaveFile(config, msg_idx_pos)
+        GLOBAL_SEGMENTS_LOCK.acquire()
+        try:
+            with open(fn, 'a') as fd:
+                fd.write('%s\t%s\n' % (msg_mid, data))
+            if fn in cls._CACHE:
+                cls._CACHE[fn][msg_mid] = data
+        finally:
+            GLOBAL_SEGMENTS_LOCK.release()
+        return len(data)
+
+    @classmethod
+    def _LoadSegment(cls, fn):
+        segment = cls._CACHE.get(fn)
+        if segment is not None:
+            return segment
+        segment = {}
+        try:
+            with open(fn, 'r') as fd:
+                for line in fd:
+                    try:
+                        mid, data = line.strip().split('\t', 1)
+                        segment[mid] = data
+                    except ValueError:
+                        pass
+        except (IOError, OSError):
+            pass
+        cls._CACHE[fn] = segment
+        cls._CACHE_ORDER.append(fn)
+        while len(cls._CACHE_ORDER) > cls.CACHE_SEGMENTS:
+            del cls._CACHE[cls._CACHE_ORDER.pop(0)]
+        return segment
+
+    @classmethod
+    def Load(cls, config, msg_idx_pos, keys=None):
+        """Return the decoded data for a message, or None."""
+        fn = cls.SaveFile(config, msg_idx_pos)
+        GLOBAL_SEGMENTS_LOCK.acquire()
+        try:
+            data = cls._LoadSegment(fn).get(b36(msg_idx_pos))
+        finally:
+            GLOBAL_SEGMENTS_LOCK.release()
+        if data:
+            try:
+                return cls.Decode(data, keys=keys)
+            except (ValueError, zlib.error):
+                pass
+        return None
+
+    @classmethod
+    def DropCaches(cls):
+        GLOBAL_SEGMENTS_LOCK.acquire()
+        try:
+            cls._CACHE = {}
+            cls._CACHE_ORDER = []
+        finally:
+            GLOBAL_SEGMENTS_LOCK.release()
+
+
+class WordPositions(MessageSegments):
+    """
+    Word positions are an optional, per-message record of where each
+    keyword occurs in the body text. They are not needed for normal
+    keyword search, but are used to verify phrase and proximity matches
+    after the posting lists have narrowed things down.
+
+    The segment data is "key:d,d,d key:d,d ...", where the keys are a
+    short hash of the word signature and the d's are b36 deltas between
+    successive positions.
+    """
+
+    DIRNAME = 'positions'
+
+    # Text parts are separated by this many positions, so phrases do not
+    # match across the subject/body or attachment boundaries.
+    PART_GAP = 100
+
+    _CACHE = {}
+    _CACHE_ORDER = []
+
+    @classmethod
+    def Encode(cls, config, words):
+        """
+        Convert an ordered list of words (with None marking a break
+        between text parts) into the compact on-disk form. Common words
+        are skipped, but still count towards the positions of the others.
+        """
+        keys, positions, pos = {}, {}, 0
+        for word in words:
+            if word is None:
+                pos += cls.PART_GAP
+                continue
+            if word not in STOPLIST:
+                key = keys.get(word)
+                if key is None:
+                    key = keys[word] = cls.Key(PostingList.WordSig(word,
+                                                                   config))
+                if key in positions:
+                    positions[key].append(pos)
+                else:
+                    positions[key] = [pos]
+            pos += 1
+
+        encoded = []
+        for key, plist in positions.iteritems():
+            last, deltas = 0, []
+            for p in plist:
+                deltas.append(b36(p - last))
+                last = p
+            encoded.append('%s:%s' % (key, ','.join(deltas)))
+        return cls.Compress(' '.join(encoded))
+
+    @classmethod
+    def Decode(cls, data, keys=None):
+        positions = {}
+        for item in cls.Decompress(data).split():
+            key, deltas = item.split(':', 1)
+            if keys and key not in keys:
+                continue
+            last, plist = 0, []
+            for d in deltas.split(','):
+                last += int(d, 36)
+                plist.append(last)
+            positions[key] = plist
+        return positions
+
+    @classmethod
+    def Matches(cls, positions, keys, offsets, distance=0):
+        """
+        Check whether the words (given as keys and their relative offsets
+        within a phrase) occur together. With a distance of 0,
+        this is an exact phrase match, otherwise all the words must occur
+        within distance positions of the first one, in any order.
+
+        >>> pos = {'a': [1, 7], 'b': [8, 20], 'c': [30]}
+        >>> WordPositions.Matches(pos, ['a', 'b'], [0, 1])
+        True
+        >>> WordPositions.Matches(pos, ['b', 'a'], [0, 1])
+        False
+        >>> WordPositions.Matches(pos, ['a', 'c'], [0, 1], distance=10)
+        False
+        >>> WordPositions.Matches(pos, ['c', 'b'], [0, 1], distance=10)
+        True
+        """
+        first = positions.get(keys[0])
+        if not first:
+            return False
+        others = []
+        for key, offset in zip(keys[1:], offsets[1:]):
+            plist = positions.get(key)
+            if not plist:
+                return False
+            others.append((plist, offset - offsets[0]))
+        for p in first:
+            for plist, offset in others:
+                if distance:
+                    i = bisect.bisect_left(plist, p - distance)
+                    if i >= len(plist) or plist[i] > p + distance:
+                        break
+                else:
+                    i = bisect.bisect_left(plist, p + offset)
+                    if i >= len(plist) or plist[i] != p + offset:
+                        break
+            else:
+                return True
+        return False
+
+
+class TermFrequencies(MessageSegments):
+    """
+    Term frequencies record how often each keyword occurs in a message,
+    along with the total number of words, for relevance ranking. The
+    segment data is "length key:n key:n ...", where the keys are as for
+    WordPositions. Words occurring only once are left out, as the posting
+    lists already tell us which messages contain them.
+
+    >>> data = TermFrequencies.Compress('9 abc:3 def:2')
+    >>> TermFrequencies.Decode(data)
+    (9, {'abc': 3, 'def': 2})
+    >>> TermFrequencies.Decode(data, keys=['def'])
+    (9, {'def': 2})
+    """
+
+    DIRNAME = 'termfreq'
+
+    _CACHE = {}
+    _CACHE_ORDER = []
+
+    @classmethod
+    def Encode(cls, config, words):
+        keys, counts, length = {}, {}, 0
+        for word in words:
+            if word is None:
+                continue
+            length += 1
+            if word not in STOPLIST:
+                key = keys.get(word)
+                if key is None:
+                    key = keys[word] = cls.Key(PostingList.WordSig(word,
+                                                                   config))
+                counts[key] = counts.get(key, 0) + 1
+
+        encoded = ['%d' % length]
+        for key, count in counts.iteritems():
+            if count > 1:
+                encoded.append('%s:%d' % (key, count))
+        return cls.Compress(' '.join(encoded))
+
+    @classmethod
+    def Decode(cls, data, keys=None):
+        items = cls.Decompress(data).split()
+        counts = {}
+        for item in items[1:]:
+            key, count = item.split(':', 1)
+            if keys and key not in keys:
+                continue
+            counts[key] = int(count)
+        return int(items[0]), counts
+
+
+if __name__ == "__main__":
+    import doctest
+    import sys
+    results = doctest.testmod(optionflags=doctest.ELLIPSIS)
+    print '%s' % (results, )
+    if results.failed:
+        sys.exit(1)
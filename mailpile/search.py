@@ -1,27 +1,94 @@
+import array
+import cPickle
 import email
-import lxml.html
+import email.message
+import heapq
+import math
+import multiprocessing
 import re
 import rfc822
+import signal
 import time
 import threading
 import traceback
+from collections import OrderedDict
 from gettext import gettext as _
 from gettext import ngettext as _n
 from urllib import quote, unquote
 
+import mailpile.ui
 import mailpile.util
 from mailpile.util import *
 from mailpile.plugins import PluginManager
 from mailpile.mailutils import MBX_ID_LEN, NoSuchMailboxError
 from mailpile.mailutils import ExtractEmails, ExtractEmailAndName
-from mailpile.mailutils import Email, ParseMessage, HeaderPrint
-from mailpile.postinglist import GlobalPostingList
+from mailpile.mailutils import Email, ParseMessage, ReadHeaders, HeaderPrint
+from mailpile.mailutils import ParseHeaders, FinishMessage
+from mailpile.postinglist import GlobalPostingList, PostingList
+from mailpile.postinglist import JournalFlusher
+from mailpile.postinglist import WordPositions, TermFrequencies
+from mailpile.tokenizer import Keywords, Tokenize
 from mailpile.ui import *
+from mailpile.workers import Pipeline
 
 
 _plugins = PluginManager()
 
 
+##[ Parallel scanning ]#######################################################
+
+# This is set by MailIndex._scan_pool just before forking the pool.
+SCAN_STATE = None
+
+
+def _scan_init():
+    global SCAN_STATE
+    # The parent process deals with ^C and cleans up after us.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # Reopen the mailbox, so we don't share (and seek) the parent's files.
+    idx, session, mbox, mailbox_idx = SCAN_STATE
+    copy = cPickle.loads(cPickle.dumps(mbox, cPickle.HIGHEST_PROTOCOL))
+    copy._encryption_key_func = mbox._encryption_key_func
+    SCAN_STATE = (idx, session, copy, mailbox_idx)
+
+
+def _scan_batch(batch):
+    idx, session, mbox, mailbox_idx = SCAN_STATE
+    items = []
+    for item in batch:
+        item = idx._scan_read(session, mbox, mailbox_idx, item)
+        item = item and idx._scan_parse(session, mailbox_idx, item)
+        if item is not None:
+            items.append(item)
+    results = []
+    for item in idx._scan_extract(session, mailbox_idx, items):
+        # The parent has no use for the payloads, leave them behind
+        item['msg'] = _scan_skeleton(item['msg'])
+        results.append(item)
+    return results
+
+
+SCAN_SKELETON_ATTRS = ('signature_info', 'encryption_info',
+                       'cryptedcontainer', '_decoded_headers')
+
+
+def _scan_skeleton(part):
+    """
+    Copy the headers and structure of a message, along with what we
+    learned about it (its crypto state), but not the payloads.
+    """
+    skeleton = email.message.Message()
+    for hdr, value in part.items():
+        skeleton[hdr] = value
+    for attr in SCAN_SKELETON_ATTRS:
+        if hasattr(part, attr):
+            setattr(skeleton, attr, getattr(part, attr))
+    if part.is_multipart():
+        skeleton.set_payload([_scan_skeleton(p) for p in part.get_payload()])
+    return skeleton
+
+
 class SearchResultSet:
     """
     Search results!
@@ -79,6 +146,73 @@ class CachedSearchResultSet(SearchResultSet):
         SEARCH_RESULT_CACHE = {}
 
 
+class MessageTreeCache(object):
+    """
+    A least-recently-used cache of rendered message trees, so viewing a
+    message again doesn't mean reading, parsing and decrypting it again.
+    Each tree is stored with a key describing the state of the message
+    it was rendered from, and is only returned while that still matches.
+    """
+
+    def __init__(self, max_trees=None):
+        self.max_trees = max_trees
+        self.hits = self.misses = 0
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def get(self, msg_idx, key):
+        self._lock.acquire()
+        try:
+            cached = self._cache.pop(msg_idx, None)
+            if cached is None or cached[0] != key:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._cache[msg_idx] = cached
+            return cached[1]
+        finally:
+            self._lock.release()
+
+    def put(self, msg_idx, key, tree):
+        self._lock.acquire()
+        try:
+            self._cache.pop(msg_idx, None)
+            if self.max_trees != 0:
+                self._cache[msg_idx] = (key, tree)
+            while self.max_trees and len(self._cache) > self.max_trees:
+                self._cache.popitem(last=False)
+        finally:
+            self._lock.release()
+
+    def drop(self, msg_idxs):
+        self._lock.acquire()
+        try:
+            for msg_idx in msg_idxs:
+                self._cache.pop(msg_idx, None)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._cache.clear()
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'trees': len(self._cache),
+            'max_trees': self.max_trees,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': (float(self.hits) / lookups) if lookups else 0.0
+        }
+
+
 class MailIndex:
     """This is a lazily parsing object representing a mailpile index."""
 
@@ -109,16 +243,22 @@ class MailIndex:
         self.INDEX = []
         self.INDEX_SORT = {}
         self.INDEX_THR = []
+        self.THREADS = {}
+        self.SUBJECTS = None
+        self.PENDING_REFS = OrderedDict()
         self.PTRS = {}
         self.TAGS = {}
         self.MSGIDS = {}
         self.EMAILS = []
         self.EMAIL_IDS = {}
         self.CACHE = {}
+        self.MSG_TREES = MessageTreeCache()
         self.MODIFIED = set()
+        self.scan_stats = {}
         self.EMAILS_SAVED = 0
         self._saved_changes = 0
         self._lock = threading.Lock()
+        self._ptr_repairs = set()
 
     @classmethod
     def l2m(self, line):
@@ -337,14 +477,45 @@ class MailIndex:
                     pass
         return "".join(i for i in text if ord(i) < 128)
 
+    # Headers which are plain printable ASCII, without any RFC2047 encoded
+    # words, need no decoding at all.
+    RE_HDR_NEEDS_DECODING = re.compile('[^\x20-\x7e\t\r\n]|=\?')
+
     def hdr(self, msg, name, value=None):
+        """
+        Decode a message header (or a raw header value) to unicode. The
+        decoded headers of a message are cached on the message itself, so
+        each is only decoded once.
+        """
+        cache = None
+        if value is None and msg:
+            cache = getattr(msg, '_decoded_headers', None)
+            if cache is None:
+                cache = msg._decoded_headers = {}
+            key = name.lower()
+            if key in cache:
+                return cache[key]
+            value = msg[name] or ''
+
+        if (isinstance(value, str) and
+                not self.RE_HDR_NEEDS_DECODING.search(value)):
+            decoded = unicode(value.replace('"', '')).replace(
+                '\r', ' ').replace('\t', ' ').replace('\n', ' ')
+        else:
+            decoded = self._decode_hdr(value, cleanup=(cache is not None))
+
+        if cache is not None:
+            cache[key] = decoded
+        return decoded
+
+    def _decode_hdr(self, value, cleanup=True):
         try:
-            if value is None and msg:
+            if cleanup:
                 # Security: RFC822 headers are not allowed to have (unencoded)
                 # non-ascii characters in them, so we just strip them all out
                 # before parsing.
                 # FIXME: This is "safe", but can we be smarter/gentler?
-                value = CleanText(msg[name], replace='_').clean
+                value = CleanText(value, replace='_').clean
             # Note: decode_header does the wrong thing with "quoted" data.
             decoded = email.header.decode_header((value or ''
                                                   ).replace('"', ''))
@@ -362,8 +533,12 @@ class MailIndex:
         self.PTRS[msg_ptr] = msg_idx_pos
 
         # If message was seen in this mailbox before, update the location
+        # and forget the stale pointer.
         for i in range(0, len(msg_ptrs)):
             if msg_ptrs[i][:MBX_ID_LEN] == msg_ptr[:MBX_ID_LEN]:
+                if (msg_ptrs[i] != msg_ptr and
+                        self.PTRS.get(msg_ptrs[i]) == msg_idx_pos):
+                    del self.PTRS[msg_ptrs[i]]
                 msg_ptrs[i] = msg_ptr
                 msg_ptr = None
                 break
@@ -374,6 +549,79 @@ class MailIndex:
         msg_info[self.MSG_PTRS] = ','.join(msg_ptrs)
         self.set_msg_at_idx_pos(msg_idx_pos, msg_info)
 
+    def repair_pointers(self, session, mailbox_idx):
+        """
+        Find messages which have moved within a mailbox (because the mbox
+        was compacted or rewritten by another program), by reading just the
+        headers of every message we don't have a valid pointer for and
+        matching them up with the index by Message-ID.
+
+        Returns the number of pointers which were repaired.
+        """
+        try:
+            mbox = self.config.open_mailbox(session, mailbox_idx)
+        except (IOError, OSError, NoSuchMailboxError), e:
+            session.ui.mark(_('%s: Error opening: %s') % (mailbox_idx, e))
+            return 0
+
+        if len(self.PTRS.keys()) == 0:
+            self.update_ptrs_and_msgids(session)
+
+        repaired = 0
+        for key in mbox.keys():
+            if mailpile.util.QUITTING:
+                break
+            try:
+                msg_ptr = mbox.get_msg_ptr(mailbox_idx, key)
+                if msg_ptr in self.PTRS:
+                    continue
+                msg = ParseMessage(mbox.get_file(key), headers_only=True)
+            except (IOError, OSError, ValueError, IndexError, KeyError):
+                continue
+            msg_id = self.get_msg_id(msg, msg_ptr)
+            if msg_id in self.MSGIDS:
+                self.update_location(session, self.MSGIDS[msg_id], msg_ptr)
+                repaired += 1
+
+        if repaired:
+            session.ui.mark(_('%s: Repaired %d message pointers'
+                              ) % (mailbox_idx, repaired))
+        return repaired
+
+    def repair_pointers_later(self, mailbox_idx, session=None):
+        """
+        Queue a repair_pointers() job for a mailbox on the slow worker,
+        unless one is already pending. Without a running worker (or with
+        the dumb worker), the repair happens right away.
+        """
+        session = session or self.config.background
+        if session is None:
+            session = mailpile.ui.Session(self.config)
+            session.ui = mailpile.ui.SilentInteraction(self.config)
+        self._lock.acquire()
+        try:
+            if mailbox_idx in self._ptr_repairs:
+                return
+            self._ptr_repairs.add(mailbox_idx)
+        finally:
+            self._lock.release()
+
+        def repair():
+            try:
+                return self.repair_pointers(session, mailbox_idx)
+            finally:
+                self._lock.acquire()
+                try:
+                    self._ptr_repairs.discard(mailbox_idx)
+                finally:
+                    self._lock.release()
+
+        if self.config.slow_worker:
+            self.config.slow_worker.add_task(session, 'Repair pointers: %s'
+                                                      % mailbox_idx, repair)
+        else:
+            return repair()
+
     def _parse_date(self, date_hdr):
         """Parse a Date: or Received: header into a unix timestamp."""
         try:
@@ -456,7 +704,8 @@ class MailIndex:
             print _('WARNING: No proper Message-ID for %s') % msg_ptr
         return self.encode_msg_id(raw_msg_id or msg_ptr)
 
-    def scan_mailbox(self, session, mailbox_idx, mailbox_fn, mailbox_opener):
+    def scan_mailbox(self, session, mailbox_idx, mailbox_fn, mailbox_opener,
+                     flusher=None):
         try:
             mbox = mailbox_opener(session, mailbox_idx)
             if mbox.editable:
@@ -478,66 +727,67 @@ class MailIndex:
         if len(self.PTRS.keys()) == 0:
             self.update_ptrs_and_msgids(session)
 
-        snippet_max = session.config.sys.snippet_max
-        added = 0
-        msg_ts = int(time.time())
+        def parse_status(ui, count):
+            return _n('%s: Reading your mail: %d%% (%d/%d message)',
+                      '%s: Reading your mail: %d%% (%d/%d messages)',
+                      count) % (mailbox_idx, 100 * ui / count, ui, count)
+
+        # Find the messages which are new or modified; checking pointers
+        # is cheap, so we do this first and then parse only what we must.
+        pending = []
         for ui in range(0, len(unparsed)):
             if mailpile.util.QUITTING:
                 break
-
             i = unparsed[ui]
+            msg_ptr = mbox.get_msg_ptr(mailbox_idx, i)
+            if msg_ptr not in self.PTRS:
+                pending.append((i, msg_ptr))
+            elif (ui % 317) == 0:
+                session.ui.mark(parse_status(ui, len(unparsed)))
+                play_nice_with_threads()
 
-            parse_status = _n('%s: Reading your mail: %d%% (%d/%d message)',
-                              '%s: Reading your mail: %d%% (%d/%d messages)',
-                              len(unparsed)
-                              ) % (mailbox_idx,
-                                   100 * ui / len(unparsed),
-                                   ui, len(unparsed))
+        processes = self._scan_processes(session, mbox, len(pending))
+        pipeline = self._scan_pipeline(session, mbox, mailbox_idx, pending,
+                                       processes)
 
-            msg_ptr = mbox.get_msg_ptr(mailbox_idx, i)
-            if msg_ptr in self.PTRS:
-                if (ui % 317) == 0:
-                    session.ui.mark(parse_status)
+        flusher = flusher or JournalFlusher(session, self)
+        filter_hooks = _plugins.get_filter_hooks([self.filter_keywords])
+        snippet_max = session.config.sys.snippet_max
+        msg_ts = int(time.time())
+        added = 0
+        try:
+            for ui, item in enumerate(pipeline):
+                if mailpile.util.QUITTING:
+                    break
+
+                session.ui.mark(parse_status(ui, len(pending)))
+                if (ui % self.SCAN_BATCH) == 0:
                     play_nice_with_threads()
-                continue
-            else:
-                session.ui.mark(parse_status)
-                play_nice_with_threads()
 
-            # Message new or modified, let's parse it.
-            if 'rescan' in session.config.sys.debug:
-                session.ui.debug('Reading message %s/%s' % (mailbox_idx, i))
-            try:
-                msg_fd = mbox.get_file(i)
-                msg = ParseMessage(msg_fd,
-                                   pgpmime=session.config.prefs.index_encrypted)
-            except (IOError, OSError, ValueError, IndexError, KeyError):
-                if session.config.sys.debug:
-                    traceback.print_exc()
-                session.ui.warning(('Reading message %s/%s FAILED, skipping'
-                                    ) % (mailbox_idx, i))
-                continue
+                msg, msg_id = item['msg'], item['msg_id']
+                msg_ptr, msg_size = item['msg_ptr'], item['msg_size']
+                if msg_id in self.MSGIDS:
+                    self.update_location(session, self.MSGIDS[msg_id],
+                                         msg_ptr)
+                    added += 1
+                    continue
 
-            msg_size = msg_fd.tell()
-            msg_id = self.get_msg_id(msg, msg_ptr)
-            if msg_id in self.MSGIDS:
-                self.update_location(session, self.MSGIDS[msg_id], msg_ptr)
-                added += 1
-            else:
-                # Add new message!
+                # Add new message! Anything which needs the msg_mid (or
+                # the date, which may depend on the previous message) is
+                # done here, the rest was extracted by the earlier stages.
                 msg_mid = b36(len(self.INDEX))
-
                 msg_ts = self._extract_date_ts(session,
                                                msg_mid, msg_id, msg, msg_ts)
-
-                play_nice_with_threads()
+                keywords, snippet, words = item['extracted']
+                keywords |= self.meta_keywords(msg_mid, msg, msg_size, msg_ts)
                 keywords, body_info = self.index_message(
                     session,
                     msg_mid, msg_id, msg, msg_size, msg_ts,
                     mailbox=mailbox_idx,
                     compact=False,
-                    filter_hooks=_plugins.get_filter_hooks([self.filter_keywords]),
-                    is_new=True
+                    filter_hooks=filter_hooks,
+                    is_new=True,
+                    extracted=(keywords, snippet, words)
                 )
 
                 msg_subject = self.hdr(msg, 'subject')
@@ -558,11 +808,23 @@ class MailIndex:
                     tags
                 )
                 self.set_conversation_ids(msg_info[self.MSG_MID], msg)
-                mbox.mark_parsed(i)
+                mbox.mark_parsed(item['i'])
 
                 added += 1
-                GlobalPostingList.Optimize(session, self,
-                                           lazy=True, quick=True)
+                flusher.check()
+        finally:
+            stopped = pipeline.stop()
+
+        if not stopped:
+            # A stage may still be reading the mailbox, so don't save it
+            # (or pretend the stats are final). The next rescan catches up.
+            session.ui.warning(_('%s: Scanner did not stop, not saving'
+                                 ) % mailbox_idx)
+            return added
+
+        self.scan_stats[mailbox_idx] = pipeline.stats()
+        if 'rescan' in session.config.sys.debug:
+            session.ui.debug(pipeline.summary())
 
         if added:
             mbox.save(session)
@@ -570,6 +832,163 @@ class MailIndex:
                           ) % (mailbox_idx, mailbox_fn))
         return added
 
+    # Scanning is split into stages: read, parse, extract and finally
+    # commit (above), which assigns the message its metadata ID and runs the
+    # filters. Each stage works on a dict describing one message, and drops
+    # the message (returns None) if something fails.
+
+    def _scan_read(self, session, mbox, mailbox_idx, item):
+        if 'rescan' in session.config.sys.debug:
+            session.ui.debug('Reading message %s/%s' % (mailbox_idx,
+                                                        item['i']))
+        try:
+            # Read and parse the headers first: if we already know this
+            # Message-ID, the message has just moved and we can skip the
+            # body entirely. Otherwise the parser carries on from here.
+            fd = mbox.get_file(item['i'])
+            headers = ReadHeaders(fd)
+            parser, msg = ParseHeaders(headers)
+            item['msg_id'] = self.get_msg_id(msg, item['msg_ptr'])
+            item['msg_size'] = len(headers)
+            if item['msg_id'] in self.MSGIDS:
+                item['msg'] = msg
+            else:
+                item['parser'] = parser
+                item['data'] = fd.read()
+            return item
+        except (IOError, OSError, ValueError, IndexError, KeyError):
+            if session.config.sys.debug:
+                traceback.print_exc()
+            session.ui.warning(('Reading message %s/%s FAILED, skipping'
+                                ) % (mailbox_idx, item['i']))
+            return None
+
+    def _scan_parse(self, session, mailbox_idx, item):
+        if 'parser' not in item:
+            return item
+        try:
+            parser, data = item.pop('parser'), item.pop('data')
+            parser.feed(data)
+            msg = FinishMessage(parser,
+                                pgpmime=session.config.prefs.index_encrypted)
+        except (IOError, OSError, ValueError, IndexError, KeyError):
+            if session.config.sys.debug:
+                traceback.print_exc()
+            session.ui.warning(('Parsing message %s/%s FAILED, skipping'
+                                ) % (mailbox_idx, item['i']))
+            return None
+        item['msg'] = msg
+        item['msg_size'] += len(data)
+        return item
+
+    def _scan_extract(self, session, mailbox_idx, items):
+        for item in items:
+            # Duplicates just get their location updated, so we don't
+            # bother extracting anything from them. The msg_mid is only
+            # known once the message is added, so the date and the meta
+            # keywords are left for the commit stage.
+            if item['msg_id'] not in self.MSGIDS:
+                item['extracted'] = self.extract_message(
+                    session, None, item['msg_id'], item['msg'],
+                    item['msg_size'], None, mailbox=mailbox_idx, meta=False)
+            yield item
+
+    def _scan_pipeline(self, session, mbox, mailbox_idx, pending, processes):
+        source = ({'i': i, 'msg_ptr': msg_ptr} for i, msg_ptr in pending)
+        if processes > 1:
+            # Fork the pool now, before the pipeline starts its threads
+            pool = self._scan_pool(session, mbox, mailbox_idx, processes)
+            stages = [
+                ('parse', lambda items: self._scan_parallel(
+                    session, pool, processes, items))]
+        else:
+            stages = [
+                ('read', Pipeline.Map(lambda item: self._scan_read(
+                    session, mbox, mailbox_idx, item))),
+                ('parse', Pipeline.Map(lambda item: self._scan_parse(
+                    session, mailbox_idx, item))),
+                ('extract', lambda items: self._scan_extract(
+                    session, mailbox_idx, items))]
+        return Pipeline('%s: scan' % mailbox_idx, source, stages,
+                        queue_size=session.config.sys.scan_queue,
+                        consumer='commit')
+
+    SCAN_BATCH = 50
+
+    def _scan_processes(self, session, mbox, count):
+        """Decide how many processes to use for parsing count messages."""
+        processes = session.config.sys.scan_processes
+        if processes < 1:
+            try:
+                processes = multiprocessing.cpu_count()
+            except NotImplementedError:
+                processes = 1
+        # Children forked while other threads run (the web server, the
+        # workers) inherit any locks those threads held at the time, and
+        # may wait on them forever. So we only fork when we are alone,
+        # which in practice means rescanning from the command line.
+        if (not getattr(mbox, 'PARALLEL_SCAN', False) or
+                count < 2 * self.SCAN_BATCH or
+                threading.active_count() > 1):
+            return 1
+        return min(processes, count // self.SCAN_BATCH)
+
+    def _scan_pool(self, session, mbox, mailbox_idx, processes):
+        global SCAN_STATE
+        session.ui.mark(_('%s: Parsing mail in %d processes'
+                          ) % (mailbox_idx, processes))
+        SCAN_STATE = (self, session, mbox, mailbox_idx)
+        try:
+            return multiprocessing.Pool(processes, _scan_init)
+        except:
+            SCAN_STATE = None
+            raise
+
+    def _scan_parallel(self, session, pool, processes, items):
+        """
+        Read, parse and extract keywords from messages in a pool of
+        processes (see _scan_pool), yielding the results in order.
+
+        The processes are forked from this one, before any of the scan
+        threads start, so they share the current state of the index,
+        config and plugins. Messages are sent back
+        without their payloads, so the meta keyword extractors and filter
+        hooks get to see their headers, structure and crypto state only.
+        Batches are handed out as results come back, so we never have
+        more than a few per process in flight.
+        """
+        global SCAN_STATE
+        in_flight = threading.BoundedSemaphore(2 * processes)
+
+        def batches():
+            batch = []
+            for item in items:
+                batch.append(item)
+                if len(batch) >= self.SCAN_BATCH:
+                    in_flight.acquire()
+                    yield batch
+                    batch = []
+            if batch:
+                in_flight.acquire()
+                yield batch
+
+        try:
+            for results in pool.imap(_scan_batch, batches()):
+                in_flight.release()
+                for item in results:
+                    yield item
+            pool.close()
+        finally:
+            SCAN_STATE = None
+            # Unblock the pool's task feeder, in case we are aborting.
+            for i in range(0, 2 * processes):
+                try:
+                    in_flight.release()
+                except ValueError:
+                    break
+            pool.terminate()
+            pool.join()
+
     def edit_msg_info(self, msg_info,
                       msg_mid=None, raw_msg_id=None, msg_id=None, msg_ts=None,
                       msg_from=None, msg_subject=None, msg_body=None,
@@ -649,63 +1068,152 @@ class MailIndex:
         refs = set((self.hdr(msg, 'references') + ' ' +
                     self.hdr(msg, 'in-reply-to')
                     ).replace(',', ' ').strip().split())
-        for ref_id in [self.encode_msg_id(r) for r in refs if r]:
+        ref_ids = [self.encode_msg_id(r) for r in refs if r]
+        for ref_id in ref_ids:
             try:
                 # Get conversation ID ...
                 ref_idx_pos = self.MSGIDS[ref_id]
                 msg_thr_mid = self.get_msg_at_idx_pos(ref_idx_pos
                                                       )[self.MSG_THREAD_MID]
-                # Update root of conversation thread
-                parent = self.get_msg_at_idx_pos(int(msg_thr_mid, 36))
-                replies = parent[self.MSG_REPLIES][:-1].split(',')
-                if msg_mid not in replies:
-                    replies.append(msg_mid)
-                parent[self.MSG_REPLIES] = ','.join(replies) + ','
-                self.set_msg_at_idx_pos(int(msg_thr_mid, 36), parent)
                 break
             except (KeyError, ValueError, IndexError):
                 pass
 
         msg_idx_pos = int(msg_mid, 36)
         msg_info = self.get_msg_at_idx_pos(msg_idx_pos)
+        subj = self.thread_subject(msg_info[self.MSG_SUBJECT])
+        date = long(msg_info[self.MSG_DATE], 36)
 
-        if subject_threading and not msg_thr_mid and not refs:
+        if subject_threading and not msg_thr_mid and not refs and subj:
             # Can we do plain GMail style subject-based threading?
             # FIXME: Is this too aggressive? Make configurable?
-            subj = msg_info[self.MSG_SUBJECT].lower()
-            subj = subj.replace('re: ', '').replace('fwd: ', '')
-            date = long(msg_info[self.MSG_DATE], 36)
-            if subj.strip() != '':
-                for midx in reversed(range(max(0, msg_idx_pos - 250),
-                                           msg_idx_pos)):
-                    try:
-                        m_info = self.get_msg_at_idx_pos(midx)
-                        if m_info[self.MSG_SUBJECT
-                                  ].lower().replace('re: ', '') == subj:
-                            msg_thr_mid = m_info[self.MSG_THREAD_MID]
-                            parent = self.get_msg_at_idx_pos(int(msg_thr_mid,
-                                                                 36))
-                            replies = parent[self.MSG_REPLIES][:-1].split(',')
-                            if len(replies) < 100:
-                                if msg_mid not in replies:
-                                    replies.append(msg_mid)
-                                parent[self.MSG_REPLIES] = (','.join(replies)
-                                                            + ',')
-                                self.set_msg_at_idx_pos(int(msg_thr_mid, 36),
-                                                        parent)
-                                break
-                        if date - long(m_info[self.MSG_DATE],
-                                       36) > 5 * 24 * 3600:
-                            break
-                    except (KeyError, ValueError, IndexError):
-                        pass
+            msg_thr_mid = self._subject_thread(msg_mid, subj, date)
 
         if not msg_thr_mid:
             # OK, we are our own conversation root.
             msg_thr_mid = msg_mid
 
+        # This also adds the message to the thread table.
         msg_info[self.MSG_THREAD_MID] = msg_thr_mid
         self.set_msg_at_idx_pos(msg_idx_pos, msg_info)
+        if subj:
+            self._remember_subject(subj, date, msg_thr_mid)
+
+        # Replies which arrived before this message can now join its thread,
+        # and if we did not find our own parent, we wait for it.
+        self._adopt_pending(msg_info[self.MSG_ID], int(msg_thr_mid, 36))
+        if msg_thr_mid == msg_mid:
+            self._add_pending(ref_ids, msg_idx_pos)
+
+    # Replies indexed before their parents (as happens when importing from
+    # more than one mailbox at a time) become thread roots. We remember
+    # which Message-IDs they were waiting for, so when a parent shows up
+    # its orphans can be merged into its thread. This table only lives in
+    # memory and is bounded, as it is only meant to cover a single import.
+    PENDING_REFS_MAX = 100000
+
+    def _add_pending(self, ref_ids, msg_idx_pos):
+        for ref_id in ref_ids:
+            orphans = self.PENDING_REFS.pop(ref_id, None)
+            if orphans is None:
+                orphans = array.array('i')
+            if msg_idx_pos not in orphans:
+                orphans.append(msg_idx_pos)
+            self.PENDING_REFS[ref_id] = orphans
+        while len(self.PENDING_REFS) > self.PENDING_REFS_MAX:
+            self.PENDING_REFS.popitem(last=False)
+
+    def _adopt_pending(self, msg_id, thr_idx_pos):
+        orphans = self.PENDING_REFS.pop(msg_id, None)
+        if orphans:
+            # An orphan may have been adopted by another of its references
+            # already, in which case we adopt the thread it now belongs to.
+            roots = set(self.INDEX_THR[o] for o in orphans
+                        if o < len(self.INDEX_THR))
+            roots.discard(thr_idx_pos)
+            self.merge_threads(roots, thr_idx_pos)
+
+    def merge_threads(self, thr_idx_poss, thr_idx_pos):
+        """Move all the messages of some threads into another thread."""
+        thr_mid = b36(thr_idx_pos)
+        moving = []
+        for root_idx_pos in thr_idx_poss:
+            if (root_idx_pos != thr_idx_pos and
+                    self.INDEX_THR[root_idx_pos] == root_idx_pos):
+                moving.append(root_idx_pos)
+                moving.extend(self.get_thread(root_idx_pos))
+        for msg_idx_pos in moving:
+            msg_info = self.get_msg_at_idx_pos(msg_idx_pos)
+            msg_info[self.MSG_THREAD_MID] = thr_mid
+            self.set_msg_at_idx_pos(msg_idx_pos, msg_info)
+        return moving
+
+    # Subject threading only joins messages sent within a few days of the
+    # thread's other messages. We remember the date range of the last few
+    # threads for the SUBJECT_MAX most recently seen subjects.
+    SUBJECT_WINDOW = 5 * 24 * 3600
+    SUBJECT_MAX = 50000
+    SUBJECT_THREADS = 5
+    SUBJECT_REPLIES_MAX = 100
+    RE_SUBJECT_PREFIX = re.compile('^(\s*(re|fwd?|aw|wg|sv|vs|antw|tr|rif|r|'
+                                   'odp|enc)\s*(\[\d+\]|\(\d+\))?\s*:)+',
+                                   re.IGNORECASE)
+    RE_SUBJECT_SPACE = re.compile('\s+')
+
+    @classmethod
+    def thread_subject(cls, subject):
+        """
+        Normalize a subject for threading, dropping any reply and forward
+        prefixes (in a few languages) and differences in case or spacing.
+        """
+        subject = re.sub(cls.RE_SUBJECT_PREFIX, '', subject or '')
+        return re.sub(cls.RE_SUBJECT_SPACE, ' ', subject).strip().lower()
+
+    def _load_subjects(self):
+        self.SUBJECTS = OrderedDict()
+        first = max(0, len(self.INDEX) - self.SUBJECT_MAX)
+        for msg_idx_pos in range(first, len(self.INDEX)):
+            try:
+                msg_info = self.l2m(self.INDEX[msg_idx_pos])
+                subj = self.thread_subject(msg_info[self.MSG_SUBJECT])
+                if subj:
+                    self._remember_subject(subj,
+                                           long(msg_info[self.MSG_DATE], 36),
+                                           msg_info[self.MSG_THREAD_MID])
+            except (ValueError, IndexError):
+                pass
+
+    def _remember_subject(self, subj, date, msg_thr_mid):
+        if self.SUBJECTS is None:
+            self._load_subjects()
+        threads = self.SUBJECTS.pop(subj, [])
+        for i, (first, last, thr_mid) in enumerate(threads):
+            if thr_mid == msg_thr_mid:
+                threads[i] = (min(first, date), max(last, date), thr_mid)
+                break
+        else:
+            threads.append((date, date, msg_thr_mid))
+        self.SUBJECTS[subj] = threads[-self.SUBJECT_THREADS:]
+        while len(self.SUBJECTS) > self.SUBJECT_MAX:
+            self.SUBJECTS.popitem(last=False)
+
+    def _subject_thread(self, msg_mid, subj, date):
+        """Find a thread with this (normalized) subject near this date."""
+        if self.SUBJECTS is None:
+            self._load_subjects()
+        window = self.SUBJECT_WINDOW
+        for first, last, thr_mid in reversed(self.SUBJECTS.get(subj, [])):
+            if thr_mid != msg_mid and first - window <= date <= last + window:
+                try:
+                    thr_idx_pos = int(thr_mid, 36)
+                    if self.INDEX_THR[thr_idx_pos] != thr_idx_pos:
+                        continue  # Re-threaded, no longer a thread root
+                except (ValueError, IndexError):
+                    continue
+                replies = len(self.THREADS.get(thr_idx_pos, ()))
+                if replies < self.SUBJECT_REPLIES_MAX:
+                    return thr_mid
+        return None
 
     def unthread_message(self, msg_mid):
         msg_idx_pos = int(msg_mid, 36)
@@ -713,31 +1221,17 @@ class MailIndex:
         par_idx_pos = int(msg_info[self.MSG_THREAD_MID], 36)
 
         if par_idx_pos == msg_idx_pos:
-            # Message is head of thread, chop head off!
-            thread = msg_info[self.MSG_REPLIES][:-1].split(',')
-            msg_info[self.MSG_REPLIES] = ''
-            if msg_mid in thread:
-                thread.remove(msg_mid)
-            if thread and thread[0]:
-                head_mid = thread[0]
-                head_idx_pos = int(head_mid, 36)
-                head_info = self.get_msg_at_idx_pos(head_idx_pos)
-                head_info[self.MSG_REPLIES] = ','.join(thread) + ','
-                self.set_msg_at_idx_pos(head_idx_pos, head_info)
-                for msg_mid in thread:
-                    kid_idx_pos = int(thread[0], 36)
-                    kid_info = self.get_msg_at_idx_pos(head_idx_pos)
+            # Message is head of thread, chop head off! The first reply
+            # becomes the new head of the rest of the thread.
+            thread = self.THREADS.pop(msg_idx_pos, [])
+            if thread:
+                head_mid = b36(thread[0])
+                for kid_idx_pos in thread:
+                    kid_info = self.get_msg_at_idx_pos(kid_idx_pos)
                     kid_info[self.MSG_THREAD_MID] = head_mid
-                    kid.set_msg_at_idx_pos(head_idx_pos, head_info)
-        else:
-            # Message is a reply, remove it from thread
-            par_info = self.get_msg_at_idx_pos(par_idx_pos)
-            thread = par_info[self.MSG_REPLIES][:-1].split(',')
-            if msg_mid in thread:
-                thread.remove(msg_mid)
-                par_info[self.MSG_REPLIES] = ','.join(thread) + ','
-                self.set_msg_at_idx_pos(par_idx_pos, par_info)
+                    self.set_msg_at_idx_pos(kid_idx_pos, kid_info)
 
+        # Message is a reply: this removes it from the thread
         msg_info[self.MSG_THREAD_MID] = msg_mid
         self.set_msg_at_idx_pos(msg_idx_pos, msg_info)
 
@@ -835,12 +1329,19 @@ class MailIndex:
                     self.add_tag(session, tag_id, msg_idxs=set(msg_idxs))
 
     def read_message(self, session, msg_mid, msg_id, msg, msg_size, msg_ts,
-                     mailbox=None):
-        keywords = []
+                     mailbox=None, positions=None, meta=True):
+        """
+        Extract search keywords and a body snippet from a message. If a
+        positions list is given, the words of each text part are appended
+        to it in order (None separating the parts), for phrase search.
+        Unless meta is False, this includes the meta_keywords().
+        """
+        keywords = Keywords()
         snippet_text = snippet_html = ''
         body_info = {}
         payload = [None]
         textparts = 0
+        html_max = session.config.sys.index_html_kb * 1024
         for part in msg.walk():
             textpart = payload[0] = None
             ctype = part.get_content_type()
@@ -860,34 +1361,24 @@ class MailIndex:
                     textparts += 1
 
             if ctype == 'text/html':
-                _loader(part)
-                if len(payload[0]) > 3:
-                    try:
-                        textpart = lxml.html.fromstring(payload[0]
-                                                        ).text_content()
-                    except:
-                        session.ui.warning(_('=%s/%s has bogus HTML.'
-                                             ) % (msg_mid, msg_id))
-                        textpart = payload[0]
-                else:
-                    textpart = payload[0]
+                textpart = HtmlToText(_loader(part), max_bytes=html_max)
 
             if 'pgp' in part.get_content_type().lower():
-                keywords.append('pgp:has')
-                keywords.append('crypto:has')
+                keywords.add('pgp:has')
+                keywords.add('crypto:has')
 
             att = part.get_filename()
             if att:
                 att = self.try_decode(att, charset)
                 # FIXME: These should be tags!
-                keywords.append('attachment:has')
-                keywords.extend([t + ':att' for t
-                                 in re.findall(WORD_REGEXP, att.lower())])
+                keywords.add('attachment:has')
+                keywords.add_words(Tokenize(att), 'att')
                 textpart = (textpart or '') + ' ' + att
 
             if textpart:
-                # FIXME: Does this lowercase non-ASCII characters correctly?
-                keywords.extend(re.findall(WORD_REGEXP, textpart.lower()))
+                keywords.add_text(textpart, positions=positions)
+                if positions is not None:
+                    positions.append(None)
 
                 # NOTE: As a side effect here, the cryptostate plugin will
                 #       add a 'crypto:has' keyword which we check for below
@@ -905,7 +1396,7 @@ class MailIndex:
                                         lambda: _loader(part)))
 
         if textparts == 0:
-            keywords.append('text:missing')
+            keywords.add('text:missing')
 
         if 'crypto:has' in keywords:
             e = Email(self, -1,
@@ -923,37 +1414,35 @@ class MailIndex:
             # Index the contents, if configured to do so
             if session.config.prefs.index_encrypted:
                 for text in [t['data'] for t in tree['text_parts']]:
-                    keywords.extend(re.findall(WORD_REGEXP, text.lower()))
+                    keywords.add_text(text, positions=positions)
+                    if positions is not None:
+                        positions.append(None)
                     for kwe in _plugins.get_text_kw_extractors():
                         keywords.extend(kwe(self, msg, 'text/plain', text))
 
-        keywords.append('%s:id' % msg_id)
-        keywords.extend(re.findall(WORD_REGEXP,
-                                   self.hdr(msg, 'subject').lower()))
-        keywords.extend(re.findall(WORD_REGEXP,
-                                   self.hdr(msg, 'from').lower()))
-        if mailbox:
-            keywords.append('%s:mailbox' % mailbox.lower())
-        keywords.append('%s:hp' % HeaderPrint(msg))
-
+        # Decode each interesting header only once
+        headers = {}
         for key in msg.keys():
             key_lower = key.lower()
-            if key_lower not in BORING_HEADERS:
-                emails = ExtractEmails(self.hdr(msg, key).lower())
-                words = set(re.findall(WORD_REGEXP,
-                                       self.hdr(msg, key).lower()))
-                words -= STOPLIST
-                keywords.extend(['%s:%s' % (t, key_lower) for t in words])
-                keywords.extend(['%s:%s' % (e, key_lower) for e in emails])
-                keywords.extend(['%s:email' % e for e in emails])
-                if 'list' in key_lower:
-                    keywords.extend(['%s:list' % t for t in words])
+            if key_lower not in headers and key_lower not in BORING_HEADERS:
+                headers[key_lower] = self.hdr(msg, key)
+
+        keywords.add('%s:id' % msg_id)
+        keywords.add_text(headers.get('subject', ''), positions=positions)
+        keywords.add_text(headers.get('from', ''))
+        if mailbox:
+            keywords.add('%s:mailbox' % mailbox.lower())
+        keywords.add('%s:hp' % HeaderPrint(msg))
+
+        for key_lower, value in headers.iteritems():
+            keywords.add_header(key_lower, value)
         for key in EXPECTED_HEADERS:
             if not msg[key]:
-                keywords.append('%s:missing' % key)
+                keywords.add('%s:missing' % key)
 
-        for extract in _plugins.get_meta_kw_extractors():
-            keywords.extend(extract(self, msg_mid, msg, msg_size, msg_ts))
+        if meta:
+            keywords.extend(self.meta_keywords(msg_mid, msg, msg_size,
+                                               msg_ts))
 
         # FIXME: Allow plugins to augment the body_info
 
@@ -962,7 +1451,14 @@ class MailIndex:
         else:
             body_info['snippet'] = self.clean_snippet(snippet_html[:1024])
 
-        return (set(keywords) - STOPLIST), body_info
+        return keywords.result(), body_info
+
+    def meta_keywords(self, msg_mid, msg, msg_size, msg_ts):
+        """Run the plugins' meta keyword extractors on a message."""
+        keywords = set()
+        for extract in _plugins.get_meta_kw_extractors():
+            keywords.update(extract(self, msg_mid, msg, msg_size, msg_ts))
+        return keywords
 
     # FIXME: Here it would be nice to recognize more boilerplate junk in
     #        more languages!
@@ -983,13 +1479,38 @@ class MailIndex:
                               ).split('\n--')[0])
                 ).strip()
 
-    def index_message(self, session, msg_mid, msg_id, msg, msg_size, msg_ts,
-                      mailbox=None, compact=True, filter_hooks=[],
-                      is_new=True):
+    def extract_message(self, session, msg_mid, msg_id, msg, msg_size,
+                        msg_ts, mailbox=None, meta=True):
+        """
+        Run read_message, also collecting the words needed for positions
+        and relevance, if enabled. Returns (keywords, snippet, words).
+        """
+        prefs = session.config.prefs
+        want_words = prefs.index_positions or prefs.index_relevance
+        words = [] if want_words else None
         keywords, snippet = self.read_message(session,
                                               msg_mid, msg_id, msg,
                                               msg_size, msg_ts,
-                                              mailbox=mailbox)
+                                              mailbox=mailbox,
+                                              positions=words,
+                                              meta=meta)
+        return keywords, snippet, words
+
+    def index_message(self, session, msg_mid, msg_id, msg, msg_size, msg_ts,
+                      mailbox=None, compact=True, filter_hooks=[],
+                      is_new=True, extracted=None):
+        if extracted is None:
+            extracted = self.extract_message(session, msg_mid, msg_id, msg,
+                                             msg_size, msg_ts, mailbox=mailbox)
+        keywords, snippet, words = extracted
+
+        prefs = session.config.prefs
+        if words:
+            # Recorded before the filters run, so they can match phrases.
+            if prefs.index_positions:
+                WordPositions.Record(session, msg_mid, words)
+            if prefs.index_relevance:
+                TermFrequencies.Record(session, msg_mid, words)
 
         for hook in filter_hooks:
             keywords = hook(session, msg_mid, msg, keywords, is_new=is_new)
@@ -1020,16 +1541,24 @@ class MailIndex:
             return self.BOGUS_METADATA[:]
 
     def set_msg_at_idx_pos(self, msg_idx, msg_info):
+        # Replies live in the thread table now, drop any legacy list
+        msg_info[self.MSG_REPLIES] = ''
+        thr_idx = int(msg_info[self.MSG_THREAD_MID], 36)
         if msg_idx < len(self.INDEX):
             self.INDEX[msg_idx] = self.m2l(msg_info)
-            self.INDEX_THR[msg_idx] = int(msg_info[self.MSG_THREAD_MID], 36)
+            old_thr_idx = self.INDEX_THR[msg_idx]
+            self.INDEX_THR[msg_idx] = thr_idx
         elif msg_idx == len(self.INDEX):
             self.INDEX.append(self.m2l(msg_info))
-            self.INDEX_THR.append(int(msg_info[self.MSG_THREAD_MID], 36))
+            self.INDEX_THR.append(thr_idx)
+            old_thr_idx = msg_idx
         else:
             raise IndexError(_('%s is outside the index') % msg_idx)
+        if thr_idx != old_thr_idx:
+            self._move_to_thread(msg_idx, old_thr_idx, thr_idx)
 
         CachedSearchResultSet.DropCaches(msg_idxs=[msg_idx])
+        self.MSG_TREES.drop([msg_idx])
         self.MODIFIED.add(msg_idx)
         if msg_idx in self.CACHE:
             del(self.CACHE[msg_idx])
@@ -1044,6 +1573,37 @@ class MailIndex:
             self.PTRS[msg_ptr] = msg_idx
         self.update_msg_tags(msg_idx, msg_info)
 
+    # Threads are kept in memory as a table from the index position of each
+    # thread's root to an array of the positions of its replies, in the
+    # order they were added. INDEX_THR points the other way. Both are built
+    # from the MSG_THREAD_MID of each message when the index is loaded, so
+    # adding a reply to a thread is O(1) and never rewrites the root.
+
+    def _build_threads(self):
+        threads = {}
+        for msg_idx, thr_idx in enumerate(self.INDEX_THR):
+            if thr_idx != msg_idx:
+                if thr_idx not in threads:
+                    threads[thr_idx] = array.array('i')
+                threads[thr_idx].append(msg_idx)
+        self.THREADS = threads
+
+    def _move_to_thread(self, msg_idx, old_thr_idx, thr_idx):
+        if old_thr_idx != msg_idx:
+            replies = self.THREADS.get(old_thr_idx)
+            if replies is not None and msg_idx in replies:
+                replies.remove(msg_idx)
+                if not replies:
+                    del self.THREADS[old_thr_idx]
+        if thr_idx != msg_idx:
+            if thr_idx not in self.THREADS:
+                self.THREADS[thr_idx] = array.array('i')
+            self.THREADS[thr_idx].append(msg_idx)
+
+    def get_thread(self, msg_idx):
+        """Get the index positions of the replies in a thread."""
+        return self.THREADS.get(msg_idx, [])
+
     def get_conversation(self, msg_info=None, msg_idx=None):
         if not msg_info:
             msg_info = self.get_msg_at_idx_pos(msg_idx)
@@ -1055,10 +1615,18 @@ class MailIndex:
             return [msg_info]
 
     def get_replies(self, msg_info=None, msg_idx=None):
-        if not msg_info:
-            msg_info = self.get_msg_at_idx_pos(msg_idx)
-        return [self.get_msg_at_idx_pos(int(r, 36)) for r
-                in msg_info[self.MSG_REPLIES].split(',') if r]
+        if msg_idx is None:
+            msg_idx = int(msg_info[self.MSG_MID], 36)
+        return [self.get_msg_at_idx_pos(r) for r in self.get_thread(msg_idx)]
+
+    def msg_tree_key(self, msg_info):
+        """
+        Describe the state of a message for MSG_TREES: rendered messages
+        are stale if the message moved or was tagged (which is also how we
+        learn that its encryption or signature state changed).
+        """
+        tags = sorted(t for t in msg_info[self.MSG_TAGS].split(',') if t)
+        return (msg_info[self.MSG_PTRS], ','.join(tags))
 
     def get_tags(self, msg_info=None, msg_idx=None):
         if not msg_info:
@@ -1150,6 +1718,84 @@ class MailIndex:
         results.extend(hits('%s:in' % tag_id))
         return results
 
+    NEAR_DISTANCE = 10
+    RE_NEAR_TERM = re.compile('^near(\\d*):(.+)$')
+
+    @classmethod
+    def _phrase_term(self, parts):
+        text = ' '.join(parts)
+        op = (text[:1] in ('+', '-')) and text[:1] or ''
+        words = re.findall(WORD_REGEXP, text.lower())
+        if len(words) > 1:
+            return '%s"%s"' % (op, ' '.join(words))
+        elif words:
+            return op + words[0]
+        else:
+            return None
+
+    @classmethod
+    def merge_phrases(self, searchterms):
+        """
+        Reassemble quoted phrases which were split on whitespace, so
+        ['"quarterly', 'report"'] becomes ['"quarterly report"']. Terms
+        which already contain whitespace (shlex-quoted on the command
+        line) are treated as phrases as well.
+        """
+        terms, phrase = [], None
+        for term in searchterms:
+            if phrase is not None:
+                phrase.append(term)
+                if term.endswith('"'):
+                    terms.append(self._phrase_term(phrase))
+                    phrase = None
+            elif term.lstrip('+-')[:1] == '"':
+                if len(term.lstrip('+-')) > 1 and term.endswith('"'):
+                    terms.append(self._phrase_term([term]))
+                else:
+                    phrase = [term]
+            elif ' ' in term.strip() and ':' not in term:
+                terms.append(self._phrase_term([term]))
+            else:
+                terms.append(term)
+        if phrase is not None:
+            terms.append(self._phrase_term(phrase))
+        return [t for t in terms if t]
+
+    def search_phrase(self, session, words, hits, distance=0):
+        """
+        Find messages containing all the words, either as an exact phrase
+        (distance=0) or within distance positions of each other. Without
+        positional data this degrades to a plain AND of the words.
+        """
+        offsets = [i for i, w in enumerate(words) if w not in STOPLIST]
+        words = [words[i] for i in offsets]
+        if not words:
+            return []
+
+        results = set(hits(words[0]))
+        for word in words[1:]:
+            results &= set(hits(word))
+        if (len(words) < 2 or not results or
+                not self.config.prefs.index_positions):
+            return results
+
+        if session:
+            session.ui.mark(_('Checking word positions in %d messages'
+                              ) % len(results))
+        keys = [WordPositions.Key(PostingList.WordSig(w, self.config))
+                for w in words]
+        matches = []
+        for msg_idx_pos in results:
+            positions = WordPositions.Load(self.config, msg_idx_pos,
+                                           keys=keys)
+            # Messages indexed before positions were enabled can't be
+            # verified, so we give them the benefit of the doubt.
+            if (positions is None or
+                    WordPositions.Matches(positions, keys, offsets,
+                                          distance=distance)):
+                matches.append(msg_idx_pos)
+        return matches
+
     def search(self, session, searchterms,
                keywords=None, order=None, recursion=0):
         # Stash the raw search terms, decide if this is cached or not
@@ -1161,6 +1807,8 @@ class MailIndex:
         else:
             srs = SearchResultSet(self, raw_terms, [], [])
 
+        searchterms = self.merge_phrases(searchterms)
+
         # Choose how we are going to search
         if keywords is not None:
             def hits(term):
@@ -1208,9 +1856,18 @@ class MailIndex:
             rt = r[-1][1]
             term = term.lower()
 
-            if ':' in term:
+            if term[:1] == '"':
+                rt.extend(self.search_phrase(session, term[1:-1].split(),
+                                             hits))
+            elif ':' in term:
+                near = self.RE_NEAR_TERM.match(term)
                 if term.startswith('body:'):
                     rt.extend(hits(term[5:]))
+                elif near:
+                    words = re.findall(WORD_REGEXP, near.group(2))
+                    distance = int(near.group(1) or self.NEAR_DISTANCE)
+                    rt.extend(self.search_phrase(session, words, hits,
+                                                 distance=distance))
                 elif term == 'all:mail':
                     rt.extend(range(0, len(self.INDEX)))
                 elif term.startswith('in:'):
@@ -1310,6 +1967,7 @@ class MailIndex:
             self.INDEX_THR = [
                 int(self.get_msg_at_idx_pos(r)[self.MSG_THREAD_MID], 36)
                 for r in keys]
+            self._build_threads()
             for order, by_default, sorter in self.CACHED_SORT_ORDERS:
                 if (not by_default) and not (wanted and order in wanted):
                     continue
@@ -1331,7 +1989,87 @@ class MailIndex:
         finally:
             self._lock.release()
 
-    def sort_results(self, session, results, how):
+    BM25_K1 = 1.2
+    BM25_B = 0.75
+
+    def _relevance_words(self, searchterms):
+        words = []
+        for term in self.merge_phrases(searchterms or []):
+            if term[:1] == '-':
+                continue
+            term = term.lstrip('+').lower()
+            near = self.RE_NEAR_TERM.match(term)
+            if term[:1] == '"':
+                words.extend(term[1:-1].split())
+            elif near:
+                words.extend(re.findall(WORD_REGEXP, near.group(2)))
+            elif term.startswith('body:'):
+                words.append(term[5:])
+            elif ':' not in term:
+                words.append(term)
+        return [w for w in set(words) if w and w not in STOPLIST]
+
+    def sort_by_relevance(self, session, results, searchterms):
+        """
+        Order results by their BM25 score for the keywords in the search
+        terms, most relevant first. Only the best sys.sort_max results
+        are ranked (using a heap), the rest follow in their original order.
+        Our posting lists are unordered sets without counts, so there are
+        no ordered streams to merge: we score the results directly.
+
+        Term frequencies and document lengths come from TermFrequencies,
+        which leaves out words seen only once, so every result is assumed
+        to contain each word at least once. Messages indexed without them
+        are treated as being of average length, which is taken over the
+        results rather than the whole index.
+        """
+        words = self._relevance_words(searchterms)
+        if not words:
+            session.ui.warning(_('No keywords to rank by, sorting by date'))
+            results.sort(key=self.INDEX_SORT['date'].__getitem__)
+            results.reverse()
+            return
+
+        # Inverse document frequency of each word, from the posting lists
+        total = len(self.INDEX)
+        keys, idfs = [], []
+        for word in words:
+            df = len(GlobalPostingList(session, word).hits())
+            keys.append(TermFrequencies.Key(PostingList.WordSig(word,
+                                                                self.config)))
+            idfs.append(math.log(1.0 + (total - df + 0.5) / (df + 0.5)))
+
+        stats = {}
+        lengths = 0
+        for msg_idx_pos in results:
+            tf = TermFrequencies.Load(self.config, msg_idx_pos, keys=keys)
+            if tf is not None:
+                stats[msg_idx_pos] = tf
+                lengths += tf[0]
+        avg_length = float(lengths) / len(stats) if lengths else 1.0
+
+        k1, b = self.BM25_K1, self.BM25_B
+        date_rank = self.INDEX_SORT['date']
+
+        def scored():
+            for msg_idx_pos in results:
+                length, counts = stats.get(msg_idx_pos, (avg_length, {}))
+                norm = k1 * (1 - b + b * length / avg_length)
+                score = 0.0
+                for key, idf in zip(keys, idfs):
+                    tf = counts.get(key, 1)
+                    score += idf * tf * (k1 + 1) / (tf + norm)
+                yield (score, date_rank[msg_idx_pos], msg_idx_pos)
+            play_nice_with_threads()
+
+        ranked = [r[2] for r in heapq.nlargest(self.config.sys.sort_max,
+                                               scored())]
+        if len(ranked) < len(results):
+            top = set(ranked)
+            ranked.extend(r for r in results if r not in top)
+        results[:] = ranked
+
+    def sort_results(self, session, results, how, searchterms=None):
         if not results:
             return
 
@@ -1348,6 +2086,10 @@ class MailIndex:
             elif how.endswith('random'):
                 now = time.time()
                 results.sort(key=lambda k: sha1b64('%s%s' % (now, k)))
+            elif how.endswith('relevance'):
+                if searchterms is None:
+                    searchterms = session.searched
+                self.sort_by_relevance(session, results, searchterms)
             else:
                 did_sort = False
                 for order in self.INDEX_SORT:
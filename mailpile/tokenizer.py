@@ -0,0 +1,108 @@
+"""
+Turning messages into search keywords.
+
+The Keywords class collects the keywords of a single message. Text is
+lowercased and split in one go, every keyword goes straight into a set so
+duplicates are dropped as we go, and the stoplist is applied once at the
+end, instead of building long lists of keywords and filtering them later.
+"""
+from mailpile.mailutils import ExtractEmails
+from mailpile.util import WORD_REGEXP, STOPLIST
+
+
+def Tokenize(text):
+    """
+    Split text into lowercase words.
+
+    >>> Tokenize(u'Hello, World! Hello again.')
+    [u'hello', u'world', u'hello', u'again']
+    """
+    # FIXME: Does this lowercase non-ASCII characters correctly?
+    return WORD_REGEXP.findall(text.lower())
+
+
+class Keywords(object):
+    """
+    The set of search keywords for a single message.
+
+    >>> kw = Keywords()
+    >>> kw.add_text('The quick brown fox and the lazy dog')
+    ['the', 'quick', 'brown', 'fox', 'and', 'the', 'lazy', 'dog']
+    >>> sorted(kw.add_header('list-id', 'The Fox list <fox@example.org>'))
+    ['example', 'fox', 'list', 'org']
+    >>> kw.add('fox:has')
+    >>> 'fox:has' in kw, 'the' in kw
+    (True, True)
+    >>> sorted(k for k in kw.result() if ':' not in k)
+    ['brown', 'dog', 'fox', 'lazy', 'quick']
+    >>> sorted(k for k in kw.result() if k.endswith(':list'))
+    ['example:list', 'fox:list', 'list:list', 'org:list']
+    >>> sorted(k for k in kw.result() if '@' in k)
+    ['fox@example.org:email', 'fox@example.org:list-id']
+    """
+    def __init__(self, stoplist=STOPLIST):
+        self.stoplist = stoplist
+        self.keywords = set()
+
+    def __contains__(self, keyword):
+        return keyword in self.keywords
+
+    def __len__(self):
+        return len(self.keywords)
+
+    def add(self, keyword):
+        self.keywords.add(keyword)
+
+    def extend(self, keywords):
+        self.keywords.update(keywords)
+
+    def add_text(self, text, positions=None):
+        """
+        Add the words of a chunk of text, returning them in order. If a
+        positions list is given, the words are appended to it as well.
+        """
+        words = Tokenize(text)
+        self.keywords.update(words)
+        if positions is not None:
+            positions.extend(words)
+        return words
+
+    def add_words(self, words, suffix):
+        """
+        Add words qualified with a suffix (word:suffix), skipping those on
+        the stoplist. Returns the set of words which were added.
+        """
+        words = set(words)
+        words -= self.stoplist
+        self.keywords.update('%s:%s' % (w, suffix) for w in words)
+        return words
+
+    def add_header(self, name, value):
+        """
+        Add keywords for a (decoded) message header: the words and e-mail
+        addresses it contains, qualified by the header name. Words in
+        mailing-list headers are also added as word:list. Returns the
+        set of words.
+        """
+        name = name.lower()
+        value = value.lower()
+        words = self.add_words(WORD_REGEXP.findall(value), name)
+        for email in ExtractEmails(value):
+            self.keywords.add('%s:%s' % (email, name))
+            self.keywords.add('%s:email' % email)
+        if 'list' in name:
+            self.keywords.update('%s:list' % w for w in words)
+        return words
+
+    def result(self):
+        """Return the final set of keywords, minus the stoplist."""
+        return self.keywords - self.stoplist
+
+
+if __name__ == "__main__":
+    import doctest
+    import sys
+    results = doctest.testmod(optionflags=doctest.ELLIPSIS)
+    print '%s' % (results, )
+    if results.failed:
+        sys.exit(1)
@@ -6,6 +6,7 @@ import cgi
 import datetime
 import distutils
 import hashlib
+import htmlentitydefs
 import locale
 import re
 import subprocess
@@ -548,6 +549,77 @@ class CleanText:
         return unicode(self.clean)
 
 
+HTML_INLINE_TAGS = set(['a', 'abbr', 'b', 'big', 'em', 'font', 'i',
+                        'small', 'span', 'strong', 'sub', 'sup', 'u'])
+
+RE_HTML_TOKENS = re.compile(r'<!--.*?(?:-->|\Z)'
+                            r'|<(script|style)\b.*?(?:</\1\s*>|\Z)'
+                            r'|</?([a-z][a-z0-9:-]*)[^>]*>?'
+                            r'|<[!?][^>]*>?'
+                            r'|&(#[0-9]+|#x[0-9a-f]+|[a-z][a-z0-9]*);?',
+                            re.DOTALL | re.IGNORECASE)
+
+
+def _html_token(m):
+    script, tag, entity = m.groups()
+    if entity:
+        if entity[:2].lower() == '#x':
+            cp = int(entity[2:], 16)
+        elif entity[:1] == '#':
+            cp = int(entity[1:])
+        else:
+            cp = htmlentitydefs.name2codepoint.get(entity)
+            if cp is None:
+                return m.group(0)
+        if cp == 0xa0:
+            return ' '
+        elif cp == 0 or cp > 0x10ffff or 0xd800 <= cp <= 0xdfff:
+            # Not a character, replace it (U+FFFD if we can)
+            if isinstance(m.string, unicode):
+                return u'\ufffd'
+        elif isinstance(m.string, unicode):
+            try:
+                return unichr(cp)
+            except (ValueError, OverflowError):
+                # Narrow Python builds can't do astral planes
+                return u'\ufffd'
+        elif cp < 128:
+            return chr(cp)
+        return ' '
+    elif tag and tag.lower() in HTML_INLINE_TAGS:
+        return ''
+    else:
+        return ' '
+
+
+def HtmlToText(html, max_bytes=None):
+    """
+    Quickly extract the text from a chunk of HTML for indexing, in a
+    single pass which drops tags, comments, scripts and styles and
+    decodes entities. Only the first max_bytes of the HTML are used.
+    This is far less careful than a real parser, but it never fails.
+
+    >>> HtmlToText('<p>Hello <b>W</b>orld &amp; <i>friends</i></p>')
+    ' Hello World & friends '
+    >>> HtmlToText('<style>p {}</style>A<!-- hidden -->B<br>C &bogus;')
+    ' A B C &bogus;'
+    >>> HtmlToText(u'Caf&eacute;&nbsp;au&#32;lait<scr')
+    u'Caf\\xe9 au lait '
+    >>> HtmlToText('<p>Hello world</p>', max_bytes=8)
+    ' Hello'
+
+    Numeric entities which are not characters are replaced:
+
+    >>> HtmlToText(u'a&#99999999999999999999;b&#xD800;c&#0;d')
+    u'a\\ufffdb\\ufffdc\\ufffdd'
+    >>> HtmlToText('a&#99999999999999999999;b&#xD800;c&#0;d')
+    'a b c d'
+    """
+    if max_bytes is not None:
+        html = html[:max_bytes]
+    return re.sub(RE_HTML_TOKENS, _html_token, html)
+
+
 def HideBinary(text):
     try:
         text.decode('utf-8')
@@ -1,3 +1,5 @@
+import Queue
+import sys
 import threading
 import time
 from gettext import gettext as _
@@ -251,6 +253,217 @@ class DumbWorker(Worker):
         pass
 
 
+class PipelineStage(threading.Thread):
+    """
+    One stage of a Pipeline: a thread which runs a function over the
+    items from its input queue and puts the results on its output queue.
+    """
+
+    def __init__(self, pipeline, name, func, source, outq):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.pipeline = pipeline
+        self.name = name
+        self.func = func
+        self.source = source
+        self.outq = outq
+        self.error = None
+        self.count = 0
+        self.elapsed = 0.0
+        self.waiting = 0.0
+        self.depth_max = 0
+        self.depth_total = 0
+
+    def _input(self):
+        if not isinstance(self.source, Queue.Queue):
+            for item in self.source:
+                if self.pipeline.stopped:
+                    break
+                yield item
+            return
+        while not self.pipeline.stopped:
+            t0 = time.time()
+            try:
+                item = self.source.get(timeout=1)
+            except Queue.Empty:
+                continue
+            finally:
+                self.waiting += time.time() - t0
+            if item is Pipeline.END:
+                break
+            yield item
+
+    def _output(self, item):
+        t0 = time.time()
+        try:
+            while not self.pipeline.stopped:
+                try:
+                    self.outq.put(item, timeout=1)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+        finally:
+            self.waiting += time.time() - t0
+
+    def run(self):
+        t0 = time.time()
+        items = self.func(self._input())
+        try:
+            for item in items:
+                depth = self.outq.qsize()
+                self.depth_max = max(self.depth_max, depth)
+                self.depth_total += depth
+                self.count += 1
+                if not self._output(item):
+                    break
+        except:
+            self.error = sys.exc_info()
+        finally:
+            # Let the stage function clean up now, not whenever the
+            # generator gets garbage collected.
+            if hasattr(items, 'close'):
+                items.close()
+            self.elapsed = time.time() - t0
+            self._output(Pipeline.END)
+
+    def stats(self):
+        busy = max(0.0, self.elapsed - self.waiting)
+        return {
+            'stage': self.name,
+            'count': self.count,
+            'busy': busy,
+            'rate': self.count / busy if busy else 0.0,
+            'queue_max': self.depth_max,
+            'queue_avg': float(self.depth_total) / (self.count or 1)
+        }
+
+
+class Pipeline(object):
+    """
+    A chain of stages, each running in its own thread and connected to
+    the next by a bounded queue, so slow stages (disk reads, parsing)
+    overlap with each other. Iterating over the pipeline yields the
+    output of the last stage; whoever does that is the final stage.
+
+    Each stage function takes an iterator and yields results, which lets
+    a stage batch, filter or fan out its work. Per-stage throughput and
+    queue depths are available from stats() and summary().
+
+    >>> p = Pipeline('test', range(0, 10), [
+    ...     ('double', Pipeline.Map(lambda i: i * 2)),
+    ...     ('odd', Pipeline.Map(lambda i: (i % 4) and i or None))])
+    >>> list(p)
+    [2, 6, 10, 14, 18]
+    >>> [(s['stage'], s['count']) for s in p.stats()]
+    [('double', 10), ('odd', 5), ('consumer', 5)]
+
+    Stopping a pipeline early waits for its stages to finish:
+
+    >>> p = Pipeline('test', xrange(0, 1000), [
+    ...     ('slow', Pipeline.Map(lambda i: time.sleep(0.01) or i))])
+    >>> p.stop(), [stage.is_alive() for stage in p.stages]
+    (True, [False])
+    """
+
+    END = object()
+    STOP_TIMEOUT = 10
+
+    def __init__(self, name, source, stages, queue_size=100,
+                 consumer='consumer'):
+        """
+        Create and start a pipeline.
+
+        Keyword arguments:
+        name -- The name of the pipeline, used in summaries
+        source -- An iterable of items to feed the first stage
+        stages -- A list of (name, function) pairs
+        queue_size -- How many items may wait between two stages
+        consumer -- What to call the final stage in stats
+        """
+        self.name = name
+        self.consumer = consumer
+        self.stopped = False
+        self.stages = []
+        self.consumed = 0
+        self.consumer_elapsed = 0.0
+        self.consumer_waiting = 0.0
+        for stage_name, func in stages:
+            outq = Queue.Queue(queue_size)
+            self.stages.append(PipelineStage(self, stage_name, func,
+                                             source, outq))
+            source = outq
+        for stage in self.stages:
+            stage.start()
+
+    @classmethod
+    def Map(cls, func):
+        """Make a stage function which applies func to every item,
+        dropping any item for which it returns None."""
+        def stage(items):
+            for item in items:
+                result = func(item)
+                if result is not None:
+                    yield result
+        return stage
+
+    def __iter__(self):
+        t0 = time.time()
+        outq = self.stages[-1].outq
+        try:
+            while not self.stopped:
+                t1 = time.time()
+                try:
+                    item = outq.get(timeout=1)
+                except Queue.Empty:
+                    continue
+                finally:
+                    self.consumer_waiting += time.time() - t1
+                if item is self.END:
+                    break
+                self.consumed += 1
+                yield item
+        finally:
+            self.consumer_elapsed = time.time() - t0
+            self.stop()
+        for stage in self.stages:
+            if stage.error:
+                raise stage.error[0], stage.error[1], stage.error[2]
+
+    def stop(self, timeout=None):
+        """
+        Stop all the stages, discarding anything still in flight, and wait
+        up to timeout seconds (STOP_TIMEOUT by default) for their threads
+        to finish. Returns True if they all did.
+        """
+        self.stopped = True
+        deadline = time.time() + (self.STOP_TIMEOUT if (timeout is None)
+                                  else timeout)
+        for stage in self.stages:
+            if stage is not threading.current_thread():
+                stage.join(max(0, deadline - time.time()))
+        return not [s for s in self.stages if s.is_alive()]
+
+    def stats(self):
+        stats = [stage.stats() for stage in self.stages]
+        busy = max(0.0, self.consumer_elapsed - self.consumer_waiting)
+        stats.append({
+            'stage': self.consumer,
+            'count': self.consumed,
+            'busy': busy,
+            'rate': self.consumed / busy if busy else 0.0,
+            'queue_max': 0,
+            'queue_avg': 0.0
+        })
+        return stats
+
+    def summary(self):
+        return '%s: %s' % (self.name, ', '.join([
+            ('%(stage)s %(count)d in %(busy).2fs (%(rate).1f/s, '
+             'queue %(queue_avg).1f/%(queue_max)d)') % s
+            for s in self.stats()]))
+
+
 if __name__ == "__main__":
     import doctest
     import sys
@@ -107,7 +107,7 @@ class ViewMetadata(Hacks):
             'subject': info[idx.MSG_SUBJECT],
             'body': info[idx.MSG_BODY],
             'tags': info[idx.MSG_TAGS],
-            'replies': info[idx.MSG_REPLIES],
+            'replies': ','.join(b36(r) for r in idx.get_thread(i)),
             'thread_mid': info[idx.MSG_THREAD_MID],
         }
 
@@ -0,0 +1,454 @@
+#!/usr/bin/env python2
+#
+# This script benchmarks parts of Mailpile against a synthetic corpus,
+# made by scaling up the test messages found in `testing/`.
+#
+# Usage: mailpile-benchmark.py [-n <copies>] [<benchmark> ...]
+#
+# Each copy of the corpus gets fresh Message-IDs, so nothing is treated
+# as a duplicate. Without arguments, all the benchmarks are run.
+#
+import cPickle
+import mailbox
+import multiprocessing
+import os
+import re
+import shutil
+import StringIO
+import sys
+import tempfile
+import time
+
+import lxml.html
+
+
+# Set up some paths
+mailpile_root = os.path.join(os.path.dirname(__file__), '..')
+mailpile_test = os.path.join(mailpile_root, 'testing')
+mailpile_gpgh = os.path.join(mailpile_test, 'gpg-keyring')
+
+# Set the GNUGPHOME variable to our test key
+os.environ['GNUPGHOME'] = mailpile_gpgh
+
+# Add the root to our import path, import API
+sys.path.append(mailpile_root)
+import mailpile.crypto.streamer
+from mailpile import Mailpile
+from mailpile.mailboxes.maildir import MailpileMailbox as MaildirMailbox
+from mailpile.mailboxes.mbox import MailpileMailbox
+from mailpile.mailboxes.wervd import MailpileMailbox as WervdMailbox
+from mailpile.mailutils import ExtractEmails, ParseMessage
+from mailpile.postinglist import GlobalPostingList, JournalFlusher
+from mailpile.search import CachedSearchResultSet, MailIndex
+from mailpile.tokenizer import Keywords
+from mailpile.ui import SilentInteraction
+from mailpile.util import *
+
+
+##[ Helpers ]#################################################################
+
+BENCHMARKS = []
+RE_MESSAGE_ID = re.compile('^Message-ID:[^\n]*\n', re.IGNORECASE | re.M)
+
+
+def benchmark(name):
+    def register(func):
+        BENCHMARKS.append((name, func))
+        return func
+    return register
+
+
+def say(stuff):
+    sys.stdout.write('%s\n' % stuff)
+    sys.stdout.flush()
+
+
+def test_messages():
+    messages = []
+    maildir = os.path.join(mailpile_test, 'Maildir', 'cur')
+    for fn in sorted(os.listdir(maildir)):
+        if not fn.endswith('.mbx'):
+            messages.append(open(os.path.join(maildir, fn), 'rb').read())
+    for msg in mailbox.mbox(os.path.join(mailpile_test, 'tests.mbx')):
+        messages.append(msg.as_string())
+    return messages
+
+
+def make_mbox(path, copies):
+    """Write the test corpus to an mbox, copies times over."""
+    messages = test_messages()
+    with open(path, 'wb') as fd:
+        for copy in range(0, copies):
+            for i, msg in enumerate(messages):
+                msg_id = 'Message-ID: <bench-%d-%d@mailpile>\n' % (copy, i)
+                msg = re.sub(RE_MESSAGE_ID, '', msg.replace('\r\n', '\n'))
+                msg = re.sub('\n(>*From )', '\n>\\1', msg)
+                fd.write('From bench@mailpile Thu Jan  1 00:00:00 1970\n')
+                fd.write(msg_id)
+                fd.write(msg.rstrip('\n'))
+                fd.write('\n\n')
+    return copies * len(messages)
+
+
+def make_maildir(path, count):
+    """Write count small messages to a Maildir, spread over cur and new."""
+    mbx = mailbox.Maildir(path, factory=None, create=True)
+    for i in range(0, count):
+        subdir = 'new' if (i % 10 == 0) else 'cur'
+        fn = os.path.join(path, subdir, '%d.bench%d.mailpile' % (i, i))
+        with open(fn, 'wb') as fd:
+            fd.write('Message-ID: <bench-%d@mailpile>\n'
+                     'Subject: Message %d\n\nHello!\n' % (i, i))
+    return count
+
+
+def new_mailpile(workdir, settings):
+    mp = Mailpile(workdir=workdir, ui=SilentInteraction)
+    for setting in settings:
+        mp.set(setting)
+    return mp
+
+
+def timed(func, *args, **kwargs):
+    t0 = time.time()
+    rv = func(*args, **kwargs)
+    return time.time() - t0, rv
+
+
+def du(path):
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for fn in filenames:
+            total += os.path.getsize(os.path.join(dirpath, fn))
+    return total
+
+
+def index_corpus(tmpdir, name, mbox, settings, searches=[]):
+    """Index the corpus in a fresh workdir and time some searches."""
+    workdir = os.path.join(tmpdir, name)
+    mp = new_mailpile(workdir, settings)
+    mp.add(mbox)
+    elapsed, rv = timed(mp.rescan)
+    messages = len(mp._config.index.INDEX)
+    say('%-22s indexed %d messages in %.2fs (%.1f msgs/s)'
+        % (name, messages, elapsed, messages / max(elapsed, 0.001)))
+    for terms in searches:
+        # First search warms up the posting lists, the second is what we
+        # report (with the result cache dropped so we measure the search).
+        timed(mp.search, *terms)
+        CachedSearchResultSet.DropCaches()
+        elapsed, rv = timed(mp.search, *terms)
+        say('%-22s %-40s %5d results in %.4fs'
+            % (name, ' '.join(terms), rv.result['stats']['count'], elapsed))
+    return mp, workdir
+
+
+##[ Benchmarks ]##############################################################
+
+@benchmark('positions')
+def bench_positions(tmpdir, mbox):
+    """Index growth and query latency of positional (phrase) search."""
+    searches = [['masculinity', 'research'],
+                ['"masculinity research"'],
+                ['near:emerging,research'],
+                ['"research masculinity"']]
+    for name, settings in (('without-positions', []),
+                           ('with-positions', ['prefs.index_positions=true'])):
+        mp, workdir = index_corpus(tmpdir, name, mbox, settings,
+                                   searches=searches)
+        say('%-22s search index: %d bytes, positions: %d bytes'
+            % (name,
+               du(os.path.join(workdir, 'search')),
+               du(os.path.join(workdir, 'positions'))))
+
+
+@benchmark('relevance')
+def bench_relevance(tmpdir, mbox):
+    """Index growth and sort latency of BM25 relevance ordering."""
+    for name, settings in (('without-termfreq', []),
+                           ('with-termfreq',
+                            ['prefs.index_relevance=true'])):
+        mp, workdir = index_corpus(tmpdir, name, mbox, settings)
+        say('%-22s search index: %d bytes, term frequencies: %d bytes'
+            % (name,
+               du(os.path.join(workdir, 'search')),
+               du(os.path.join(workdir, 'termfreq'))))
+        idx, session = mp._config.index, mp._session
+        for terms in (['twitter'], ['masculinity', 'research']):
+            results = list(idx.search(session, terms).as_set())
+            for order in ('flat-date', 'flat-relevance'):
+                r = results[:]
+                elapsed, rv = timed(idx.sort_results, session, r, order, terms)
+                say('%-22s %-40s %5d results in %.4fs'
+                    % (name, '%s (%s)' % (' '.join(terms), order),
+                       len(r), elapsed))
+
+
+@benchmark('rescan')
+def bench_rescan(tmpdir, mbox):
+    """Serial versus multi-process rescanning of a large mailbox."""
+    processes = max(2, multiprocessing.cpu_count())
+    indexes = []
+    for name, settings in (('serial', ['sys.scan_processes=1']),
+                           ('parallel-%d' % processes,
+                            ['sys.scan_processes=%d' % processes])):
+        mp, workdir = index_corpus(tmpdir, name, mbox, settings)
+        idx = mp._config.index
+        for mailbox_idx, stats in idx.scan_stats.iteritems():
+            for s in stats:
+                say('%-22s %-8s %5d msgs, busy %6.2fs, %7.1f/s, queue %.1f/%d'
+                    % (name, s['stage'], s['count'], s['busy'], s['rate'],
+                       s['queue_avg'], s['queue_max']))
+        # Dates of messages without a Date: header depend on the clock,
+        # so we leave those out of the comparison.
+        indexes.append([idx.get_msg_at_idx_pos(i)[idx.MSG_FROM:]
+                        for i in range(0, len(idx.INDEX))])
+    say('%-22s %s' % ('same index', indexes[0] == indexes[1]))
+
+
+@benchmark('flush')
+def bench_flush(tmpdir, mbox):
+    """Rescan speed with different keyword journal flush budgets."""
+    for name, settings in (('flush-words-only', ['sys.journal_flush_kb=0',
+                                                 'sys.journal_flush_secs=0']),
+                           ('flush-default', []),
+                           ('flush-16mb-only', ['sys.journal_flush_words=0',
+                                                'sys.journal_flush_secs=0']),
+                           ('flush-every-256kb', ['sys.journal_flush_kb=256'])
+                           ):
+        mp, workdir = index_corpus(tmpdir, name, mbox,
+                                   settings + ['sys.scan_processes=1'],
+                                   searches=[['masculinity', 'research']])
+
+    # What the scan loop pays per message just to decide whether to flush:
+    # the old lazy Optimize() call versus asking the flusher.
+    idx, session = mp._config.index, mp._session
+    flusher = JournalFlusher(session, idx)
+    checks = 100000
+    for name, check in (('check-optimize-lazy',
+                         lambda: GlobalPostingList.Optimize(
+                             session, idx, lazy=True, quick=True)),
+                        ('check-flusher', flusher.check)):
+        elapsed, rv = timed(lambda: [check() for i in xrange(0, checks)])
+        say('%-22s %.2fus per message' % (name, elapsed * 10**6 / checks))
+
+
+@benchmark('toc')
+def bench_toc(tmpdir, mbox):
+    """Mailbox table-of-contents building, caching and incremental updates."""
+    size = os.path.getsize(mbox)
+    for name, cls in (('mailbox.mbox', mailbox.mbox),
+                      ('mmap', MailpileMailbox)):
+        elapsed, keys = timed(lambda: cls(mbox).keys())
+        say('%-22s %6d messages in %.4fs (%.1f MB/s)'
+            % (name, len(keys), elapsed, size / max(elapsed, 0.001) / 2**20))
+
+    # Saving and loading the mailbox state: old pickles versus TOC cache.
+    copy = os.path.join(tmpdir, 'toc-copy.mbx')
+    shutil.copyfile(mbox, copy)
+    mbx = MailpileMailbox(copy)
+    count = len(mbx.keys())
+    elapsed, data = timed(cPickle.dumps, mbx, 0)
+    say('%-22s %8d bytes, saved in %.4fs, loaded in %.4fs'
+        % ('pickle (protocol 0)', len(data), elapsed,
+           timed(cPickle.loads, data)[0]))
+    elapsed, (full, data) = timed(mbx.get_toc_chunk)
+    say('%-22s %8d bytes, saved in %.4fs, loaded in %.4fs'
+        % ('TOC cache', len(data), elapsed,
+           timed(MailpileMailbox.FromTocCache, data)[0]))
+
+    # Append a tenth of the mailbox to the copy and time the update.
+    with open(mbox, 'rb') as src:
+        tail = src.read(size // 10)
+        tail = tail[:tail.rfind('\nFrom ') + 1]
+    with open(copy, 'ab') as fd:
+        fd.write(tail)
+    elapsed, rv = timed(mbx.update_toc)
+    say('%-22s %6d new messages in %.4fs'
+        % ('mmap update_toc', len(mbx.keys()) - count, elapsed))
+    elapsed, (full, chunk) = timed(mbx.get_toc_chunk)
+    say('%-22s %8d bytes, saved in %.4fs, loaded in %.4fs'
+        % ('TOC cache increment', len(chunk), elapsed,
+           timed(MailpileMailbox.FromTocCache, data + chunk)[0]))
+
+    elapsed, rv = timed(lambda: [mbx.get_string(k) for k in mbx.keys()])
+    say('%-22s %6d messages in %.4fs' % ('mmap get_string', len(rv), elapsed))
+
+
+@benchmark('maildir')
+def bench_maildir(tmpdir, mbox):
+    """Maildir listing and change detection on 100k files."""
+    path = os.path.join(tmpdir, 'Maildir')
+    files = make_maildir(path, 100000)
+    parsed = {}
+
+    def stdlib_unparsed(mbx):
+        return [k for k in mbx.keys() if k not in parsed]
+
+    old, new = mailbox.Maildir(path, factory=None), MaildirMailbox(path)
+    for name, func in (('mailbox.Maildir', lambda: stdlib_unparsed(old)),
+                       ('mailpile', new.unparsed)):
+        elapsed, rv = timed(func)
+        say('%-22s %6d unparsed of %d files in %.4fs'
+            % (name, len(rv), files, elapsed))
+    for key in new.keys():
+        parsed[key] = True
+        new.mark_parsed(key)
+
+    # Deliver a few messages, then look for changes. We pretend the last
+    # read was long ago, so both trust the directory mtimes.
+    for step in ('unchanged', 'delivered 10'):
+        if step != 'unchanged':
+            for i in range(0, 10):
+                new.add('Subject: %d\n\nHello\n' % i)
+        for name, mbx, func in (
+                ('mailbox.Maildir', old, lambda: stdlib_unparsed(old)),
+                ('mailpile', new, new.unparsed)):
+            mbx._last_read = 0
+            elapsed, rv = timed(func)
+            say('%-22s %-14s %6d unparsed in %.4fs'
+                % (name, step, len(rv), elapsed))
+
+
+@benchmark('ptrs')
+def bench_ptrs(tmpdir, mbox):
+    """Verifying message pointers, one at a time vs. batched and cached."""
+    mbx = MailpileMailbox(mbox)
+    ptrs = [mbx.get_msg_ptr('0000', k) for k in mbx.keys()]
+    for name, cold, func in (
+            ('get_file_by_ptr', True, lambda: [mbx.get_file_by_ptr(p)
+                                               for p in ptrs]),
+            ('verify_ptrs (cold)', True, lambda: mbx.verify_ptrs(ptrs)),
+            ('verify_ptrs (cached)', False, lambda: mbx.verify_ptrs(ptrs))):
+        if cold:
+            mbx._cs_cache = {}
+        elapsed, rv = timed(func)
+        say('%-22s %6d pointers in %.4fs' % (name, len(rv), elapsed))
+
+
+@benchmark('wervd')
+def bench_wervd(tmpdir, mbox):
+    """Adding and reading encrypted messages, coprocess vs. in-process."""
+    streamer = mailpile.crypto.streamer
+    messages = [m.as_string() for m in mailbox.mbox(mbox)][:500]
+    for name, inline in (('openssl coprocess', False),
+                         ('in-process', True)):
+        if inline and not streamer.EVPCipher.Available():
+            say('%-22s libcrypto not found' % name)
+            continue
+        avail = streamer.EVPCipher.Available
+        streamer.EVPCipher.Available = classmethod(lambda cls: inline)
+        try:
+            path = os.path.join(tmpdir, 'wervd-%s' % inline)
+            mbx = WervdMailbox(path)
+            mbx._encryption_key_func = lambda: 'benchmark key'
+            elapsed, keys = timed(lambda: [mbx.add(m) for m in messages])
+            say('%-22s added %d messages in %.2fs'
+                % (name, len(keys), elapsed))
+            elapsed, rv = timed(lambda: [mbx.get_file(k).read()
+                                         for k in keys])
+            say('%-22s read %d messages in %.2fs'
+                % (name, len(rv), elapsed))
+            for fsync in (False, True) if inline else ():
+                elapsed, keys = timed(mbx.add_many, messages, fsync=fsync)
+                say('%-22s add_many %d messages in %.2fs (fsync=%s)'
+                    % (name, len(keys), elapsed, fsync))
+        finally:
+            streamer.EVPCipher.Available = avail
+
+
+
+@benchmark('html')
+def bench_html(tmpdir, mbox):
+    """Extracting text from HTML parts for indexing, lxml vs. HtmlToText."""
+    parts = []
+    for msg in mailbox.mbox(mbox):
+        for part in msg.walk():
+            if part.get_content_type() == 'text/html':
+                parts.append(part.get_payload(None, True).decode('utf-8',
+                                                                 'replace'))
+    # Plus one huge marketing e-mail
+    parts.append(u'<html><body>%s</body></html>' % ''.join(parts[:100]))
+    size = sum(len(p) for p in parts)
+    text_content = lambda p: lxml.html.fromstring(p).text_content()
+    for name, func in (
+            ('lxml text_content', text_content),
+            ('HtmlToText', HtmlToText),
+            ('HtmlToText (64KB)', lambda p: HtmlToText(p, max_bytes=65536))):
+        elapsed, rv = timed(lambda: [func(p) for p in parts])
+        say('%-22s %d parts, %.1fMB in %.2fs (%.1f MB/s)'
+            % (name, len(rv), size / 1048576.0, elapsed,
+               size / 1048576.0 / max(elapsed, 0.001)))
+
+
+
+@benchmark('keywords')
+def bench_keywords(tmpdir, mbox):
+    """Extracting keywords from headers, list-and-filter vs. Keywords."""
+    mp = new_mailpile(os.path.join(tmpdir, 'keywords'), [])
+    session, idx = mp._session, MailIndex(mp._config)
+    messages = [ParseMessage(StringIO.StringIO(m.as_string()),
+                             pgpmime=False)
+                for m in mailbox.mbox(mbox)][:2000]
+
+    def list_and_filter(msg):
+        # This is how read_message used to do it
+        keywords = []
+        for key in msg.keys():
+            key_lower = key.lower()
+            if key_lower not in BORING_HEADERS:
+                emails = ExtractEmails(idx.hdr(msg, key).lower())
+                words = set(re.findall(WORD_REGEXP,
+                                       idx.hdr(msg, key).lower()))
+                words -= STOPLIST
+                keywords.extend(['%s:%s' % (t, key_lower) for t in words])
+                keywords.extend(['%s:%s' % (e, key_lower) for e in emails])
+                keywords.extend(['%s:email' % e for e in emails])
+                if 'list' in key_lower:
+                    keywords.extend(['%s:list' % t for t in words])
+        return len(keywords), set(keywords) - STOPLIST
+
+    def keywords_set(msg):
+        headers, keywords = {}, Keywords()
+        for key in msg.keys():
+            key_lower = key.lower()
+            if key_lower not in headers and key_lower not in BORING_HEADERS:
+                headers[key_lower] = idx.hdr(msg, key)
+        for key, value in headers.iteritems():
+            keywords.add_header(key, value)
+        return len(keywords), keywords.result()
+
+    for name, func in (('list-and-filter', list_and_filter),
+                       ('Keywords', keywords_set)):
+        elapsed, rv = timed(lambda: [func(m) for m in messages])
+        built = sum(b for b, k in rv)
+        say('%-22s %d messages in %.2fs (%.2fms/msg), %.1f keyword'
+            ' strings built per message'
+            % (name, len(rv), elapsed, 1000 * elapsed / len(rv),
+               float(built) / len(rv)))
+    elapsed, rv = timed(lambda: [idx.read_message(session, 'x', 'x', m, 0, 0)
+                                 for m in messages])
+    say('%-22s %d messages in %.2fs (%.2fms/msg)'
+        % ('read_message', len(rv), elapsed, 1000 * elapsed / len(rv)))
+
+
+##[ Main ]####################################################################
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    copies = 100
+    if args and args[0] == '-n':
+        copies = int(args[1])
+        args = args[2:]
+
+    tmpdir = tempfile.mkdtemp(prefix='mailpile-benchmark-')
+    try:
+        mbox = os.path.join(tmpdir, 'corpus.mbx')
+        say('Generated %d messages in %s'
+            % (make_mbox(mbox, copies), mbox))
+        for name, func in BENCHMARKS:
+            if not args or name in args:
+                say('\n== %s: %s' % (name, func.__doc__))
+                func(tmpdir, mbox)
+    finally:
+        shutil.rmtree(tmpdir)
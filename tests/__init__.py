@@ -47,6 +47,8 @@ def _initialize_mailpile_for_testing(workdir, test_data):
     mp = mailpile.Mailpile(session=session)
     session.config.plugins.load('demos')
     mp.set('prefs.index_encrypted=true')
+    mp.set('prefs.index_positions=true')
+    mp.set('prefs.index_relevance=true')
 
     # Add some mail, scan it.
     # Create local mailboxes
@@ -0,0 +1,189 @@
+"""
+A tiny in-process IMAP server, just smart enough to test our IMAP code.
+
+It serves a single account with any number of folders, supports LOGIN,
+SELECT/EXAMINE, NOOP, STATUS and UID FETCH/SEARCH/STORE, and counts the
+commands it receives so tests can check how chatty the client is.
+"""
+import re
+import SocketServer
+import threading
+
+
+class FakeFolder(object):
+    def __init__(self, uidvalidity=1):
+        self.uidvalidity = uidvalidity
+        self.uidnext = 1
+        self.messages = []  # (uid, data) tuples
+
+    def append(self, data):
+        self.messages.append((self.uidnext, data))
+        self.uidnext += 1
+        return self.uidnext - 1
+
+    def expunge(self, uid):
+        self.messages = [(u, d) for u, d in self.messages if u != uid]
+
+    def uids(self, uid_set):
+        """Return the (seq, uid, data) of messages matching a UID set."""
+        if not self.messages:
+            return []
+        highest = self.messages[-1][0]
+        wanted = set()
+        for part in uid_set.split(','):
+            if ':' in part:
+                lo, hi = [highest if (p == '*') else int(p)
+                          for p in part.split(':')]
+                lo, hi = min(lo, hi), max(lo, hi)
+                wanted |= set(u for u, d in self.messages if lo <= u <= hi)
+                if part.endswith('*'):
+                    wanted.add(highest)
+            else:
+                wanted.add(highest if (part == '*') else int(part))
+        return [(i + 1, u, d) for i, (u, d) in enumerate(self.messages)
+                if u in wanted]
+
+
+class FakeIMAPHandler(SocketServer.StreamRequestHandler):
+    RE_COMMAND = re.compile(r'^(\S+) (UID )?(\S+)\s*(.*)$')
+
+    def send(self, line):
+        self.wfile.write(line + '\r\n')
+
+    def handle(self):
+        server = self.server
+        self.folder = None
+        self.seen = []
+        self.send('* OK Fake IMAP ready')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            m = self.RE_COMMAND.match(line.strip())
+            if not m:
+                self.send('* BAD Syntax error')
+                continue
+            tag, uid, command, args = m.groups()
+            command = ('UID ' if uid else '') + command.upper()
+            server.commands.append(command)
+            handler = getattr(self, 'do_' + command.replace(' ', '_'), None)
+            if handler is None:
+                self.send('%s BAD Unknown command' % tag)
+            elif handler(tag, args) is False:
+                return
+
+    def _folder_name(self, args):
+        return args.split(' ')[0].strip('"')
+
+    def do_CAPABILITY(self, tag, args):
+        self.send('* CAPABILITY IMAP4rev1')
+        self.send('%s OK CAPABILITY completed' % tag)
+
+    def do_LOGIN(self, tag, args):
+        user, password = [a.strip('"') for a in args.split(' ', 1)]
+        if (user, password) == (self.server.user, self.server.password):
+            self.server.logins += 1
+            self.send('%s OK LOGIN completed' % tag)
+        else:
+            self.send('%s NO LOGIN failed' % tag)
+
+    def do_NOOP(self, tag, args):
+        if self.folder is not None:
+            if self.folder.uidvalidity != self.uidvalidity:
+                # Like many real servers, we give up on the client.
+                self.send('* BYE UIDVALIDITY changed')
+                return False
+            uids = [u for u, d in self.folder.messages]
+            for seq in reversed(range(0, len(self.seen))):
+                if self.seen[seq] not in uids:
+                    self.send('* %d EXPUNGE' % (seq + 1))
+                    del self.seen[seq]
+            if len(uids) != len(self.seen):
+                self.send('* %d EXISTS' % len(uids))
+            self.seen = uids
+        self.send('%s OK NOOP completed' % tag)
+
+    def do_LOGOUT(self, tag, args):
+        self.send('* BYE Logging out')
+        self.send('%s OK LOGOUT completed' % tag)
+        return False
+
+    def do_CLOSE(self, tag, args):
+        self.folder = None
+        self.seen = []
+        self.send('%s OK CLOSE completed' % tag)
+
+    def do_SELECT(self, tag, args):
+        folder = self.server.folders.get(self._folder_name(args))
+        if folder is None:
+            self.send('%s NO No such folder' % tag)
+            return
+        self.folder = folder
+        self.seen = [u for u, d in folder.messages]
+        self.uidvalidity = folder.uidvalidity
+        self.send('* %d EXISTS' % len(folder.messages))
+        self.send('* 0 RECENT')
+        self.send('* OK [UIDVALIDITY %d] UIDs valid' % folder.uidvalidity)
+        self.send('* OK [UIDNEXT %d] Predicted next UID' % folder.uidnext)
+        self.send('%s OK [READ-WRITE] SELECT completed' % tag)
+
+    do_EXAMINE = do_SELECT
+
+    def do_STATUS(self, tag, args):
+        name = self._folder_name(args)
+        folder = self.server.folders.get(name)
+        if folder is None:
+            self.send('%s NO No such folder' % tag)
+            return
+        self.send('* STATUS "%s" (MESSAGES %d UIDNEXT %d UIDVALIDITY %d)'
+                  % (name, len(folder.messages), folder.uidnext,
+                     folder.uidvalidity))
+        self.send('%s OK STATUS completed' % tag)
+
+    def do_UID_SEARCH(self, tag, args):
+        self.send('* SEARCH %s' % ' '.join(str(u) for u, d
+                                           in self.folder.messages))
+        self.send('%s OK SEARCH completed' % tag)
+
+    def do_UID_STORE(self, tag, args):
+        self.send('%s OK STORE completed' % tag)
+
+    def do_UID_FETCH(self, tag, args):
+        uid_set, items = args.split(' ', 1)
+        for seq, uid, data in self.folder.uids(uid_set):
+            parts = ['UID %d' % uid]
+            if 'RFC822.SIZE' in items:
+                parts.append('RFC822.SIZE %d' % len(data))
+            if 'BODY.PEEK[]' in items:
+                self.server.bodies_sent += 1
+                self.wfile.write('* %d FETCH (%s BODY[] {%d}\r\n%s)\r\n'
+                                 % (seq, ' '.join(parts), len(data), data))
+            else:
+                self.send('* %d FETCH (%s)' % (seq, ' '.join(parts)))
+        self.send('%s OK FETCH completed' % tag)
+
+
+class FakeIMAPServer(SocketServer.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, user='user', password='pass'):
+        SocketServer.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0),
+                                                 FakeIMAPHandler)
+        self.user = user
+        self.password = password
+        self.folders = {'INBOX': FakeFolder()}
+        self.commands = []
+        self.logins = 0
+        self.bodies_sent = 0
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -107,6 +107,31 @@ class TestCommandResult(MailPileUnittest):
         self.assertGreater(res.as_html(), 0)
 
 
+class TestView(MailPileUnittest):
+    def test_view_caches_messages(self):
+        trees = self.config.index.MSG_TREES
+        first = self.mp.view('=5').as_dict()
+        hits = trees.hits
+        again = self.mp.view('=5').as_dict()
+        self.assertEqual(trees.hits, hits + 1)
+        self.assertEqual(again['result']['data']['messages'],
+                         first['result']['data']['messages'])
+
+        # Tagging the message makes us render it again
+        self.mp.tag('-inbox', '=5')
+        self.mp.view('=5')
+        self.assertEqual(trees.hits, hits + 1)
+        self.mp.tag('+inbox', '=5')
+
+    def test_view_drops_mime_parts(self):
+        messages = self.mp.view('=1').as_dict()['result']['data']['messages']
+        attachments = messages['1']['attachments']
+        self.assertEqual(len(attachments), 3)
+        for att in attachments:
+            self.assertFalse('part' in att)
+            self.assertTrue(att['length'] > 0)
+
+
 class TestTagging(MailPileUnittest):
     def test_addtag(self):
         pass
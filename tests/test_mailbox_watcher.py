@@ -0,0 +1,57 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import mailpile.app
+import mailpile.defaults
+from mailpile.plugins.mailbox_watcher import Inotify, MailboxWatcher
+from mailpile.ui import Session, SilentInteraction
+from mailpile.workers import Worker
+
+
+class TestMailboxWatcher(unittest.TestCase):
+    def setUp(self):
+        try:
+            Inotify().close()
+        except (AttributeError, OSError):
+            raise unittest.SkipTest('inotify is unavailable')
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.maildir = os.path.join(self.tmpdir, 'Maildir')
+        for subdir in ('cur', 'new', 'tmp'):
+            os.makedirs(os.path.join(self.maildir, subdir))
+
+        config = self.config = mailpile.app.ConfigManager(
+            workdir=self.tmpdir, rules=mailpile.defaults.CONFIG_RULES)
+        self.session = Session(config)
+        self.session.ui = SilentInteraction(config)
+        config.sys.mailbox.append(self.maildir)
+        self.mbx_id = config.get_mailboxes()[0][0]
+
+        # Not started, so the rescans just pile up in the job queue
+        config.slow_worker = Worker('Slow worker', self.session)
+        self.watcher = MailboxWatcher(self.session)
+
+    def tearDown(self):
+        self.watcher.quit()
+        shutil.rmtree(self.tmpdir)
+
+    def _wait_for(self, check, timeout=5):
+        deadline = time.time() + timeout
+        while not check() and time.time() < deadline:
+            time.sleep(0.05)
+        return check()
+
+    def test_delivery_queues_rescan(self):
+        self.watcher.start()
+        self.assertTrue(self._wait_for(lambda: self.watcher.watches))
+        self.assertEqual(self.config.slow_worker.JOBS, [])
+
+        with open(os.path.join(self.maildir, 'new', '1.test'), 'wb') as fd:
+            fd.write('Subject: Hello\n\nHello world\n')
+        jobs = self.config.slow_worker.JOBS
+        self.assertTrue(self._wait_for(lambda: jobs))
+        self.assertEqual([name for session, name, task in jobs],
+                         ['Rescan: %s' % self.mbx_id])
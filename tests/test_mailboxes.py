@@ -0,0 +1,317 @@
+import cPickle
+import mailbox
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from mailpile.crypto.streamer import EncryptingStreamer, EVPCipher
+from mailpile.crypto.streamer import InlineDecryptingStreamer
+from mailpile.mailboxes import MailboxCache
+from mailpile.mailboxes.imap import MailpileMailbox as IMAPMailbox
+from mailpile.mailboxes.imap import POOL
+from mailpile.mailboxes.maildir import MailpileMailbox as MaildirMailbox
+from mailpile.mailboxes.mbox import MailpileMailbox as MboxMailbox
+from mailpile.mailboxes.wervd import MailpileMailbox as WervdMailbox
+from tests import get_mailpile_root
+from tests.fake_imap import FakeFolder, FakeIMAPServer
+
+
+class TestMboxTocCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.source = os.path.join(get_mailpile_root(), 'testing', 'tests.mbx')
+        self.path = os.path.join(self.tmpdir, 'test.mbx')
+        shutil.copyfile(self.source, self.path)
+        for i in range(0, 3):
+            self._append_source()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _append_source(self):
+        with open(self.path, 'ab') as fd:
+            fd.write(open(self.source, 'rb').read())
+
+    def test_toc_matches_stdlib(self):
+        ours, theirs = MboxMailbox(self.path), mailbox.mbox(self.path)
+        self.assertEqual(ours.keys(), theirs.keys())
+        for key in theirs.keys():
+            self.assertEqual(ours.get_string(key), theirs.get_string(key))
+
+    def test_incremental_toc_cache(self):
+        mbx = MboxMailbox(self.path)
+        count = len(mbx)
+        full, cache = mbx.get_toc_chunk()
+        self.assertTrue(full)
+
+        self._append_source()
+        mbx.update_toc()
+        full, chunk = mbx.get_toc_chunk()
+        self.assertFalse(full)
+        self.assertTrue(len(chunk) < len(cache))
+
+        loaded = MboxMailbox.FromTocCache(cache + chunk)
+        self.assertTrue(len(mbx) > count)
+        self.assertEqual(len(loaded), len(mbx))
+        self.assertEqual(loaded._toc, mbx._toc)
+
+        # An interrupted append loses the chunk, not the cache.
+        loaded = MboxMailbox.FromTocCache(cache + chunk[:-10])
+        self.assertEqual(loaded._toc, mbx._toc)
+        self.assertTrue(loaded.get_toc_chunk()[0])
+
+    def test_verify_ptrs(self):
+        mbx = MboxMailbox(self.path)
+        ptrs = [mbx.get_msg_ptr('0000', k) for k in mbx.keys()]
+        bogus = ptrs[1][:-4] + 'AAAA'
+        valid = mbx.verify_ptrs(ptrs + [bogus, '0000zz'])
+        self.assertEqual([valid[p] for p in ptrs], [True] * len(ptrs))
+        self.assertFalse(valid[bogus] or valid['0000zz'])
+        self.assertEqual(mbx.get_file_by_ptr(ptrs[2]).read(),
+                         mbx.get_string(2, from_=True))
+
+        # Results are cached...
+        mbx._cs_cache[ptrs[0]] = 'cached'
+        self.assertEqual(mbx.verify_ptrs(ptrs[:1]), {ptrs[0]: 'cached'})
+
+        # ...until the file changes.
+        with open(self.path, 'r+b') as fd:
+            fd.seek(mbx._toc[0][0] + 5)
+            fd.write('SOMEONE ELSE')
+        os.utime(self.path, (0, 0))
+        valid = mbx.verify_ptrs(ptrs)
+        self.assertEqual((valid[ptrs[0]], valid[ptrs[1]]), (False, True))
+        self.assertRaises(IOError, mbx.get_file_by_ptr, ptrs[0])
+
+
+class TestMailboxCache(unittest.TestCase):
+    def test_lru_eviction(self):
+        cache = MailboxCache(max_open=2)
+        cache.put('0001', 'one')
+        cache.put('0002', 'two')
+        self.assertEqual(cache.get('0001'), 'one')
+        cache.put('0003', 'three')
+        self.assertTrue('0001' in cache)
+        self.assertFalse('0002' in cache)
+        self.assertEqual(cache.get('0002'), None)
+
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions']),
+                         (1, 1, 1))
+        self.assertEqual(stats['hit_rate'], 0.5)
+
+
+class TestMaildirRefresh(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.mbx = MaildirMailbox(os.path.join(self.path, 'Maildir'))
+        self.keys = [self.mbx.add('Subject: %d\n\nHello\n' % i)
+                     for i in range(0, 5)]
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _refresh(self):
+        # Pretend the last read was long ago, so the mtimes are trusted.
+        self.mbx._last_read = 0
+        self.mbx.update_toc()
+
+    def test_unparsed_tracks_changes(self):
+        self.assertEqual(self.mbx.unparsed(), sorted(self.keys))
+        for key in self.keys[:3]:
+            self.mbx.mark_parsed(key)
+        self.assertEqual(self.mbx.unparsed(), sorted(self.keys[3:]))
+
+        # Deliver one message, move one from new/ to cur/, delete one
+        new_key = self.mbx.add('Subject: new\n\nHello\n')
+        moved = self.mbx._lookup(self.keys[4])
+        os.rename(os.path.join(self.mbx._path, moved),
+                  os.path.join(self.mbx._path, 'cur',
+                               os.path.basename(moved) + ':2,S'))
+        os.remove(os.path.join(self.mbx._path,
+                               self.mbx._lookup(self.keys[3])))
+        self._refresh()
+        self.assertEqual(self.mbx.unparsed(),
+                         sorted([self.keys[4], new_key]))
+        self.assertFalse(self.keys[3] in self.mbx)
+        self.assertTrue(self.mbx._lookup(self.keys[4]).startswith('cur'))
+
+        # The TOC survives pickling
+        loaded = cPickle.loads(cPickle.dumps(self.mbx))
+        self.assertEqual(loaded._toc, self.mbx._toc)
+        self.assertEqual(loaded.unparsed(), self.mbx.unparsed())
+
+
+class TestWervdMailbox(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.mbx = WervdMailbox(os.path.join(self.path, 'Maildir'))
+        self.mbx._encryption_key_func = lambda: 'secret'
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_streaming_decryption(self):
+        if not EVPCipher.Available():
+            raise unittest.SkipTest('libcrypto is unavailable')
+        message = ''.join('Header-%d: %s\n' % (i, 'x' * i)
+                          for i in range(0, 500)) + '\nHello world\n'
+        key = self.mbx.add(message)
+
+        fd = self.mbx.get_file(key)
+        self.assertTrue(isinstance(fd, InlineDecryptingStreamer))
+        self.assertEqual(fd.readline(), 'Header-0: \n')
+        self.assertEqual(fd.read(12), 'Header-1: x\n')
+        self.assertEqual(''.join(fd), message[23:])
+        fd.close()
+        self.assertEqual(self.mbx.get_message(key)['Header-3'], 'xxx')
+
+        # Messages encrypted by the openssl coprocess are just as readable
+        es = EncryptingStreamer('secret', dir=os.path.join(self.mbx._path,
+                                                           'tmp'))
+        es.write(message)
+        es.save(os.path.join(self.mbx._path, 'new', 'fromopenssl'))
+        self.mbx._refresh()
+        self.assertEqual(self.mbx.get_string('fromopenssl'), message)
+
+        # Unencrypted messages are passed through
+        self.mbx._encryption_key_func = lambda: None
+        key = self.mbx.add(message)
+        self.mbx._encryption_key_func = lambda: 'secret'
+        self.assertEqual(self.mbx.get_file(key).read(), message)
+
+    def test_pinned_digest(self):
+        if not EVPCipher.Available():
+            raise unittest.SkipTest('libcrypto is unavailable')
+        message = 'Subject: Pinned\n\nHello world\n'
+        key = self.mbx.add(message)
+        path = os.path.join(self.mbx._path, self.mbx._lookup(key))
+        with open(path, 'rb') as fd:
+            data = fd.read()
+        self.assertTrue('\nmd: sha256\n' in data)
+
+        # Data written before the digest was recorded uses the default
+        with open(path, 'wb') as fd:
+            fd.write(data.replace('\nmd: sha256\n', '\n'))
+        self.assertEqual(self.mbx.get_string(key), message)
+
+    def test_add_many(self):
+        self.mbx._encryption_key_func = lambda: None
+        self.mbx.FSYNC_GROUP = 4
+        messages = ['Subject: %d\n\nHello\n' % (i % 7) for i in range(0, 10)]
+        single = self.mbx.add(messages[0])
+        keys = self.mbx.add_many(messages, copies=2)
+        self.assertEqual(len(set(keys + [single])), 11)
+
+        # Identical messages get longer prefixes of the same checksum
+        self.assertTrue(keys[0].startswith(single))
+        self.assertTrue(keys[7].startswith(keys[0]))
+        for key, message in zip(keys, messages):
+            self.assertEqual(self.mbx.get_string(key), message)
+            self.assertTrue(os.path.exists(os.path.join(
+                self.mbx._path, 'new', '%s.1' % key)))
+        self.assertEqual(os.listdir(os.path.join(self.mbx._path, 'tmp')), [])
+
+
+class TestIMAPMailbox(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeIMAPServer()
+        self.inbox = self.server.folders['INBOX']
+        for i in range(0, 10):
+            self.inbox.append('Subject: %d\r\n\r\nHello %d\r\n' % (i, i))
+        self.cache = tempfile.mkdtemp()
+
+    def tearDown(self):
+        POOL.close()
+        self.server.stop()
+        shutil.rmtree(self.cache)
+
+    def _open(self, folder=None):
+        mbx = IMAPMailbox('127.0.0.1', self.server.port, 'user', 'pass',
+                          folder, use_ssl=False, cache_dir=self.cache)
+        mbx.REFRESH_INTERVAL = 0
+        return mbx
+
+    def test_incremental_sync(self):
+        mbx = self._open()
+        self.assertEqual(mbx.keys(), [str(i) for i in range(1, 11)])
+        self.assertEqual(mbx.get_msg_size('3'), len(self.inbox.messages[2][1]))
+
+        # New mail only fetches the new messages
+        self.inbox.append('Subject: new\r\n\r\nHello\r\n')
+        self.inbox.expunge(2)
+        self.server.commands = []
+        self.assertEqual(len(mbx), 10)
+        self.assertFalse('2' in mbx)
+        self.assertTrue('11' in mbx)
+        self.assertEqual(self.server.bodies_sent, 0)
+
+        # A new UIDVALIDITY means starting over (the fake server hangs up
+        # on us when that happens, so we reconnect)
+        self.inbox.uidvalidity += 1
+        self.server.commands = []
+        self.assertEqual(mbx.keys(), [str(i) for i in range(1, 12) if i != 2])
+        self.assertEqual(self.server.commands[-3:],
+                         ['STATUS', 'SELECT', 'UID FETCH'])
+
+    def test_readahead_and_cache(self):
+        mbx = self._open()
+        for key in mbx.keys():
+            self.assertEqual(mbx.get_string(key),
+                             self.inbox.messages[int(key) - 1][1])
+        # Reading in order fetched everything in a few round-trips
+        self.assertEqual(self.server.bodies_sent, 10)
+        self.assertTrue(self.server.commands.count('UID FETCH') < 5)
+
+        # The second time around, everything comes from the cache
+        mbx = cPickle.loads(cPickle.dumps(self._open()))
+        mbx.get_file('5').read()
+        self.assertEqual(self.server.bodies_sent, 10)
+
+    def test_connection_pool(self):
+        self.server.folders['Sent'] = FakeFolder()
+        self.server.folders['Sent'].append('Subject: sent\r\n\r\nHi\r\n')
+        inbox, sent = self._open(), self._open('Sent')
+        self.assertEqual(len(inbox), 10)
+        self.assertEqual(len(sent), 1)
+        self.assertEqual(self.server.logins, 1)
+
+        # Unchanged folders cost a NOOP or a STATUS, never a SELECT
+        self.server.commands = []
+        for i in range(0, 3):
+            len(inbox), len(sent)
+        self.assertFalse('SELECT' in self.server.commands)
+
+        # Reopening does not reconnect
+        inbox = cPickle.loads(cPickle.dumps(inbox))
+        self.assertEqual(inbox.get_string('1'), self.inbox.messages[0][1])
+        self.assertEqual(self.server.logins, 1)
+
+    def test_connection_limit(self):
+        max_connections, POOL.max_connections = POOL.max_connections, 2
+        try:
+            key = ('127.0.0.1', self.server.port, 'user', False)
+            conns = [POOL.get(*(key[:3] + ('pass', False)))
+                     for i in range(0, 2)]
+            self.assertEqual(POOL._count[key], 2)
+
+            # A third caller has to wait for a connection to be returned
+            waiter = threading.Thread(target=lambda: conns.append(
+                POOL.get(*(key[:3] + ('pass', False)))))
+            waiter.start()
+            waiter.join(0.2)
+            self.assertEqual(len(conns), 2)
+            POOL.release(conns[0])
+            waiter.join(5)
+            self.assertEqual(len(conns), 3)
+            self.assertTrue(conns[2] is conns[0])
+            self.assertEqual(self.server.logins, 2)
+
+            # Broken connections are dropped
+            POOL.release(conns[1], error=IOError('Connection reset'))
+            self.assertEqual(POOL._count[key], 1)
+            POOL.release(conns[2])
+        finally:
+            POOL.max_connections = max_connections
@@ -1,7 +1,19 @@
+import email.parser
+import os
+import shutil
+import tempfile
+import threading
 import unittest
 from nose.tools import assert_equal, assert_less
 
-from tests import get_shared_mailpile
+import mailpile.app
+import mailpile.defaults
+import mailpile.postinglist
+from mailpile.mailutils import Email, ParseMessage
+from mailpile.postinglist import GlobalPostingList, JournalFlusher
+from mailpile.search import MailIndex, _scan_skeleton
+from mailpile.ui import Session, SilentInteraction
+from tests import get_mailpile_root, get_shared_mailpile
 
 
 def checkSearch(query, expected_count=1):
@@ -39,3 +51,287 @@ def test_generator():
     # Not found
     yield checkSearch(['subject:Moderation', 'kde-isl'], 0)
     yield checkSearch(['has:crypto'], 2)
+    # Phrases and proximity
+    yield checkSearch(['"masculinity research"'])
+    yield checkSearch(['"ideas', 'in', 'masculinity"'])
+    yield checkSearch(['"masculinity ideas"'], 0)
+    yield checkSearch(['near:emerging,research'])
+    yield checkSearch(['near2:emerging,research'], 0)
+
+
+def test_relevance_order():
+    mp, session, config = get_shared_mailpile()[:3]
+    idx = config.index
+    results = list(idx.search(session, ['twitter']).as_set())
+    msg_id = lambda pos: idx.get_msg_at_idx_pos(pos)[idx.MSG_ID]
+    # The first message mentions twitter most densely (once the CSS in the
+    # HTML parts is ignored), the last only once.
+    most, least = '+2BwnW_1QpynHUhLWwNeHCdU8hc', 'OOFgEM5IRf9mA_ilh+2dQewlvZA'
+    idx.sort_results(session, results, 'flat-relevance', ['twitter'])
+    assert_equal(msg_id(results[0]), most)
+    assert_equal(msg_id(results[-1]), least)
+    idx.sort_results(session, results, 'rev-flat-relevance', ['twitter'])
+    assert_equal(msg_id(results[0]), least)
+
+
+def test_hdr_decoding():
+    idx = MailIndex(None)
+    msg = email.message_from_string('Subject: =?utf-8?q?Caf=C3=A9?=\n'
+                                    'From: "Bjarni" <bre@example.org>\n'
+                                    'X-Junk: caf\xe9\n\n')
+    assert_equal(idx.hdr(msg, 'subject'), u'Caf\xe9')
+    assert_equal(idx.hdr(msg, 'from'), u'Bjarni <bre@example.org>')
+    assert_equal(idx.hdr(msg, 'x-junk'), u'caf_')
+    assert_equal(idx.hdr(msg, 'x-missing'), u'')
+
+    # Decoded headers are cached on the message
+    msg.replace_header('Subject', 'Changed')
+    assert_equal(idx.hdr(msg, 'Subject'), u'Caf\xe9')
+    assert_equal(idx.hdr(None, None, value='Changed'), u'Changed')
+
+
+def test_thread_subject():
+    for subject in ('Lunch today?', 'Re: Lunch today?', 'RE: Lunch  today?',
+                    'Fwd: Re: lunch today?', 'AW: WG: Lunch today?',
+                    'Re[2]: Lunch today? ', 'SV:Lunch today?'):
+        assert_equal(MailIndex.thread_subject(subject), 'lunch today?')
+    assert_equal(MailIndex.thread_subject('Re: '), '')
+    assert_equal(MailIndex.thread_subject('Ready: steady'), 'ready: steady')
+
+
+class TestSubjectThreading(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.config = mailpile.app.ConfigManager(
+            workdir=self.tmpdir, rules=mailpile.defaults.CONFIG_RULES)
+        self.idx = MailIndex(self.config)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _add(self, subject, days, refs='', msgid=None):
+        msg = email.message_from_string('Subject: %s\nReferences: %s\n\n'
+                                        % (subject, refs))
+        msgid = (self.idx.encode_msg_id(msgid) if msgid
+                 else 'id%d' % len(self.idx.INDEX))
+        msg_idx_pos, msg_info = self.idx.add_new_msg(
+            '', msgid, days * 24 * 3600, '', [], [],
+            0, subject, '', [])
+        self.idx.set_conversation_ids(msg_info[self.idx.MSG_MID], msg)
+        msg_info = self.idx.get_msg_at_idx_pos(msg_idx_pos)
+        return msg_info[self.idx.MSG_THREAD_MID]
+
+    def test_subject_threading(self):
+        first = self._add('Lunch today?', 10)
+        self.assertEqual(first, '0')
+        # Replies join the thread, even if they arrive out of order
+        self.assertEqual(self._add('AW: Lunch today?', 11), first)
+        self.assertEqual(self._add('Re: Re: lunch today?', 8), first)
+
+        # The subject index is rebuilt from the index when needed
+        self.idx.SUBJECTS = None
+        self.assertEqual(self._add('Fwd: Lunch today?', 9), first)
+        self.assertEqual(list(self.idx.get_thread(0)), [1, 2, 3])
+
+        # Messages too far apart, or with references, are not threaded
+        self.assertNotEqual(self._add('Re: Lunch today?', 30), first)
+        self.assertNotEqual(self._add('Re: Lunch today?', 10, '<x@y>'), first)
+
+    def test_out_of_order_threading(self):
+        # Replies arriving before their parents start their own threads...
+        self.assertEqual(self._add('C', 10, '<a@x> <b@x>', '<c@x>'), '0')
+        self.assertEqual(self._add('D', 10, '<a@x> <c@x>', '<d@x>'), '0')
+        self.assertEqual(self._add('B', 10, '<a@x>', '<b@x>'), '2')
+        self.assertEqual(list(self.idx.get_thread(2)), [0, 1])
+
+        # ... until the parent arrives and adopts them all.
+        self.assertEqual(self._add('A', 10, '', '<a@x>'), '3')
+        self.assertEqual(list(self.idx.get_thread(3)), [2, 0, 1])
+        self.assertEqual(self.idx.get_thread(2), [])
+        for msg_idx_pos in range(0, 3):
+            self.assertEqual(self.idx.INDEX_THR[msg_idx_pos], 3)
+
+    def test_thread_table(self):
+        self._add('Lunch today?', 10)
+        for days in (10, 11, 12):
+            self._add('Re: Lunch today?', days)
+        self.assertEqual(list(self.idx.get_thread(0)), [1, 2, 3])
+        self.assertEqual(len(self.idx.get_conversation(msg_idx=2)), 4)
+
+        # Unthreading the root makes the first reply the new root
+        self.idx.unthread_message('0')
+        self.assertEqual(list(self.idx.get_thread(0)), [])
+        self.assertEqual(list(self.idx.get_thread(1)), [2, 3])
+        self.idx.unthread_message('3')
+        self.assertEqual(list(self.idx.get_thread(1)), [2])
+
+        # The table is rebuilt from the index when it is loaded
+        session = Session(self.config)
+        session.ui = SilentInteraction(self.config)
+        self.idx.save(session)
+        idx = MailIndex(self.config)
+        idx.load(session)
+        self.assertEqual(idx.THREADS, self.idx.THREADS)
+
+    def test_legacy_replies_dropped(self):
+        self._add('Lunch today?', 10)
+        msg_info = self.idx.get_msg_at_idx_pos(0)
+        msg_info[self.idx.MSG_REPLIES] = '1,2,3'
+        self.idx.set_msg_at_idx_pos(0, msg_info)
+        self.assertEqual(
+            self.idx.get_msg_at_idx_pos(0)[self.idx.MSG_REPLIES], '')
+
+
+class TestPointerRepair(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'test.mbx')
+        shutil.copyfile(os.path.join(get_mailpile_root(), 'testing',
+                                     'tests.mbx'), self.path)
+
+        config = self.config = mailpile.app.ConfigManager(
+            workdir=self.tmpdir, rules=mailpile.defaults.CONFIG_RULES)
+        session = config.background = Session(config)
+        session.ui = SilentInteraction(config)
+        config.sys.mailbox.append(self.path)
+        self.mbx_id = config.get_mailboxes()[0][0]
+
+        # Index just the Message-IDs and locations
+        self.idx = MailIndex(config)
+        mbox = config.open_mailbox(session, self.mbx_id)
+        parser = email.parser.HeaderParser()
+        for key in mbox.keys():
+            msg_ptr = mbox.get_msg_ptr(self.mbx_id, key)
+            msg_id = self.idx.get_msg_id(parser.parse(mbox.get_file(key)),
+                                         msg_ptr)
+            self.idx.add_new_msg(msg_ptr, msg_id, 0, '', [], [], 0, '', '',
+                                 [])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _compact(self):
+        # Delete the first message, moving all the others.
+        data = open(self.path, 'rb').read()
+        with open(self.path, 'wb') as fd:
+            fd.write(data[data.index('\nFrom ') + 1:])
+
+    def test_repair_on_read(self):
+        self._compact()
+        email = Email(self.idx, len(self.idx.INDEX) - 1)
+        old_ptr = email.get_msg_info(self.idx.MSG_PTRS)
+        self.assertTrue(email.get_file() is not None)
+
+        new_ptr = email.get_msg_info(self.idx.MSG_PTRS)
+        self.assertNotEqual(old_ptr, new_ptr)
+        self.assertFalse(old_ptr in self.idx.PTRS)
+        for pos in range(1, len(self.idx.INDEX)):
+            msg_ptr = self.idx.get_msg_at_idx_pos(pos)[self.idx.MSG_PTRS]
+            self.assertEqual(self.idx.PTRS[msg_ptr], pos)
+
+        # The deleted message stays lost, without further repair attempts.
+        self.assertTrue(Email(self.idx, 0).get_file() is None)
+        self.assertEqual(self.idx.repair_pointers(self.config.background,
+                                                  self.mbx_id), 0)
+
+    def test_repair_without_worker(self):
+        self.config.background = self.config.slow_worker = None
+        self._compact()
+        self.assertEqual(self.idx.repair_pointers_later(self.mbx_id),
+                         len(self.idx.INDEX) - 1)
+        for pos in range(1, len(self.idx.INDEX)):
+            msg_ptr = self.idx.get_msg_at_idx_pos(pos)[self.idx.MSG_PTRS]
+            self.assertEqual(self.idx.PTRS[msg_ptr], pos)
+            self.assertTrue(Email(self.idx, pos).get_file() is not None)
+
+    def test_scan_skips_known_bodies(self):
+        session = self.config.background
+        mbox = self.config.open_mailbox(session, self.mbx_id)
+        item = self.idx._scan_read(session, mbox, self.mbx_id,
+                                   {'i': mbox.keys()[0], 'msg_ptr': 'moved'})
+        item = self.idx._scan_parse(session, self.mbx_id, item)
+        self.assertFalse('data' in item or 'parser' in item)
+        self.assertEqual(item['msg_id'],
+                         self.idx.get_msg_at_idx_pos(0)[self.idx.MSG_ID])
+        self.assertEqual(item['msg'].get_payload(), None)
+
+
+class TestScanning(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'test.mbx')
+        shutil.copyfile(os.path.join(get_mailpile_root(), 'testing',
+                                     'tests.mbx'), self.path)
+
+        config = self.config = mailpile.app.ConfigManager(
+            workdir=self.tmpdir, rules=mailpile.defaults.CONFIG_RULES)
+        self.session = Session(config)
+        self.session.ui = SilentInteraction(config)
+        config.sys.mailbox.append(self.path)
+        self.mbx_id = config.get_mailboxes()[0][0]
+        self.idx = config.index = MailIndex(config)
+
+        # The keyword journal is global, keep ours apart from the shared one
+        self.journal = mailpile.postinglist.GLOBAL_POSTING_LIST
+        self.journal_bytes = GlobalPostingList.JOURNAL_BYTES
+        mailpile.postinglist.GLOBAL_POSTING_LIST = None
+        GlobalPostingList.JOURNAL_BYTES = 0
+
+    def tearDown(self):
+        mailpile.postinglist.GLOBAL_POSTING_LIST = self.journal
+        GlobalPostingList.JOURNAL_BYTES = self.journal_bytes
+        shutil.rmtree(self.tmpdir)
+
+    def _scan(self):
+        return self.idx.scan_mailbox(self.session, self.mbx_id, self.path,
+                                     self.config.open_mailbox)
+
+    def test_scan_with_filter(self):
+        self.config.filters.append({'terms': 'subject:signatures',
+                                    'tags': '+special',
+                                    'comment': 'Signed',
+                                    'type': 'incoming'})
+        self.assertEqual(self._scan(), 8)
+        self.assertEqual(len(self.idx.INDEX), 8)
+        tagged = [self.idx.get_msg_at_idx_pos(i)[self.idx.MSG_SUBJECT]
+                  for i in self.idx.TAGS.get('special', [])]
+        self.assertEqual(tagged, ['Testing signatures'])
+
+    def test_scan_flushes_journal(self):
+        self.config.sys.journal_flush_kb = 1
+        self.config.sys.journal_flush_secs = 0
+        self.config.sys.journal_flush_words = 0
+        flusher = JournalFlusher(self.session, self.idx)
+        self.assertEqual(self.idx.scan_mailbox(self.session, self.mbx_id,
+                                               self.path,
+                                               self.config.open_mailbox,
+                                               flusher=flusher), 8)
+        self.assertTrue(flusher.flushes > 0)
+        self.assertTrue(GlobalPostingList.JOURNAL_BYTES <= 1024)
+        hits = self.idx.search(self.session, ['subject:signatures'])
+        self.assertEqual(len(hits.as_set()), 1)
+
+    def test_no_forking_with_threads(self):
+        self.config.sys.scan_processes = 4
+        mbox = self.config.open_mailbox(self.session, self.mbx_id)
+        done = threading.Event()
+        other = threading.Thread(target=done.wait)
+        other.start()
+        try:
+            self.assertEqual(self.idx._scan_processes(self.session, mbox,
+                                                      1000), 1)
+        finally:
+            done.set()
+            other.join()
+
+    def test_scan_skeleton(self):
+        mbox = self.config.open_mailbox(self.session, self.mbx_id)
+        msg = ParseMessage(mbox.get_file(mbox.keys()[0]))
+        skeleton = _scan_skeleton(msg)
+        self.assertEqual(skeleton.items(), msg.items())
+        self.assertEqual([p.get_content_type() for p in skeleton.walk()],
+                         [p.get_content_type() for p in msg.walk()])
+        self.assertEqual(skeleton.signature_info, msg.signature_info)
+        for part in skeleton.walk():
+            if not part.is_multipart():
+                self.assertEqual(part.get_payload(), None)
@@ -0,0 +1,59 @@
+import asyncore
+import smtplib
+import threading
+import time
+
+from mailpile.plugins.smtp_server import SMTPServer
+from tests import MailPileUnittest
+
+
+class TestSMTPServer(MailPileUnittest):
+    def setUp(self):
+        self.server = SMTPServer(self.session, ('localhost', 0))
+        self.port = self.server.socket.getsockname()[1]
+
+    def tearDown(self):
+        self.server.close()
+
+    def _send(self, i, replies):
+        client = smtplib.SMTP('localhost', self.port, timeout=10)
+        try:
+            client.sendmail('sender@example.com', ['rcpt@example.com'],
+                            'Message-ID: <smtpbatch-%d@example.com>\n'
+                            'Subject: Smtpbatch %d\n\nHello\n' % (i, i))
+            replies.append(client.noop()[0])
+        finally:
+            client.quit()
+
+    def test_delivery(self):
+        replies = []
+        clients = [threading.Thread(target=self._send, args=(i, replies))
+                   for i in range(0, 3)]
+        for client in clients:
+            client.start()
+        deadline = time.time() + 20
+        while [c for c in clients if c.is_alive()] and time.time() < deadline:
+            asyncore.poll(timeout=0.05)
+            self.server.deliver_queued()
+        self.assertEqual(replies, [250, 250, 250])
+
+        results = self.mp.search('smtpbatch')
+        self.assertEqual(results.result['stats']['count'], 3)
+
+    def test_queued_messages_share_a_batch(self):
+        class Channel(object):
+            released = []
+
+            def release(self, status):
+                self.released.append(status)
+
+        for i in range(0, 2):
+            self.server.process_message(None, 'sender@example.com',
+                                        ['rcpt@example.com'],
+                                        'Subject: Smtpqueued %d\n\nHi\n' % i)
+            self.server.queue[-1][1] = Channel()
+        self.server.deliver_queued()
+        self.assertEqual(Channel.released, ['250 Ok', '250 Ok'])
+        self.assertEqual(self.server.queue, [])
+        results = self.mp.search('smtpqueued')
+        self.assertEqual(results.result['stats']['count'], 2)